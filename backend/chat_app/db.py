@@ -0,0 +1,43 @@
+from django.conf import settings
+from channels.db import DatabaseSyncToAsync
+from notifications.stats import DatabaseExecutorStats
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+
+_executor = None
+
+
+def get_executor():
+    """Get the thread pool running the database calls of this process"""
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            settings.DATABASE_EXECUTOR_WORKERS, thread_name_prefix="database"
+        )
+    return _executor
+
+
+def database_to_async(func):
+    """
+    Run a blocking database function on the database executor.
+
+    Like channels' database_sync_to_async, but calls don't wait for
+    asgiref's single thread-sensitive thread. The time each call waits for
+    an executor thread is recorded in DatabaseExecutorStats.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        queued = time.perf_counter()
+
+        def run():
+            DatabaseExecutorStats.record(time.perf_counter() - queued)
+            return func(*args, **kwargs)
+
+        return await DatabaseSyncToAsync(
+            run, thread_sensitive=False, executor=get_executor()
+        )()
+
+    return wrapper
@@ -0,0 +1,373 @@
+from django.db import connections, transaction
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.core import RedisChannelLayer
+from notifications.models import ChannelLayerPayloads
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from datetime import timedelta
+import asyncio
+import base64
+import collections
+import contextvars
+import logging
+import msgpack
+import psycopg2
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Local channel received by the current task
+receiving_channel = contextvars.ContextVar("receiving_channel", default=None)
+
+
+class LocalRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that delivers to the channels of this process in memory.
+
+    The layer keeps a registry of the groups its own channels belong to. A
+    group send puts the message straight into the receive buffer of the local
+    members and only publishes it through Redis for the members that belong
+    to other processes. Memberships are still stored in Redis, so other
+    processes reach the local channels as before.
+
+    The receiver holding the receive lock waits on Redis for the whole
+    process rather than on its own buffer, so a message put in its buffer is
+    followed by an empty wake-up message on the Redis channel of the process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Local channel names by group
+        self.local_groups = collections.defaultdict(set)
+        # Local channel of the receiver waiting on Redis
+        self.lock_holder = None
+        self.wake_tasks = set()
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    def deliver_locally(self, channels, message):
+        """Put a copy of the message in the receive buffer of the local channels"""
+        # Deserialize a copy like a message received from Redis would be
+        message = self.deserialize(self.serialize(message))
+
+        loop = self.receive_event_loop
+        for channel in channels:
+            if loop is not None and loop is not asyncio.get_running_loop():
+                loop.call_soon_threadsafe(self.put_locally, channel, message)
+            else:
+                self.put_locally(channel, message)
+
+    def put_locally(self, channel, message):
+        self.receive_buffer[channel].put_nowait(message)
+        if channel == self.lock_holder:
+            task = asyncio.ensure_future(self.wake(channel))
+            self.wake_tasks.add(task)
+            task.add_done_callback(self.wake_tasks.discard)
+
+    async def wake(self, channel):
+        """Make the receiver waiting on Redis check its buffer"""
+        real_channel = self.non_local_name(channel)
+        channel_key = self.prefix + real_channel
+        connection = self.connection(self.consistent_hash(real_channel))
+        # Delivered to no channel, like a group message without members
+        message = self.serialize({"__asgi_channel__": []})
+        await connection.zadd(channel_key, {message: time.time()})
+        await connection.expire(channel_key, int(self.expiry))
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+        token = receiving_channel.set(channel)
+        try:
+            return await super().receive(channel)
+        finally:
+            receiving_channel.reset(token)
+
+    async def receive_single(self, channel):
+        holder = receiving_channel.get()
+        if holder is None:
+            return await super().receive_single(channel)
+        # A message was put in the buffer before the lock was taken
+        if not self.receive_buffer[holder].empty():
+            return [], {}
+        self.lock_holder = holder
+        try:
+            return await super().receive_single(channel)
+        finally:
+            self.lock_holder = None
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            self.deliver_locally([channel], message)
+            return
+        await super().send(channel, message)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        channels = self.local_groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.local_groups[group]
+
+    async def group_send(self, group, message):
+        # Local members get the message before any round trip to Redis
+        channels = self.local_groups.get(group)
+        if channels:
+            self.deliver_locally(list(channels), message)
+        await super().group_send(group, message)
+
+    async def flush(self):
+        await super().flush()
+        self.local_groups.clear()
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Publish through Redis only for the members of other processes
+        remote_channel_names = [
+            channel for channel in channel_names if not self.is_local(channel)
+        ]
+        return super()._map_channel_keys_to_connection(remote_channel_names, message)
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    """
+    Channel layer on Postgres LISTEN/NOTIFY for deployments without Redis.
+
+    Channels and group memberships live in the memory of their process, and
+    each process listens for notifications on one connection. A send to a
+    channel or group of another process is one notification that every
+    process receives and delivers to its own members. Payloads over the
+    notification size limit are stored in ChannelLayerPayloads and the
+    notification carries their id.
+    """
+
+    extensions = ["groups", "flush"]
+
+    # Postgres notifications are limited to 8000 bytes
+    PAYLOAD_LIMIT = 7900
+
+    def __init__(
+        self,
+        database="default",
+        prefix="asgi",
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity
+        )
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.database = database
+        # Notification channel shared by the processes
+        self.prefix = prefix
+        self.client_prefix = uuid.uuid4().hex
+        self.channels = {}
+        # Local channel names by group
+        self.local_groups = collections.defaultdict(set)
+        self.listener = None
+        self.listening = None
+        self.loop = None
+
+    def serialize(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def deserialize(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def is_local(self, channel):
+        return self.non_local_name(channel).endswith(f".{self.client_prefix}!")
+
+    async def listen(self):
+        """Start the listener connection of the process on first use"""
+        if self.listening is None:
+            self.listening = asyncio.ensure_future(self.start_listener())
+        try:
+            await self.listening
+        except Exception:
+            # Retry on the next call
+            self.listening = None
+            raise
+
+    async def start_listener(self):
+        self.loop = asyncio.get_running_loop()
+        self.listener = await self.loop.run_in_executor(None, self.connect)
+        self.notifications = asyncio.Queue()
+        self.loop.add_reader(self.listener.fileno(), self.read_notifications)
+        self.dispatcher = self.loop.create_task(self.dispatch())
+
+    def connect(self):
+        listener = psycopg2.connect(
+            **connections[self.database].get_connection_params()
+        )
+        listener.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with listener.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.prefix)))
+        return listener
+
+    def stop_listener(self):
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener.fileno())
+            self.dispatcher.cancel()
+            self.listener.close()
+        self.listener = None
+        self.listening = None
+
+    def read_notifications(self):
+        try:
+            self.listener.poll()
+        except psycopg2.Error:
+            # Messages sent until the connection is back are lost, as with
+            # Redis pub/sub
+            logger.exception("Channel layer listener disconnected")
+            self.stop_listener()
+            self.loop.call_later(1, lambda: asyncio.ensure_future(self.listen()))
+            return
+
+        while self.listener.notifies:
+            payload = self.listener.notifies.pop(0).payload
+            sender, _, payload = payload.partition(":")
+            # The sending process has delivered to its own channels
+            if sender != self.client_prefix:
+                self.notifications.put_nowait(payload)
+
+    async def dispatch(self):
+        """Deliver the notified messages in order to the local channels"""
+        while True:
+            payload = await self.notifications.get()
+            try:
+                if payload.startswith("spill:"):
+                    data = await database_sync_to_async(self.load)(int(payload[6:]))
+                    if data is None:
+                        continue
+                else:
+                    data = base64.b64decode(payload)
+                envelope = self.deserialize(data)
+            except Exception:
+                logger.exception("Invalid channel layer notification")
+                continue
+
+            if "group" in envelope:
+                channels = list(self.local_groups.get(envelope["group"], ()))
+            else:
+                channels = [envelope["channel"]]
+            self.deliver(channels, envelope["message"])
+
+    def load(self, payload_id):
+        payload = (
+            ChannelLayerPayloads.objects.using(self.database)
+            .filter(id=payload_id)
+            .values_list("payload", flat=True)
+            .first()
+        )
+        return bytes(payload) if payload is not None else None
+
+    def deliver(self, channels, message):
+        """Put the message in the queues of the local channels, dropping it when full"""
+        for channel in channels:
+            queue = self.channels.get(channel)
+            if queue is None:
+                continue
+            if self.loop is not None and self.loop is not asyncio.get_running_loop():
+                self.loop.call_soon_threadsafe(self.put, queue, message)
+            else:
+                self.put(queue, message)
+
+    @staticmethod
+    def put(queue, message):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            pass
+
+    async def publish(self, envelope):
+        data = self.serialize(envelope)
+        payload = base64.b64encode(data).decode()
+        await database_sync_to_async(self.notify)(
+            payload if len(payload) <= self.PAYLOAD_LIMIT else None, data
+        )
+
+    def notify(self, payload, data):
+        # The notification is delivered once the spilled payload is committed
+        with transaction.atomic(using=self.database):
+            if payload is None:
+                payloads = ChannelLayerPayloads.objects.using(self.database)
+                payloads.filter(
+                    created_at__lt=timezone.now() - timedelta(seconds=self.expiry)
+                ).delete()
+                payload = f"spill:{payloads.create(payload=data).id}"
+
+            with connections[self.database].cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_notify(%s, %s)",
+                    [self.prefix, f"{self.client_prefix}:{payload}"],
+                )
+
+    async def new_channel(self, prefix="specific"):
+        await self.listen()
+        channel = f"{prefix}.{self.client_prefix}!{uuid.uuid4().hex}"
+        self.channels[channel] = asyncio.Queue(self.get_capacity(channel))
+        return channel
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self.listen()
+        if channel not in self.channels:
+            self.channels[channel] = asyncio.Queue(self.get_capacity(channel))
+        return await self.channels[channel].get()
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+
+        if self.is_local(channel):
+            queue = self.channels.get(channel)
+            if queue is not None and queue.full():
+                raise ChannelFull(channel)
+            self.deliver([channel], self.deserialize(self.serialize(message)))
+            return
+        await self.publish({"channel": channel, "message": message})
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        channels = self.local_groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.local_groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+
+        # Local members get the message before the notification round trip
+        channels = self.local_groups.get(group)
+        if channels:
+            self.deliver(list(channels), self.deserialize(self.serialize(message)))
+        await self.publish({"group": group, "message": message})
+
+    async def flush(self):
+        self.stop_listener()
+        self.channels.clear()
+        self.local_groups.clear()
+        await database_sync_to_async(
+            ChannelLayerPayloads.objects.using(self.database).all().delete
+        )()
@@ -1,5 +1,5 @@
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
+from chat_app.db import database_to_async
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import TokenError
 from django.contrib.auth import get_user_model
@@ -9,7 +9,7 @@ Users = get_user_model()
 
 class JWTAuthMiddleware(BaseMiddleware):
 
-    @database_sync_to_async
+    @database_to_async
     def get_user(self, token):
         try:
             # Validate the token and extracts user id from it
@@ -0,0 +1,176 @@
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = {
+        "error_message": "The login provider is unavailable. Please try again later."
+    }
+    default_code = "provider_unavailable"
+
+
+class ProviderClient:
+    """
+    HTTP client of an OAuth provider.
+
+    The requests of a process share a pooled session, so logins reuse the
+    TLS connections to the provider. Each request is bounded by
+    OAUTH_CONNECT_TIMEOUT and OAUTH_READ_TIMEOUT. Connection errors are
+    retried with backoff, and GET requests also on read timeouts and
+    502/503/504 responses. The token exchange is not retried once sent
+    since an authorization code can only be used once.
+
+    After OAUTH_BREAKER_FAILURES failed requests in a row the circuit opens
+    and requests fail right away for OAUTH_BREAKER_RESET seconds. Then one
+    request goes through to probe the provider and closes the circuit if it
+    succeeds.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.session = None
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                retry = Retry(
+                    total=settings.OAUTH_RETRIES,
+                    backoff_factor=settings.OAUTH_RETRY_BACKOFF,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=["GET"],
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_maxsize=settings.OAUTH_POOL_SIZE, max_retries=retry
+                )
+                self.session = requests.Session()
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            return self.session
+
+    def reset(self):
+        """Close the pooled connections and the circuit"""
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def post(self, url, data=None, **kwargs):
+        return self.send(self.get_session().post, url, data=data, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.send(self.get_session().get, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        """Send a request, raising ProviderUnavailable if the provider fails or the circuit is open"""
+        probe = self.before_request()
+        try:
+            response = method(
+                url,
+                timeout=(settings.OAUTH_CONNECT_TIMEOUT, settings.OAUTH_READ_TIMEOUT),
+                **kwargs,
+            )
+
+            # Client errors, like an expired authorization code, are answers
+            if not response.ok and response.status_code >= 500:
+                logger.warning(
+                    f"The {self.name} OAuth provider answered {response.status_code}"
+                )
+                self.record(failed=True)
+                raise ProviderUnavailable()
+
+            self.record(failed=False)
+            return response
+        except requests.RequestException as e:
+            logger.warning(f"Request to the {self.name} OAuth provider failed: {e}")
+            self.record(failed=True)
+            raise ProviderUnavailable()
+        finally:
+            # Any error ends the probe too, or no request would probe again
+            if probe:
+                with self.lock:
+                    self.probing = False
+
+    def before_request(self):
+        """Raise ProviderUnavailable while the circuit is open, return whether the request probes it"""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if (
+                self.probing
+                or time.monotonic() - self.opened_at < settings.OAUTH_BREAKER_RESET
+            ):
+                raise ProviderUnavailable()
+            self.probing = True
+            return True
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            # A failed probe opens the circuit again
+            if (
+                self.opened_at is not None
+                or self.failures >= settings.OAUTH_BREAKER_FAILURES
+            ):
+                if self.opened_at is None:
+                    logger.warning(f"Circuit of the {self.name} OAuth provider opened")
+                self.opened_at = time.monotonic()
+
+
+class HostClients:
+    """
+    ProviderClient per host, for URLs served by many hosts.
+
+    Each host has its own pool and circuit, so a host that is down doesn't
+    fail the requests to the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def for_url(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.clients:
+                self.clients[host] = ProviderClient(f"{self.name} {host}")
+            return self.clients[host]
+
+    def reset(self):
+        with self.lock:
+            clients, self.clients = self.clients, {}
+        for client in clients.values():
+            client.reset()
+
+    def get(self, url, **kwargs):
+        return self.for_url(url).get(url, **kwargs)
+
+
+google = ProviderClient("Google")
+intra_42 = ProviderClient("42")
+# Avatars of the OAuth users, served by the CDNs of the providers
+avatars = HostClients("avatar")
@@ -146,6 +146,10 @@ MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
 AUTH_USER_MODEL = "users.Users"
 
+# Route the conversations, messages and friendships endpoints to their
+# async views, for when the API is served by the ASGI application
+ASYNC_VIEWS = env.bool("ASYNC_VIEWS", default=False)
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_simplejwt.authentication.JWTAuthentication",
@@ -171,6 +175,9 @@ GOOGLE_CLIENT_SECRET = env("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = env("GOOGLE_REDIRECT_URI")
 GOOGLE_AUTH_URI = env("GOOGLE_AUTH_URI")
 GOOGLE_TOKEN_URI = env("GOOGLE_TOKEN_URI")
+GOOGLE_USERINFO_URI = env(
+    "GOOGLE_USERINFO_URI", default="https://www.googleapis.com/oauth2/v2/userinfo"
+)
 
 # Credentials for 42 intranet
 CLIENT_42_ID = env("CLIENT_42_ID")
@@ -178,14 +185,56 @@ CLIENT_42_SECRET = env("CLIENT_42_SECRET")
 REDIRECT_42_URI = env("REDIRECT_42_URI")
 AUTH_42_URI = env("AUTH_42_URI")
 TOKEN_42_URI = env("TOKEN_42_URI")
-
+USERINFO_42_URI = env("USERINFO_42_URI", default="https://api.intra.42.fr/v2/me")
+
+# Seconds to connect to and wait for an OAuth provider, retries of the failed
+# requests, and failures in a row before failing logins right away for
+# OAUTH_BREAKER_RESET seconds
+OAUTH_CONNECT_TIMEOUT = env.float("OAUTH_CONNECT_TIMEOUT", default=2.0)
+OAUTH_READ_TIMEOUT = env.float("OAUTH_READ_TIMEOUT", default=4.0)
+OAUTH_RETRIES = env.int("OAUTH_RETRIES", default=2)
+OAUTH_RETRY_BACKOFF = env.float("OAUTH_RETRY_BACKOFF", default=0.25)
+OAUTH_POOL_SIZE = env.int("OAUTH_POOL_SIZE", default=10)
+OAUTH_BREAKER_FAILURES = env.int("OAUTH_BREAKER_FAILURES", default=5)
+OAUTH_BREAKER_RESET = env.float("OAUTH_BREAKER_RESET", default=30.0)
+
+# Avatars of OAuth users are downloaded in the background, resized to fit
+# AVATAR_SIZE pixels and stored like uploaded pictures
+AVATAR_SIZE = 256
+AVATAR_MAX_SIZE = 2 * 1024 * 1024
+AVATAR_INGESTION_WORKERS = env.int("AVATAR_INGESTION_WORKERS", default=2)
+AVATAR_URL_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Conversations list pagination
+CONVERSATIONS_PAGE_SIZE = 20
+CONVERSATIONS_MAX_PAGE_SIZE = 100
+
+# Messages pagination and cold storage
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+MESSAGES_ARCHIVE_AFTER_DAYS = 90
+MESSAGES_ARCHIVE_BLOCK_SIZE = 500
+MESSAGES_PAGE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+MESSAGES_RING_BUFFER_SIZE = 100
+MESSAGES_IDEMPOTENCY_TIMEOUT = 60 * 60 * 24
+
+# Write-behind for messages sent over the WebSocket
+MESSAGES_WRITE_BEHIND = env.bool("MESSAGES_WRITE_BEHIND", default=False)
+MESSAGES_WRITE_BEHIND_BATCH_SIZE = 200
+MESSAGES_WRITE_BEHIND_INTERVAL_MS = 10
+MESSAGES_WRITE_BEHIND_MAX_RETRIES = 10
+MESSAGES_WRITE_BEHIND_FSYNC = True
+MESSAGES_WRITE_BEHIND_JOURNAL_DIR = BASE_DIR / "journal"
 
 # Cronjob
 CRONJOBS = [
-    ("0 0 * * *", "django.core.management.call_command", ["cleanup_conversations"])
+    ("0 0 * * *", "django.core.management.call_command", ["cleanup_conversations"]),
+    ("0 3 * * *", "django.core.management.call_command", ["archive_messages"]),
+    ("*/15 * * * *", "django.core.management.call_command", ["ingest_avatars"]),
 ]
 
-# Logger for cleanup_conversations command
+# Loggers for cronjob commands
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -201,6 +250,14 @@ LOGGING = {
             "handlers": ["file"],
             "level": "INFO",
         },
+        "chats.management.commands.archive_messages": {
+            "handlers": ["file"],
+            "level": "INFO",
+        },
+        "users.management.commands.ingest_avatars": {
+            "handlers": ["file"],
+            "level": "INFO",
+        },
     },
 }
 
@@ -209,9 +266,56 @@ LOGGING = {
 REDIS_HOST = env("REDIS_HOST")
 REDIS_PORT = env("REDIS_PORT")
 
+# Channel layer backends by mode: "core" keeps messages in Redis lists and
+# groups in sorted sets, "local" is core with in-memory delivery to the
+# channels of the same process, "pubsub" uses Redis pub/sub and "postgres"
+# uses Postgres LISTEN/NOTIFY for deployments without Redis
+CHANNEL_LAYER_BACKENDS = {
+    "core": "channels_redis.core.RedisChannelLayer",
+    "local": "chat_app.layers.LocalRedisChannelLayer",
+    "pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+    "postgres": "chat_app.layers.PostgresChannelLayer",
+}
+CHANNEL_LAYER_MODE = env("CHANNEL_LAYER_MODE", default="local")
+
+# Redis instances of the channel layer, channels and groups are sharded
+# across them by consistent hashing
+REDIS_HOSTS = env.list("REDIS_HOSTS", default=[f"redis://{REDIS_HOST}:{REDIS_PORT}"])
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {"hosts": [(REDIS_HOST, REDIS_PORT)]},
+        "BACKEND": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_MODE],
+        "CONFIG": {} if CHANNEL_LAYER_MODE == "postgres" else {"hosts": REDIS_HOSTS},
+    }
+}
+
+# WebSocket events of clients connected with ?batch=1 are sent in one frame
+# per window, 0 disables batching
+WEBSOCKET_BATCH_WINDOW_MS = env.int("WEBSOCKET_BATCH_WINDOW_MS", default=20)
+
+# Frames queued for a WebSocket client before dropping status updates or
+# disconnecting it
+WEBSOCKET_OUTBOUND_QUEUE_SIZE = env.int("WEBSOCKET_OUTBOUND_QUEUE_SIZE", default=256)
+
+# Seconds between server pings and without any frame from the client before
+# its connection is reaped, for clients connecting with ?heartbeat=1. An
+# interval of 0 disables the heartbeat
+WEBSOCKET_HEARTBEAT_INTERVAL = env.float("WEBSOCKET_HEARTBEAT_INTERVAL", default=25.0)
+WEBSOCKET_HEARTBEAT_TIMEOUT = env.float("WEBSOCKET_HEARTBEAT_TIMEOUT", default=60.0)
+
+# Seconds over which the WebSocket connections of a draining process are
+# closed
+WEBSOCKET_DRAIN_WINDOW = env.float("WEBSOCKET_DRAIN_WINDOW", default=20.0)
+
+# Threads of each process running the database calls of the WebSocket
+# consumers, each can hold a database connection
+DATABASE_EXECUTOR_WORKERS = env.int("DATABASE_EXECUTOR_WORKERS", default=10)
+
+# Cache configuration
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/1",
     }
 }
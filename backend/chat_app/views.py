@@ -0,0 +1,53 @@
+from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView with coroutine handlers, served without a thread per request by
+    the ASGI application.
+
+    Authentication, permissions and throttling can query the database, so
+    they run in the thread of the request before the handler is awaited.
+    Handlers only use the async ORM for single object lookups and saves.
+    The services and serializers are synchronous and run with sync_to_async,
+    which takes a thread for as long as they query the database. What the
+    handlers save is the thread while they wait between those steps and on
+    the channel layer, which they publish to directly.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+
+            response = await handler(request, *args, **kwargs)
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def http_method_not_allowed(self, request, *args, **kwargs):
+        return super().http_method_not_allowed(request, *args, **kwargs)
+
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
+
+    @staticmethod
+    async def get_data(serializer):
+        """Serialize in the thread of the request, related objects can be queried"""
+        return await sync_to_async(getattr)(serializer, "data")
@@ -0,0 +1,127 @@
+from django.db import transaction
+from .models import ArchivedMessages
+from .serializers import MessagesSerializer
+import json
+import zlib
+
+
+class MessagesArchive:
+    """
+    Cold storage for old conversation history.
+
+    Old messages are serialized once, compressed and stored in blocks of
+    ArchivedMessages. Every archived message id is lower than the ids left in
+    the messages table, so a reader can fill a page from the hot table first
+    and continue into the archive for the remaining, older messages.
+    """
+
+    @staticmethod
+    def compress(items):
+        return zlib.compress(json.dumps(items).encode())
+
+    @staticmethod
+    def decompress(payload):
+        return json.loads(zlib.decompress(bytes(payload)))
+
+    @staticmethod
+    def archive_conversation(conversation, cutoff, block_size):
+        """Move messages created before the cutoff into archived blocks"""
+        messages = conversation.messages_set.filter(created_at__lt=cutoff)
+
+        # Keep the last message in the hot table since the conversation references it
+        if conversation.lastMessage_id:
+            messages = messages.filter(id__lt=conversation.lastMessage_id)
+
+        messages = list(messages.select_related("sender").order_by("id"))
+        if not messages:
+            return 0
+
+        items = []
+        for message, data in zip(
+            messages, MessagesSerializer(messages, many=True).data
+        ):
+            data["IsVisibleToUser1"] = message.IsVisibleToUser1
+            data["IsVisibleToUser2"] = message.IsVisibleToUser2
+            items.append(data)
+
+        with transaction.atomic():
+            for start in range(0, len(items), block_size):
+                block = items[start : start + block_size]
+                ArchivedMessages.objects.create(
+                    conversation=conversation,
+                    first_message_id=block[0]["id"],
+                    last_message_id=block[-1]["id"],
+                    first_seq=block[0]["seq"],
+                    last_seq=block[-1]["seq"],
+                    count=len(block),
+                    payload=MessagesArchive.compress(block),
+                )
+            conversation.messages_set.filter(
+                id__in=[message.id for message in messages]
+            ).delete()
+
+        return len(items)
+
+    @staticmethod
+    def read(conversation, user, before=None, limit=None):
+        """
+        Read archived messages visible to the user, newest first up to the limit,
+        and return them in ascending order.
+        """
+        visibility_field = (
+            "IsVisibleToUser1" if user == conversation.user1 else "IsVisibleToUser2"
+        )
+        blocks = conversation.archived_blocks.filter(
+            **{visibility_field: True}
+        ).order_by("-last_message_id")
+        if before is not None:
+            blocks = blocks.filter(first_message_id__lt=before)
+
+        messages = []
+        for block in blocks.iterator():
+            for item in reversed(MessagesArchive.decompress(block.payload)):
+                if before is not None and item["id"] >= before:
+                    continue
+                if not item.pop(visibility_field):
+                    continue
+                item.pop("IsVisibleToUser1", None)
+                item.pop("IsVisibleToUser2", None)
+                messages.append(item)
+                if limit is not None and len(messages) >= limit:
+                    return messages[::-1]
+
+        return messages[::-1]
+
+    @staticmethod
+    def read_seq_range(conversation, user, seq_from, seq_to):
+        """Read archived messages visible to the user within the seq range"""
+        visibility_field = (
+            "IsVisibleToUser1" if user == conversation.user1 else "IsVisibleToUser2"
+        )
+        blocks = conversation.archived_blocks.filter(
+            **{visibility_field: True},
+            last_seq__gte=seq_from,
+            first_seq__lte=seq_to,
+        ).order_by("first_seq")
+
+        messages = []
+        for block in blocks.iterator():
+            for item in MessagesArchive.decompress(block.payload):
+                if not seq_from <= item["seq"] <= seq_to:
+                    continue
+                if not item.pop(visibility_field):
+                    continue
+                item.pop("IsVisibleToUser1", None)
+                item.pop("IsVisibleToUser2", None)
+                messages.append(item)
+
+        return messages
+
+    @staticmethod
+    def hide_for_user(user, conversation):
+        """Hide the archived messages for a particular user in a conversation"""
+        blocks = conversation.archived_blocks.all()
+        if user == conversation.user1:
+            blocks.update(IsVisibleToUser1=False)
+        else:
+            blocks.update(IsVisibleToUser2=False)
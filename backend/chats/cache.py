@@ -0,0 +1,259 @@
+from django.core.cache import cache
+from django.conf import settings
+from .serializers import MessagesSerializer
+import time
+
+
+class MessagesPageCache:
+    """
+    Cache for closed pages of messages.
+
+    A page requested with a `before` cursor that has newer messages after it
+    never changes, except when the viewer clears or hides the chat. Pages are
+    cached per viewer under a visibility version that is bumped on those actions,
+    which invalidates every cached page of the viewer at once.
+    """
+
+    @staticmethod
+    def version_key(conversation, user):
+        return f"chats:messages:version:{conversation.id}:{user.id}"
+
+    @staticmethod
+    def get_version(conversation, user):
+        """
+        Get the visibility version, starting from the current time so that
+        an evicted version never reuses the number of an older one
+        """
+        key = MessagesPageCache.version_key(conversation, user)
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, time.time_ns(), None)
+            version = cache.get(key)
+        return version
+
+    @staticmethod
+    def page_key(conversation, user, before, limit):
+        version = MessagesPageCache.get_version(conversation, user)
+        return f"chats:messages:page:{conversation.id}:{user.id}:{version}:{before}:{limit}"
+
+    @staticmethod
+    def get(conversation, user, before, limit):
+        return cache.get(MessagesPageCache.page_key(conversation, user, before, limit))
+
+    @staticmethod
+    def set(conversation, user, before, limit, data):
+        cache.set(
+            MessagesPageCache.page_key(conversation, user, before, limit),
+            list(data),
+            settings.MESSAGES_PAGE_CACHE_TIMEOUT,
+        )
+
+    @staticmethod
+    def invalidate(conversation, user):
+        """Bump the visibility version of the user in the conversation"""
+        key = MessagesPageCache.version_key(conversation, user)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+class PendingMessagesCache:
+    """
+    Count of the messages of a conversation acknowledged by the write-behind
+    buffer but not yet written, shared by the processes through the cache.
+
+    A page missing such a message must not be cached as closed. The count is
+    raised before the message takes its id and lowered once it is written or
+    dead-lettered. The count of a crashed process is never lowered, so it
+    expires TIMEOUT seconds after the last message was sent.
+    """
+
+    TIMEOUT = 60 * 60
+
+    @staticmethod
+    def key(conversation_id):
+        return f"chats:messages:pending:{conversation_id}"
+
+    @staticmethod
+    def add(conversation_id):
+        key = PendingMessagesCache.key(conversation_id)
+        cache.add(key, 0, PendingMessagesCache.TIMEOUT)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, PendingMessagesCache.TIMEOUT)
+        cache.touch(key, PendingMessagesCache.TIMEOUT)
+
+    @staticmethod
+    def remove(conversation_id, count):
+        try:
+            cache.decr(PendingMessagesCache.key(conversation_id), count)
+        except ValueError:
+            # Expired meanwhile
+            pass
+
+    @staticmethod
+    def has_pending(conversation_id):
+        return (cache.get(PendingMessagesCache.key(conversation_id)) or 0) > 0
+
+
+class MessagesIdempotencyCache:
+    """Short lived cache of the responses of messages sent with an idempotency key"""
+
+    @staticmethod
+    def key(user, idempotency_key):
+        return f"chats:messages:idempotency:{user.id}:{idempotency_key}"
+
+    @staticmethod
+    def get(user, idempotency_key):
+        return cache.get(MessagesIdempotencyCache.key(user, idempotency_key))
+
+    @staticmethod
+    def set(user, idempotency_key, data):
+        cache.set(
+            MessagesIdempotencyCache.key(user, idempotency_key),
+            dict(data),
+            settings.MESSAGES_IDEMPOTENCY_TIMEOUT,
+        )
+
+
+class MessagesRingBuffer:
+    """
+    Bounded buffer of the latest serialized messages of a conversation.
+
+    The newest page of messages is served from the buffer when it holds enough
+    messages visible to the viewer. The buffer is trusted only when its newest
+    message is the conversation's last message, otherwise the page falls back
+    to the database and the buffer is warmed again.
+    """
+
+    @staticmethod
+    def key(conversation):
+        return f"chats:messages:ring:{conversation.id}"
+
+    @staticmethod
+    def lock_key(conversation):
+        return f"chats:messages:ring:lock:{conversation.id}"
+
+    @staticmethod
+    def serialize(message, data):
+        item = dict(data)
+        item["IsVisibleToUser1"] = message.IsVisibleToUser1
+        item["IsVisibleToUser2"] = message.IsVisibleToUser2
+        return item
+
+    @staticmethod
+    def warm(conversation):
+        """Fill the buffer with the latest messages from the database"""
+        size = settings.MESSAGES_RING_BUFFER_SIZE
+        messages = list(
+            conversation.messages_set.select_related("sender").order_by("-id")[:size]
+        )
+        messages.reverse()
+        data = MessagesSerializer(messages, many=True).data
+
+        ring = {
+            "messages": [
+                MessagesRingBuffer.serialize(message, item)
+                for message, item in zip(messages, data)
+            ],
+            # The buffer holds the whole history when nothing was left out
+            "complete": len(messages) < size
+            and not conversation.archived_blocks.exists(),
+        }
+        cache.set(MessagesRingBuffer.key(conversation), ring, None)
+        return ring
+
+    @staticmethod
+    def append(conversation, message, data):
+        """Append a new message, or drop the buffer when appends run concurrently"""
+        key = MessagesRingBuffer.key(conversation)
+        lock_key = MessagesRingBuffer.lock_key(conversation)
+
+        if not cache.add(lock_key, 1, 5):
+            cache.delete(key)
+            return
+
+        try:
+            ring = cache.get(key)
+            if ring is None:
+                return
+
+            ring["messages"].append(MessagesRingBuffer.serialize(message, data))
+            if len(ring["messages"]) > settings.MESSAGES_RING_BUFFER_SIZE:
+                ring["messages"] = ring["messages"][
+                    -settings.MESSAGES_RING_BUFFER_SIZE :
+                ]
+                ring["complete"] = False
+            cache.set(key, ring, None)
+        finally:
+            cache.delete(lock_key)
+
+    @staticmethod
+    def invalidate(conversation):
+        cache.delete(MessagesRingBuffer.key(conversation))
+
+    @staticmethod
+    def is_current(conversation, ring):
+        newest_id = ring["messages"][-1]["id"] if ring["messages"] else None
+        return newest_id == conversation.lastMessage_id
+
+    @staticmethod
+    def read(conversation, ring, user, limit):
+        """Get the newest page visible to the user, or None if the buffer can't serve it"""
+        visibility_field = (
+            "IsVisibleToUser1" if user == conversation.user1 else "IsVisibleToUser2"
+        )
+        messages = [item for item in ring["messages"] if item[visibility_field]]
+        if len(messages) < limit and not ring["complete"]:
+            return None
+
+        return [
+            {
+                field: value
+                for field, value in item.items()
+                if field not in ("IsVisibleToUser1", "IsVisibleToUser2")
+            }
+            for item in messages[-limit:]
+        ]
+
+    @staticmethod
+    def get_page(conversation, user, limit):
+        """
+        Get the newest page from the buffer, warming it when it is missing or
+        stale. Returns None when the page has to be read from the database.
+        """
+        ring = cache.get(MessagesRingBuffer.key(conversation))
+        hit = ring is not None and MessagesRingBuffer.is_current(conversation, ring)
+
+        if not hit:
+            ring = MessagesRingBuffer.warm(conversation)
+            if not MessagesRingBuffer.is_current(conversation, ring):
+                MessagesRingBuffer.record("misses")
+                return None
+
+        data = MessagesRingBuffer.read(conversation, ring, user, limit)
+        MessagesRingBuffer.record("hits" if hit and data is not None else "misses")
+        return data
+
+    @staticmethod
+    def record(counter):
+        key = f"chats:messages:ring:{counter}"
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+    @staticmethod
+    def stats():
+        hits = cache.get("chats:messages:ring:hits", 0)
+        misses = cache.get("chats:messages:ring:misses", 0)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    def reset_stats():
+        cache.delete_many(["chats:messages:ring:hits", "chats:messages:ring:misses"])
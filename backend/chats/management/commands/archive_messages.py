@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+from chats.models import Conversations
+from chats.archive import MessagesArchive
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Moves old messages into compressed archived blocks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.MESSAGES_ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this number of days",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=settings.MESSAGES_ARCHIVE_BLOCK_SIZE,
+            help="Maximum number of messages per archived block",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        # Find conversations having messages older than the cutoff
+        conversations = Conversations.objects.filter(
+            messages__created_at__lt=cutoff
+        ).distinct()
+
+        count = 0
+        for conversation in conversations.iterator():
+            count += MessagesArchive.archive_conversation(
+                conversation, cutoff, options["block_size"]
+            )
+
+        logger.info(f"Archived {count} messages")
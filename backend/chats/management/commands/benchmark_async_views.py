@@ -0,0 +1,170 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.tokens import AccessToken
+from chats.models import Conversations
+from chats.services import MessagesService
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import requests
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+Users = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the throughput of the chat API served by gunicorn sync "
+        "workers and by the ASGI application with the async views"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests", type=int, default=3000, help="Requests per server"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=50, help="Requests in flight"
+        )
+        parser.add_argument(
+            "--users", type=int, default=50, help="Users chatting in pairs"
+        )
+        parser.add_argument(
+            "--gunicorn-workers",
+            type=int,
+            default=os.cpu_count() * 2 + 1,
+            help="Sync workers, sized like config/gunicorn.conf.py",
+        )
+        parser.add_argument(
+            "--daphne-workers", type=int, default=os.cpu_count(), help="ASGI workers"
+        )
+        parser.add_argument("--port", type=int, default=18100)
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        users = [
+            Users.objects.create_user(
+                username=f"bench_{suffix}_{index}",
+                email=f"bench_{suffix}_{index}@example.com",
+            )
+            for index in range(options["users"] // 2 * 2)
+        ]
+        sessions = []
+        for user1, user2 in zip(users[::2], users[1::2]):
+            conversation = Conversations.objects.create(user1=user1, user2=user2)
+            for index in range(20):
+                MessagesService.send_message(
+                    user1, conversation, {"content": f"Message {index}"}
+                )
+            for user in (user1, user2):
+                sessions.append((str(AccessToken.for_user(user)), conversation.id))
+
+        servers = (
+            (
+                "WSGI (gunicorn)",
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "chat_app.wsgi:application",
+                    "-b",
+                    f"127.0.0.1:{options['port']}",
+                    "-w",
+                    str(options["gunicorn_workers"]),
+                    "--log-level",
+                    "warning",
+                ],
+                {},
+            ),
+            (
+                "ASGI (async views)",
+                [
+                    sys.executable,
+                    str(settings.BASE_DIR / "config" / "daphne_workers.py"),
+                ],
+                {
+                    "ASYNC_VIEWS": "1",
+                    "WEBSOCKET_HOST": "127.0.0.1",
+                    "WEBSOCKET_PORT": str(options["port"]),
+                    "WEBSOCKET_WORKERS": str(options["daphne_workers"]),
+                    "WEBSOCKET_VERBOSITY": "0",
+                    "WEBSOCKET_DRAIN_WINDOW": "0",
+                },
+            ),
+        )
+
+        try:
+            for name, command, env in servers:
+                server = subprocess.Popen(
+                    command, cwd=settings.BASE_DIR, env=dict(os.environ, **env)
+                )
+                try:
+                    self.wait_for_server(options["port"])
+                    latencies, errors, elapsed = self.measure(sessions, options)
+                finally:
+                    server.terminate()
+                    server.wait()
+
+                quantiles = statistics.quantiles(latencies, n=100)
+                self.stdout.write(
+                    f"{name}: {len(latencies) / elapsed:.0f} requests/s, "
+                    f"p50 {quantiles[49] * 1000:.1f}ms, "
+                    f"p99 {quantiles[98] * 1000:.1f}ms, errors {errors}"
+                )
+        finally:
+            Users.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def wait_for_server(self, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f"http://127.0.0.1:{port}/api/conversations/", timeout=5)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.5)
+        # A worker answered, give the others time to load the application
+        time.sleep(2)
+
+    def measure(self, sessions, options):
+        """Send the hot path requests: list conversations, read and send messages"""
+        base_url = f"http://127.0.0.1:{options['port']}/api/conversations/"
+        local = threading.local()
+        errors = []
+
+        def send(_):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+
+            token, conversation_id = random.choice(sessions)
+            headers = {"Authorization": f"Bearer {token}"}
+            method, url, data = random.choice(
+                [
+                    ("GET", base_url, None),
+                    ("GET", f"{base_url}{conversation_id}/messages/", None),
+                    (
+                        "POST",
+                        f"{base_url}{conversation_id}/messages/",
+                        {"content": "Hi"},
+                    ),
+                ]
+            )
+
+            start = time.perf_counter()
+            response = local.session.request(
+                method, url, json=data, headers=headers, timeout=30
+            )
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            latencies = list(executor.map(send, range(options["requests"])))
+        elapsed = time.perf_counter() - start
+
+        return latencies, len(errors), elapsed
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from asgiref.sync import async_to_sync
+from chats.models import Conversations
+from chats.services import MessagesService
+from chats.writebehind import MessagesWriteBehind
+import tempfile
+import time
+import uuid
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the throughput of direct and write-behind message writes. "
+        "Write-behind messages are acknowledged after one round trip taking "
+        "their id and sequence number, and written in batches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--messages", type=int, default=1000, help="Number of messages to send"
+        )
+
+    def handle(self, *args, **options):
+        count = options["messages"]
+        suffix = uuid.uuid4().hex[:8]
+        user1 = User.objects.create_user(
+            username=f"benchmark1_{suffix}", email=f"benchmark1_{suffix}@example.com"
+        )
+        user2 = User.objects.create_user(
+            username=f"benchmark2_{suffix}", email=f"benchmark2_{suffix}@example.com"
+        )
+
+        try:
+            conversation = Conversations.objects.create(user1=user1, user2=user2)
+
+            start = time.perf_counter()
+            for index in range(count):
+                MessagesService.send_message(
+                    user1, conversation, {"content": f"Message {index}"}
+                )
+            self.report("Direct", count, time.perf_counter() - start)
+
+            write_behind = MessagesWriteBehind(tempfile.mkdtemp())
+
+            async def send():
+                start = time.perf_counter()
+                for index in range(count):
+                    await write_behind.enqueue(user1, conversation, f"Message {index}")
+                acknowledged = time.perf_counter() - start
+                await write_behind.flush()
+                return acknowledged, time.perf_counter() - start
+
+            acknowledged, written = async_to_sync(send)()
+            self.report("Write-behind, acknowledged", count, acknowledged)
+            self.report("Write-behind, written", count, written)
+            write_behind.journal.close()
+        finally:
+            Conversations.objects.filter(user1=user1).delete()
+            user1.delete()
+            user2.delete()
+
+    def report(self, name, count, elapsed):
+        self.stdout.write(
+            f"{name}: {count} messages in {elapsed:.2f}s "
+            f"({count / elapsed:.0f} messages/sec)"
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from chats.cache import MessagesRingBuffer
+
+
+class Command(BaseCommand):
+    help = "Shows the hit ratio of the conversations ring buffer"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset", action="store_true", help="Reset the counters after showing them"
+        )
+
+    def handle(self, *args, **options):
+        stats = MessagesRingBuffer.stats()
+
+        self.stdout.write(
+            f"Hits: {stats['hits']}, misses: {stats['misses']}, "
+            f"hit ratio: {stats['hit_ratio']:.2%}"
+        )
+
+        if options["reset"]:
+            MessagesRingBuffer.reset_stats()
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0005_rename_isvisibletoreceiver_messages_isvisibletouser1_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedMessages",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("first_message_id", models.BigIntegerField()),
+                ("last_message_id", models.BigIntegerField()),
+                ("count", models.PositiveIntegerField()),
+                ("IsVisibleToUser1", models.BooleanField(default=True)),
+                ("IsVisibleToUser2", models.BooleanField(default=True)),
+                ("payload", models.BinaryField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "conversation",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archived_blocks",
+                        to="chats.conversations",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["conversation", "-last_message_id"],
+                        name="chats_archi_convers_b7f095_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,87 @@
+from django.db import migrations, models
+import json
+import zlib
+
+
+def assign_seq(apps, schema_editor):
+    """Number the existing messages of every conversation in id order"""
+    Conversations = apps.get_model("chats", "Conversations")
+    Messages = apps.get_model("chats", "Messages")
+    ArchivedMessages = apps.get_model("chats", "ArchivedMessages")
+
+    for conversation in Conversations.objects.iterator():
+        seq = 0
+
+        # Archived messages are older than every message left in the table
+        blocks = ArchivedMessages.objects.filter(conversation=conversation)
+        for block in blocks.order_by("first_message_id"):
+            items = json.loads(zlib.decompress(bytes(block.payload)))
+            for item in items:
+                seq += 1
+                item["seq"] = seq
+            block.first_seq = items[0]["seq"]
+            block.last_seq = items[-1]["seq"]
+            block.payload = zlib.compress(json.dumps(items).encode())
+            block.save(update_fields=["first_seq", "last_seq", "payload"])
+
+        messages = list(
+            Messages.objects.filter(conversation=conversation).order_by("id").only("id")
+        )
+        for message in messages:
+            seq += 1
+            message.seq = seq
+        Messages.objects.bulk_update(messages, ["seq"], batch_size=1000)
+
+        Conversations.objects.filter(pk=conversation.pk).update(lastSeq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0006_archivedmessages"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversations",
+            name="lastSeq",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="messages",
+            name="seq",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="archivedmessages",
+            name="first_seq",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="archivedmessages",
+            name="last_seq",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(assign_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="messages",
+            name="seq",
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name="archivedmessages",
+            name="first_seq",
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name="archivedmessages",
+            name="last_seq",
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name="messages",
+            constraint=models.UniqueConstraint(
+                fields=("conversation", "seq"), name="unique_conversation_seq"
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0007_conversations_lastseq_messages_seq"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messages",
+            name="client_message_id",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name="messages",
+            constraint=models.UniqueConstraint(
+                fields=("sender", "client_message_id"),
+                name="unique_sender_client_message_id",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:54
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0008_messages_client_message_id"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="messages",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
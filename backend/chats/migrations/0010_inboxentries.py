@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_inbox(apps, schema_editor):
+    """Create the inbox entries of the existing conversations"""
+    Conversations = apps.get_model("chats", "Conversations")
+    Messages = apps.get_model("chats", "Messages")
+    InboxEntries = apps.get_model("chats", "InboxEntries")
+
+    entries = []
+    for conversation in Conversations.objects.iterator():
+        for owner_id, visible in (
+            (conversation.user1_id, conversation.IsVisibleToUser1),
+            (conversation.user2_id, conversation.IsVisibleToUser2),
+        ):
+            if owner_id is None:
+                continue
+            unread = (
+                Messages.objects.filter(
+                    conversation=conversation, IsReadByReceiver=False
+                )
+                .exclude(sender_id=owner_id)
+                .count()
+            )
+            entries.append(
+                InboxEntries(
+                    owner_id=owner_id,
+                    conversation=conversation,
+                    last_activity=conversation.lastMessageTimestamp,
+                    unread=unread,
+                    hidden=not visible,
+                )
+            )
+    InboxEntries.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0009_alter_messages_created_at"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InboxEntries",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_activity", models.DateTimeField()),
+                ("unread", models.PositiveIntegerField(default=0)),
+                ("hidden", models.BooleanField(default=False)),
+                (
+                    "conversation",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="inbox_entries",
+                        to="chats.conversations",
+                    ),
+                ),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="inbox",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["owner", "hidden", "last_activity"],
+                        name="chats_inbox_owner_i_9d70b3_idx",
+                    )
+                ],
+                "unique_together": {("owner", "conversation")},
+            },
+        ),
+        migrations.RunPython(fill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chats", "0010_inboxentries"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="inboxentries",
+            name="chats_inbox_owner_i_9d70b3_idx",
+        ),
+        migrations.AddIndex(
+            model_name="inboxentries",
+            index=models.Index(
+                fields=["owner", "hidden", "-last_activity", "-conversation"],
+                name="inbox_owner_activity_idx",
+            ),
+        ),
+    ]
@@ -1,7 +1,8 @@
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import Q, Case, When, Value
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 Users = get_user_model()
 
@@ -13,11 +14,35 @@ class Messages(models.Model):
     IsVisibleToUser1 = models.BooleanField(default=True)
     IsVisibleToUser2 = models.BooleanField(default=True)
     IsReadByReceiver = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    seq = models.PositiveIntegerField()
+    client_message_id = models.CharField(max_length=64, null=True, blank=True)
+    # Not auto_now_add, so messages written behind keep their acknowledged time
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "seq"], name="unique_conversation_seq"
+            ),
+            models.UniqueConstraint(
+                fields=["sender", "client_message_id"],
+                name="unique_sender_client_message_id",
+            ),
+        ]
 
     def __str__(self):
         return f"Message sent by {self.sender.username}"
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            # Take the next sequence number of the conversation, the row lock
+            # held until commit keeps the numbers dense under concurrent sends
+            with transaction.atomic():
+                self.seq = Conversations.reserve_seq(self.conversation_id)
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
+
 
 class Conversations(models.Model):
     user1 = models.ForeignKey(
@@ -41,6 +66,7 @@ class Conversations(models.Model):
 
     lastMessage = models.ForeignKey(Messages, null=True, on_delete=models.SET_NULL)
     lastMessageTimestamp = models.DateTimeField(auto_now=True)
+    lastSeq = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("user1", "user2")
@@ -58,4 +84,111 @@ class Conversations(models.Model):
 
     def save(self, *args, **kwargs):
         self.clean()
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # lastSeq is only updated atomically by reserve_seq, never from
+            # an instance that may hold a stale value
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "lastSeq"
+            ]
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        self.sync_inbox(adding)
+
+    def sync_inbox(self, adding=False):
+        """Mirror the visibility and activity of the conversation in the inbox of both users"""
+        if adding:
+            InboxEntries.objects.bulk_create(
+                [
+                    InboxEntries(
+                        owner_id=owner_id,
+                        conversation=self,
+                        last_activity=self.lastMessageTimestamp,
+                        hidden=hidden,
+                    )
+                    for owner_id, hidden in (
+                        (self.user1_id, not self.IsVisibleToUser1),
+                        (self.user2_id, not self.IsVisibleToUser2),
+                    )
+                    if owner_id is not None
+                ]
+            )
+            return
+
+        InboxEntries.objects.filter(conversation=self).update(
+            last_activity=self.lastMessageTimestamp,
+            hidden=Case(
+                When(owner_id=self.user1_id, then=Value(not self.IsVisibleToUser1)),
+                default=Value(not self.IsVisibleToUser2),
+            ),
+        )
+
+    @staticmethod
+    def reserve_seq(conversation_id, count=1):
+        """
+        Reserve the next sequence numbers and return the last one, in one
+        statement so concurrent callers outside a transaction never read
+        back the same number
+        """
+        table = connection.ops.quote_name(Conversations._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET "lastSeq" = "lastSeq" + %s WHERE "id" = %s '
+                'RETURNING "lastSeq"',
+                [count, conversation_id],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise Conversations.DoesNotExist()
+        return row[0]
+
+
+class ArchivedMessages(models.Model):
+    """Compressed block of old messages moved out of the messages table"""
+
+    conversation = models.ForeignKey(
+        Conversations, on_delete=models.CASCADE, related_name="archived_blocks"
+    )
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_seq = models.PositiveIntegerField()
+    last_seq = models.PositiveIntegerField()
+    count = models.PositiveIntegerField()
+    IsVisibleToUser1 = models.BooleanField(default=True)
+    IsVisibleToUser2 = models.BooleanField(default=True)
+    payload = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["conversation", "-last_message_id"])]
+
+    def __str__(self) -> str:
+        return f"Archived messages {self.first_message_id}-{self.last_message_id}"
+
+
+class InboxEntries(models.Model):
+    """
+    Conversation in the conversations list of a user, written when the
+    conversation changes so the list is read with one index range scan
+    """
+
+    owner = models.ForeignKey(Users, on_delete=models.CASCADE, related_name="inbox")
+    conversation = models.ForeignKey(
+        Conversations, on_delete=models.CASCADE, related_name="inbox_entries"
+    )
+    last_activity = models.DateTimeField()
+    unread = models.PositiveIntegerField(default=0)
+    hidden = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ("owner", "conversation")
+        indexes = [
+            models.Index(
+                fields=["owner", "hidden", "-last_activity", "-conversation"],
+                name="inbox_owner_activity_idx",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.conversation} in the inbox of {self.owner}"
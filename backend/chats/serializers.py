@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from chats.models import Conversations, Messages
+from chats.models import Conversations, Messages, InboxEntries
 from users.serializers import UsersSerializer
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model
@@ -18,6 +18,7 @@ class ConversationsSerializer(serializers.ModelSerializer):
     IsBlockedByMe = serializers.SerializerMethodField()
     IsBlockedByOtherUser = serializers.SerializerMethodField()
     lastMessage = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversations
@@ -27,6 +28,7 @@ class ConversationsSerializer(serializers.ModelSerializer):
             "IsBlockedByMe",
             "IsBlockedByOtherUser",
             "lastMessage",
+            "unread",
             "user2_username",
         ]
         read_only_fields = [
@@ -35,6 +37,7 @@ class ConversationsSerializer(serializers.ModelSerializer):
             "IsBlockedByMe",
             "IsBlockedByOtherUser",
             "lastMessage",
+            "unread",
         ]
 
     def get_user(self, obj):
@@ -70,6 +73,19 @@ class ConversationsSerializer(serializers.ModelSerializer):
         """Get the message content"""
         return obj.lastMessage.content if obj.lastMessage else None
 
+    def get_unread(self, obj):
+        """Get the number of unread messages from the inbox of auth user"""
+        if hasattr(obj, "unread"):
+            return obj.unread
+
+        user = self.context.get("request").user
+        unread = (
+            InboxEntries.objects.filter(owner=user, conversation=obj)
+            .values_list("unread", flat=True)
+            .first()
+        )
+        return unread or 0
+
     def validate(self, attrs):
         user2 = get_object_or_404(Users, username=attrs["user2_username"])
 
@@ -93,8 +109,8 @@ class MessagesSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Messages
-        fields = ["id", "conversation", "sender", "content", "created_at"]
-        read_only_fields = ["id", "conversation", "sender", "created_at"]
+        fields = ["id", "conversation", "sender", "content", "seq", "created_at"]
+        read_only_fields = ["id", "conversation", "sender", "seq", "created_at"]
 
     def get_sender(self, obj):
         return obj.sender.username
@@ -116,12 +132,15 @@ class MessagesSerializer(serializers.ModelSerializer):
         return attrs
 
     def create(self, validated_data):
-        user = self.context.get("request").user
+        user = validated_data.get("sender") or self.context.get("request").user
         conversation = validated_data["conversation"]
         content = validated_data["content"]
 
         messages = Messages.objects.create(
-            conversation=conversation, sender=user, content=content
+            conversation=conversation,
+            sender=user,
+            content=content,
+            client_message_id=validated_data.get("client_message_id"),
         )
 
         return messages
@@ -0,0 +1,391 @@
+from .serializers import MessagesSerializer
+from .models import Messages, InboxEntries
+from .archive import MessagesArchive
+from .cache import (
+    MessagesPageCache,
+    MessagesRingBuffer,
+    MessagesIdempotencyCache,
+    PendingMessagesCache,
+)
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+import base64
+
+
+class ConversationsService:
+    @staticmethod
+    def get_cursor(request):
+        """
+        Parse the `cursor` and `limit` query params of the conversations list.
+        Raises ValueError for invalid values.
+        """
+        cursor = request.query_params.get("cursor")
+        limit = int(request.query_params.get("limit", settings.CONVERSATIONS_PAGE_SIZE))
+
+        if limit < 1:
+            raise ValueError("Invalid cursor.")
+
+        if cursor is not None:
+            try:
+                timestamp, conversation_id = (
+                    base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+                )
+            except Exception:
+                raise ValueError("Invalid cursor.")
+            last_activity = parse_datetime(timestamp)
+            if last_activity is None:
+                raise ValueError("Invalid cursor.")
+            cursor = (last_activity, int(conversation_id))
+
+        return cursor, min(limit, settings.CONVERSATIONS_MAX_PAGE_SIZE)
+
+    @staticmethod
+    def encode_cursor(entry):
+        value = f"{entry.last_activity.isoformat()},{entry.conversation_id}"
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def get_page(user, cursor, limit):
+        """
+        Get a page of the visible conversations of the user, newest activity
+        first, after the `(last_activity, conversation id)` cursor.
+        Returns the conversations and the cursor of the next page, if any.
+        """
+        entries = InboxEntries.objects.filter(owner=user, hidden=False)
+        if cursor is not None:
+            last_activity, conversation_id = cursor
+            entries = entries.filter(
+                Q(last_activity__lt=last_activity)
+                | Q(last_activity=last_activity, conversation_id__lt=conversation_id)
+            )
+
+        entries = list(
+            entries.select_related(
+                "conversation__user1",
+                "conversation__user2",
+                "conversation__lastMessage",
+            ).order_by("-last_activity", "-conversation_id")[: limit + 1]
+        )
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = ConversationsService.encode_cursor(entries[-1])
+
+        conversations = []
+        for entry in entries:
+            entry.conversation.unread = entry.unread
+            conversations.append(entry.conversation)
+
+        return conversations, next_cursor
+
+
+class InboxService:
+    @staticmethod
+    def serialize(entry):
+        """Compact diff of a conversation in the inbox of its owner"""
+        conversation = entry.conversation
+        if entry.owner_id == conversation.user1_id:
+            blocked_by_me = conversation.IsBlockedByUser1
+            blocked_by_other_user = conversation.IsBlockedByUser2
+        else:
+            blocked_by_me = conversation.IsBlockedByUser2
+            blocked_by_other_user = conversation.IsBlockedByUser1
+
+        return {
+            "type": "inbox_update",
+            "conversation": conversation.id,
+            "lastMessage": (
+                conversation.lastMessage.content if conversation.lastMessage else None
+            ),
+            "timestamp": serializers.DateTimeField().to_representation(
+                entry.last_activity
+            ),
+            "unread": entry.unread,
+            "hidden": entry.hidden,
+            "IsBlockedByMe": blocked_by_me,
+            "IsBlockedByOtherUser": blocked_by_other_user,
+        }
+
+    @staticmethod
+    def get_updates(conversation_ids, owner=None):
+        """
+        Get the inbox diffs of the conversations as (owner id, diff) pairs,
+        for both participants or only for the owner
+        """
+        entries = InboxEntries.objects.filter(
+            conversation_id__in=conversation_ids
+        ).select_related("conversation__lastMessage")
+        if owner is not None:
+            entries = entries.filter(owner=owner)
+
+        return [(entry.owner_id, InboxService.serialize(entry)) for entry in entries]
+
+
+class MessagesService:
+    @staticmethod
+    def get_receiver(sender, conversation):
+        """Get the other participant of the conversation"""
+        return (
+            conversation.user2 if sender == conversation.user1 else conversation.user1
+        )
+
+    @staticmethod
+    def send_message(user, conversation, data, idempotency_key=None):
+        """
+        Validate and store a new message sent by the user in the conversation.
+
+        Returns the serialized message and whether it was created, a retried
+        message returns the original one without storing it again.
+        Raises ValidationError for invalid messages and ValueError for
+        invalid idempotency keys.
+        """
+        if idempotency_key:
+            sent_message = MessagesService.get_sent_message(
+                user, conversation, idempotency_key
+            )
+            if sent_message is not None:
+                return sent_message, False
+
+        serializer = MessagesSerializer(
+            data=data, context={"conversation_id": conversation.id}
+        )
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            serializer.save(sender=user, client_message_id=idempotency_key)
+        except IntegrityError:
+            if not idempotency_key:
+                raise
+            # A concurrent retry stored the message first
+            return (
+                MessagesService.get_sent_message(user, conversation, idempotency_key),
+                False,
+            )
+
+        if idempotency_key:
+            MessagesIdempotencyCache.set(user, idempotency_key, serializer.data)
+
+        conversation.lastMessage = serializer.instance
+        conversation.save()
+        InboxEntries.objects.filter(conversation=conversation).exclude(
+            owner=user
+        ).update(unread=F("unread") + 1)
+        MessagesRingBuffer.append(conversation, serializer.instance, serializer.data)
+
+        return serializer.data, True
+
+    @staticmethod
+    def prepare_message(user, conversation, data, idempotency_key=None):
+        """
+        Validate a new message to be written behind and return the message
+        already sent with the idempotency key and the escaped content.
+        Raises ValidationError for invalid messages and ValueError for
+        invalid idempotency keys.
+        """
+        if idempotency_key:
+            sent_message = MessagesService.get_sent_message(
+                user, conversation, idempotency_key
+            )
+            if sent_message is not None:
+                return sent_message, None
+
+        serializer = MessagesSerializer(
+            data=data, context={"conversation_id": conversation.id}
+        )
+        serializer.is_valid(raise_exception=True)
+
+        return None, serializer.validated_data["content"]
+
+    @staticmethod
+    def mark_messages_as_read(receiver, conversation):
+        """Read unread messages for the receiver and return their count"""
+        count = (
+            conversation.messages_set.exclude(sender=receiver)
+            .filter(IsReadByReceiver=False)
+            .update(IsReadByReceiver=True)
+        )
+        InboxEntries.objects.filter(
+            owner=receiver, conversation=conversation, unread__gt=0
+        ).update(unread=0)
+        return count
+
+    @staticmethod
+    def hide_messages_for_user(user, conversation):
+        """Hide messages for a particular user in a conversation"""
+        messages = conversation.messages_set.all()
+        if user == conversation.user1:
+            messages.update(IsVisibleToUser1=False)
+        else:
+            messages.update(IsVisibleToUser2=False)
+        MessagesArchive.hide_for_user(user, conversation)
+        InboxEntries.objects.filter(owner=user, conversation=conversation).update(
+            unread=0
+        )
+        MessagesPageCache.invalidate(conversation, user)
+        MessagesRingBuffer.invalidate(conversation)
+
+    @staticmethod
+    def get_cursor(request):
+        """
+        Parse the `before` cursor and `limit` query params.
+        Raises ValueError for invalid values.
+        """
+        before = request.query_params.get("before")
+        limit = request.query_params.get("limit", settings.MESSAGES_PAGE_SIZE)
+
+        before = int(before) if before is not None else None
+        limit = int(limit)
+
+        if limit < 1 or (before is not None and before < 1):
+            raise ValueError("Invalid cursor.")
+
+        return before, min(limit, settings.MESSAGES_MAX_PAGE_SIZE)
+
+    @staticmethod
+    def get_idempotency_key(request):
+        """
+        Get the client supplied key from the `Idempotency-Key` header or the
+        `client_message_id` field. Raises ValueError for invalid keys.
+        """
+        key = request.headers.get("Idempotency-Key") or request.data.get(
+            "client_message_id"
+        )
+        return MessagesService.validate_idempotency_key(key)
+
+    @staticmethod
+    def validate_idempotency_key(key):
+        if key is None:
+            return None
+        if not isinstance(key, str) or not 0 < len(key) <= 64:
+            raise ValueError("Invalid idempotency key.")
+        return key
+
+    @staticmethod
+    def get_sent_message(user, conversation, idempotency_key):
+        """
+        Get the serialized message already sent with the idempotency key,
+        from the cache or the database
+        """
+        data = MessagesIdempotencyCache.get(user, idempotency_key)
+        if data is None:
+            message = (
+                Messages.objects.filter(sender=user, client_message_id=idempotency_key)
+                .select_related("sender")
+                .first()
+            )
+            if message is None:
+                return None
+            data = MessagesSerializer(message).data
+            MessagesIdempotencyCache.set(user, idempotency_key, data)
+
+        if data["conversation"] != conversation.id:
+            raise ValueError("Idempotency key already used.")
+        return data
+
+    @staticmethod
+    def get_seq_range(request):
+        """
+        Parse the inclusive `seq_from` and `seq_to` query params.
+        Raises ValueError for invalid values.
+        """
+        seq_from = int(request.query_params.get("seq_from"))
+        seq_to = int(request.query_params.get("seq_to", seq_from))
+
+        if (
+            seq_from < 1
+            or seq_to < seq_from
+            or seq_to - seq_from >= settings.MESSAGES_MAX_PAGE_SIZE
+        ):
+            raise ValueError("Invalid seq range.")
+
+        return seq_from, seq_to
+
+    @staticmethod
+    def get_messages_seq_range(user, conversation, seq_from, seq_to):
+        """Get serialized messages visible to the user within the seq range"""
+        if user == conversation.user1:
+            messages = conversation.messages_set.filter(IsVisibleToUser1=True)
+        else:
+            messages = conversation.messages_set.filter(IsVisibleToUser2=True)
+
+        messages = messages.filter(seq__gte=seq_from, seq__lte=seq_to)
+        messages = list(messages.select_related("sender").order_by("seq"))
+        data = MessagesSerializer(messages, many=True).data
+
+        # Read through to the archive for the part of the range older than the hot messages
+        if not messages or messages[0].seq > seq_from:
+            archive_to = messages[0].seq - 1 if messages else seq_to
+            data = (
+                MessagesArchive.read_seq_range(conversation, user, seq_from, archive_to)
+                + data
+            )
+
+        return data
+
+    @staticmethod
+    def get_messages_page(user, conversation, before, limit):
+        """
+        Get a page of serialized messages visible to the user, older than
+        the `before` message id, and read through to the archive when the
+        page goes past the hot messages.
+        """
+        if user == conversation.user1:
+            messages = conversation.messages_set.filter(IsVisibleToUser1=True)
+        else:
+            messages = conversation.messages_set.filter(IsVisibleToUser2=True)
+
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+
+        messages = list(messages.select_related("sender").order_by("-id")[:limit])
+        messages.reverse()
+        data = MessagesSerializer(messages, many=True).data
+
+        if len(messages) < limit:
+            archive_before = messages[0].id if messages else before
+            data = (
+                MessagesArchive.read(
+                    conversation,
+                    user,
+                    before=archive_before,
+                    limit=limit - len(messages),
+                )
+                + data
+            )
+
+        return data
+
+    @staticmethod
+    def get_page(user, conversation, before, limit):
+        """
+        Get a page of serialized messages, from the page cache for older pages
+        or the ring buffer for the newest page when possible
+        """
+        if before is not None:
+            data = MessagesPageCache.get(conversation, user, before, limit)
+            if data is not None:
+                return data
+        elif limit <= settings.MESSAGES_RING_BUFFER_SIZE:
+            data = MessagesRingBuffer.get_page(conversation, user, limit)
+            if data is not None:
+                return data
+
+        # The page is closed when newer messages exist after it and no older
+        # message is still pending in the write-behind buffer. Checked before
+        # reading the page, since messages taking their ids afterwards are
+        # newer than the ones found here
+        closed = (
+            before is not None
+            and conversation.messages_set.filter(id__gte=before).exists()
+            and not PendingMessagesCache.has_pending(conversation.id)
+        )
+
+        data = MessagesService.get_messages_page(user, conversation, before, limit)
+        if closed:
+            MessagesPageCache.set(conversation, user, before, limit, data)
+
+        return data
@@ -0,0 +1,44 @@
+from django.test import override_settings
+from django.urls import include, path
+from chats.models import Messages
+from chats.views import AsyncConversationsView, AsyncMessagesView, OpenConversationView
+from chats.tests import test_views
+from django.core.cache import cache
+from unittest.mock import patch
+
+urlpatterns = [
+    path("api/", include("users.urls")),
+    path("api/conversations/", AsyncConversationsView.as_view()),
+    path("api/conversations/<int:pk>/", AsyncConversationsView.as_view()),
+    path("api/conversations/<int:pk>/hide/", AsyncConversationsView.as_view()),
+    path("api/conversations/<int:pk>/messages/", AsyncMessagesView.as_view()),
+    path("api/conversations/<int:pk>/open/", OpenConversationView.as_view()),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncConversationsViewTests(test_views.ConversationsViewTests):
+    """Runs the ConversationsView test suite against AsyncConversationsView."""
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncMessagesViewTests(test_views.MessagesViewTests):
+    """
+    Runs the MessagesView test suite against AsyncMessagesView.
+
+    Test cases:
+    - test_retry_message_creation_with_idempotency_key: Tests retries publish once
+    """
+
+    @patch("chats.views.ChatConsumer.asendChatMessage")
+    def test_retry_message_creation_with_idempotency_key(self, mock_send):
+        url = f"{self.url}{self.conversation.id}/messages/"
+        headers = {**self.headers, "Idempotency-Key": "key-1"}
+
+        first_response = self.client.post(url, {"content": "Hello"}, headers=headers)
+        cache.clear()
+        retry_response = self.client.post(url, {"content": "Hello"}, headers=headers)
+
+        self.assertEqual(retry_response.data, first_response.data)
+        self.assertEqual(Messages.objects.filter(content="Hello").count(), 1)
+        mock_send.assert_called_once()
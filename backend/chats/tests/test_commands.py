@@ -1,7 +1,9 @@
 from django.test import TestCase
-from chats.models import Conversations
+from chats.models import Conversations, Messages, ArchivedMessages
 from chat_app.helpers import create_test_user
 from django.core.management import call_command
+from django.utils import timezone
+from datetime import timedelta
 
 
 class CleanupConversationTests(TestCase):
@@ -23,3 +25,47 @@ class CleanupConversationTests(TestCase):
         # The conversation should not exist
         with self.assertRaises(Conversations.DoesNotExist):
             Conversations.objects.get(pk=conversation.id)
+
+
+class ArchiveMessagesTests(TestCase):
+
+    def setUp(self):
+        self.user1 = create_test_user(username="user1", email="user1@example.com")
+        self.user2 = create_test_user(username="user2", email="user2@example.com")
+        self.conversation = Conversations.objects.create(
+            user1=self.user1, user2=self.user2
+        )
+
+        for index in range(5):
+            Messages.objects.create(
+                conversation=self.conversation,
+                sender=self.user1,
+                content=f"Message {index}",
+            )
+
+        # Make all messages old enough to be archived
+        Messages.objects.update(created_at=timezone.now() - timedelta(days=365))
+
+        self.conversation.lastMessage = Messages.objects.order_by("id").last()
+        self.conversation.save()
+
+    def test_command(self):
+        call_command("archive_messages", "--block-size", "3")
+
+        # The last message of the conversation stays in the messages table
+        self.assertEqual(
+            list(Messages.objects.values_list("id", flat=True)),
+            [self.conversation.lastMessage_id],
+        )
+        self.assertEqual(ArchivedMessages.objects.count(), 2)
+        self.assertEqual(
+            sum(ArchivedMessages.objects.values_list("count", flat=True)), 4
+        )
+
+    def test_command_skips_recent_messages(self):
+        Messages.objects.update(created_at=timezone.now())
+
+        call_command("archive_messages")
+
+        self.assertEqual(Messages.objects.count(), 5)
+        self.assertFalse(ArchivedMessages.objects.exists())
@@ -1,8 +1,9 @@
 from django.test import TestCase
-from chats.models import Conversations, Messages
+from chats.models import Conversations, Messages, InboxEntries
 from django.contrib.auth import get_user_model
 from chat_app.helpers import create_test_user
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError
 
 Users = get_user_model()
 
@@ -42,6 +43,20 @@ class ConversationsModelTests(TestCase):
         self.assertIsNotNone(self.conversation)
         self.assertIsNone(self.conversation.user1)
 
+    def test_inbox_follows_conversation(self):
+        self.assertEqual(
+            set(self.conversation.inbox_entries.values_list("owner", "hidden")),
+            {(self.user.id, False), (self.another_user.id, False)},
+        )
+
+        self.conversation.IsVisibleToUser2 = False
+        self.conversation.save()
+
+        entry = InboxEntries.objects.get(owner=self.another_user)
+        self.assertTrue(entry.hidden)
+        self.assertEqual(entry.last_activity, self.conversation.lastMessageTimestamp)
+        self.assertFalse(InboxEntries.objects.get(owner=self.user).hidden)
+
     def test_assign_lastmessage_to_conversation(self):
         message = Messages.objects.create(
             conversation=self.conversation, sender=self.user, content="Last message!"
@@ -94,3 +109,39 @@ class MessageModelTests(TestCase):
             )
             message.full_clean()
             message.save()
+
+    def test_message_seq_assignment(self):
+        stale_conversation = Conversations.objects.get(pk=self.conversation.pk)
+
+        second_message = Messages.objects.create(
+            conversation=self.conversation, sender=self.user, content="Second"
+        )
+
+        # Saving a stale conversation instance keeps the sequence counter
+        stale_conversation.save()
+        third_message = Messages.objects.create(
+            conversation=self.conversation, sender=self.user, content="Third"
+        )
+
+        self.assertEqual(
+            [self.message.seq, second_message.seq, third_message.seq], [1, 2, 3]
+        )
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastSeq, 3)
+
+    def test_reserve_seq(self):
+        self.assertEqual(Conversations.reserve_seq(self.conversation.id, 3), 4)
+        self.assertEqual(Conversations.reserve_seq(self.conversation.id), 5)
+
+        with self.assertRaises(Conversations.DoesNotExist):
+            Conversations.reserve_seq(0)
+
+    def test_duplicate_message_seq_fails(self):
+
+        with self.assertRaises(IntegrityError):
+            Messages.objects.create(
+                conversation=self.conversation,
+                sender=self.user,
+                content="Duplicate",
+                seq=self.message.seq,
+            )
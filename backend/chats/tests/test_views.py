@@ -2,7 +2,13 @@ from django.test import TestCase
 from rest_framework.test import APIClient
 from rest_framework import status
 from chats.models import Conversations, Messages
+from chats.cache import MessagesRingBuffer, PendingMessagesCache
 from chat_app.helpers import create_test_user, get_auth_headers
+from django.core.management import call_command
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from unittest.mock import patch
 
 
 class ConversationsViewTests(TestCase):
@@ -16,7 +22,10 @@ class ConversationsViewTests(TestCase):
     - test_success_conversation_creation: Tests successful conversation creation
     - test_conversation_visibility_update: Tests visibility updates
     - test_list_conversations: Tests conversation listing
+    - test_list_conversations_with_cursor: Tests keyset pagination of the list
+    - test_list_conversations_with_invalid_cursor: Tests cursor validation
     - test_list_unvisible_conversations: Tests invisible conversation handling
+    - test_list_conversations_with_unread_messages: Tests unread counts from the inbox
     - test_hide_conversation: Tests conversation hiding
     - test_hide_conversation_from_unauthorized_user: Tests unauthorized access
 
@@ -104,18 +113,84 @@ class ConversationsViewTests(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(len(response.data) == 2)
-        self.assertEqual(response.data[0]["user"].get("username"), "anotheruser")
-        self.assertEqual(response.data[1]["user"].get("username"), "thirduser")
+        # Newest activity first
+        self.assertEqual(response.data[0]["user"].get("username"), "thirduser")
+        self.assertEqual(response.data[1]["user"].get("username"), "anotheruser")
+        self.assertNotIn("X-Next-Cursor", response)
+
+    def test_list_conversations_with_cursor(self):
+        usernames = ["thirduser", "anotheruser"]
+        for index in range(3):
+            user = create_test_user(
+                username=f"user{index}", email=f"user{index}@example.com"
+            )
+            Conversations.objects.create(user1=user, user2=self.user)
+            usernames.insert(0, user.username)
+
+        listed_usernames = []
+        url = f"{self.url}?limit=2"
+        while url:
+            response = self.client.get(url, headers=self.headers)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data), 2)
+            listed_usernames += [item["user"]["username"] for item in response.data]
+            cursor = response.get("X-Next-Cursor")
+            url = f"{self.url}?limit=2&cursor={cursor}" if cursor else None
+
+        self.assertEqual(listed_usernames, usernames)
+
+    def test_list_conversations_with_invalid_cursor(self):
+        for query in ("limit=0", "limit=abc", "cursor=abc", "cursor=YWJj"):
+            with self.subTest(query=query):
+                response = self.client.get(f"{self.url}?{query}", headers=self.headers)
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response.data["detail"], "Invalid cursor.")
 
     def test_list_unvisible_conversations(self):
         # Make all conversations invisible to user1
-        self.user.conversation_user1.all().update(IsVisibleToUser1=False)
+        for conversation in self.user.conversation_user1.all():
+            self.client.patch(
+                f"{self.url}{conversation.id}/hide/", headers=self.headers
+            )
 
         response = self.client.get(self.url, headers=self.headers)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(len(response.data) == 0)
 
+    def test_list_conversations_with_unread_messages(self):
+        conversation = self.user.conversation_user1.get(user2__username="anotheruser")
+        another_user_headers = get_auth_headers(
+            self.client, "anotheruser", "Swift-1234"
+        )
+
+        for content in ("Message 1", "Message 2"):
+            self.client.post(
+                f"{self.url}{conversation.id}/messages/",
+                {"content": content},
+                headers=another_user_headers,
+            )
+
+        response = self.client.get(self.url, headers=self.headers)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The conversation with the latest activity comes first
+        self.assertEqual(response.data[0]["id"], conversation.id)
+        self.assertEqual(response.data[0]["unread"], 2)
+        self.assertEqual(response.data[1]["unread"], 0)
+
+        # Reading the messages clears the unread count
+        self.client.patch(
+            f"{self.url}{conversation.id}/messages/",
+            {"action": "read_messages"},
+            headers=self.headers,
+        )
+        response = self.client.get(self.url, headers=self.headers)
+
+        self.assertEqual(response.data[0]["unread"], 0)
+
     def test_retrieve_conversation(self):
         conversation = self.user.conversation_user1.all().first()
 
@@ -175,8 +250,17 @@ class MessagesViewTests(TestCase):
     - test_endpoints_for_nonexistent_conversation: Tests nonexistent conversation handling
     - test_endpoints_for_unauthorized_user: Tests unauthorized access
     - test_success_message_creation: Tests successful message creation
+    - test_retry_message_creation_with_idempotency_key: Tests deduplicated retries
+    - test_message_creation_with_invalid_idempotency_key: Tests invalid keys
     - test_list_invisible_messages: Tests invisible message handling
     - test_success_list_messages: Tests message listing
+    - test_list_messages_with_cursor: Tests paging back with the before cursor
+    - test_list_messages_with_invalid_cursor: Tests invalid cursor handling
+    - test_list_archived_messages: Tests reading through to archived messages
+    - test_list_cached_messages: Tests caching of older pages and invalidation
+    - test_list_messages_from_ring_buffer: Tests serving the newest page from the ring buffer
+    - test_list_messages_by_seq_range: Tests listing a range of sequence numbers
+    - test_list_messages_with_invalid_seq_range: Tests invalid seq range handling
     - test_success_clear_messages: Tests message clearing
     - test_mark_messages_as_read: Tests marking messages as read
     - test_clear_message_with_invalid_action: Tests invalid action handling
@@ -186,6 +270,7 @@ class MessagesViewTests(TestCase):
     """
 
     def setUp(self):
+        cache.clear()
         self.user = create_test_user(username="testuser", email="testuser@example.com")
         self.another_user = create_test_user(
             username="anotheruser", email="anotheruser@example.com"
@@ -305,6 +390,70 @@ class MessagesViewTests(TestCase):
         self.assertEqual(response.data["sender"], self.user.username)
         self.assertEqual(response.data["conversation"], self.conversation.id)
 
+    @patch("chats.views.ChatConsumer.sendChatMessage")
+    def test_retry_message_creation_with_idempotency_key(self, mock_send):
+        url = f"{self.url}{self.conversation.id}/messages/"
+        requests = [
+            {"headers": {**self.headers, "Idempotency-Key": "key-1"}, "data": {}},
+            {"headers": self.headers, "data": {"client_message_id": "key-2"}},
+        ]
+
+        for request in requests:
+            with self.subTest():
+                mock_send.reset_mock()
+                data = {"content": "Hello world", **request["data"]}
+
+                first_response = self.client.post(url, data, headers=request["headers"])
+                retry_response = self.client.post(url, data, headers=request["headers"])
+
+                self.assertEqual(retry_response.status_code, status.HTTP_201_CREATED)
+                self.assertEqual(retry_response.data, first_response.data)
+                self.assertEqual(
+                    Messages.objects.filter(
+                        id=first_response.data["id"], content="Hello world"
+                    ).count(),
+                    1,
+                )
+                mock_send.assert_called_once()
+
+        # The stored message is found again when the cache entry expired
+        cache.clear()
+        response = self.client.post(
+            url,
+            {"content": "Hello world", "client_message_id": "key-2"},
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Messages.objects.filter(content="Hello world").count(), 2)
+
+    def test_message_creation_with_invalid_idempotency_key(self):
+        another_conversation = Conversations.objects.create(
+            user1=self.user,
+            user2=create_test_user(username="thirduser", email="thirduser@example.com"),
+        )
+        self.client.post(
+            f"{self.url}{another_conversation.id}/messages/",
+            {"content": "Hello world"},
+            headers={**self.headers, "Idempotency-Key": "used-key"},
+        )
+
+        test_cases = [
+            ("x" * 65, "Invalid idempotency key."),
+            ("used-key", "Idempotency key already used."),
+        ]
+
+        for key, error in test_cases:
+            with self.subTest():
+                response = self.client.post(
+                    f"{self.url}{self.conversation.id}/messages/",
+                    {"content": "Hello world"},
+                    headers={**self.headers, "Idempotency-Key": key},
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response.data["detail"], error)
+
     def test_list_invisible_messages(self):
         self.conversation.messages_set.filter(IsVisibleToUser1=True).update(
             IsVisibleToUser1=False
@@ -343,6 +492,180 @@ class MessagesViewTests(TestCase):
             self.conversation.messages_set.filter(IsReadByReceiver=True).count() == 2
         )
 
+    def test_list_messages_with_cursor(self):
+        first_message, second_message = self.conversation.messages_set.order_by("id")
+
+        response = self.client.get(
+            f"{self.url}{self.conversation.id}/messages/?limit=1",
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in response.data], [second_message.id]
+        )
+
+        response = self.client.get(
+            f"{self.url}{self.conversation.id}/messages/?limit=1&before={second_message.id}",
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in response.data], [first_message.id]
+        )
+
+    def test_list_messages_with_invalid_cursor(self):
+        for query in ["before=abc", "limit=0", "before=-1"]:
+            with self.subTest():
+                response = self.client.get(
+                    f"{self.url}{self.conversation.id}/messages/?{query}",
+                    headers=self.headers,
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response.data["detail"], "Invalid cursor.")
+
+    def test_list_archived_messages(self):
+        Messages.objects.update(created_at=timezone.now() - timedelta(days=365))
+        last_message = Messages.objects.create(
+            conversation=self.conversation, sender=self.user, content="Test message 3"
+        )
+        self.conversation.lastMessage = last_message
+        self.conversation.save()
+
+        call_command("archive_messages")
+
+        response = self.client.get(
+            f"{self.url}{self.conversation.id}/messages/?limit=2",
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["content"] for message in response.data],
+            ["Test message 2", "Test message 3"],
+        )
+
+        # Clearing the chat hides the archived messages too
+        self.client.patch(
+            f"{self.url}{self.conversation.id}/messages/",
+            {"action": "clear_chat"},
+            headers=self.headers,
+        )
+        response = self.client.get(
+            f"{self.url}{self.conversation.id}/messages/",
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.data, [])
+
+    def test_list_cached_messages(self):
+        first_message, second_message = self.conversation.messages_set.order_by("id")
+        url = f"{self.url}{self.conversation.id}/messages/?before={second_message.id}"
+
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(response.data[0]["content"], "Test message 1")
+
+        # The closed page is served from the cache
+        Messages.objects.filter(pk=first_message.id).update(content="Updated")
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(response.data[0]["content"], "Test message 1")
+
+        # Clearing the chat invalidates the cached pages of the user
+        self.client.patch(
+            f"{self.url}{self.conversation.id}/messages/",
+            {"action": "clear_chat"},
+            headers=self.headers,
+        )
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(response.data, [])
+
+    def test_pages_not_cached_with_pending_messages(self):
+        first_message, second_message = self.conversation.messages_set.order_by("id")
+        url = f"{self.url}{self.conversation.id}/messages/?before={second_message.id}"
+
+        # A message acknowledged by the write-behind buffer but not written yet
+        PendingMessagesCache.add(self.conversation.id)
+        self.client.get(url, headers=self.headers)
+        Messages.objects.filter(pk=first_message.id).update(content="Updated")
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(response.data[0]["content"], "Updated")
+
+        # Once written, the page is cached again
+        PendingMessagesCache.remove(self.conversation.id, 1)
+        self.client.get(url, headers=self.headers)
+        Messages.objects.filter(pk=first_message.id).update(content="Updated again")
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(response.data[0]["content"], "Updated")
+
+    def test_list_messages_from_ring_buffer(self):
+        url = f"{self.url}{self.conversation.id}/messages/"
+        self.client.post(url, {"content": "Test message 3"}, headers=self.headers)
+
+        # The first read warms the ring buffer
+        response = self.client.get(url, headers=self.headers)
+        self.assertEqual(len(response.data), 3)
+
+        # Sent messages are appended to the ring buffer and served from it
+        self.client.post(url, {"content": "Test message 4"}, headers=self.headers)
+        Messages.objects.filter(content="Test message 4").update(content="Updated")
+        response = self.client.get(url, headers=self.headers)
+
+        self.assertEqual(response.data[-1]["content"], "Test message 4")
+        self.assertEqual(MessagesRingBuffer.stats()["hits"], 1)
+        self.assertEqual(MessagesRingBuffer.stats()["misses"], 1)
+
+        # A last message missing from the ring buffer makes it stale
+        self.conversation.lastMessage = Messages.objects.create(
+            conversation=self.conversation, sender=self.user, content="Test message 5"
+        )
+        self.conversation.save()
+        response = self.client.get(url, headers=self.headers)
+
+        self.assertEqual(response.data[-1]["content"], "Test message 5")
+
+    def test_list_messages_by_seq_range(self):
+        for index in range(3, 6):
+            Messages.objects.create(
+                conversation=self.conversation,
+                sender=self.user,
+                content=f"Test message {index}",
+            )
+
+        # Archive the first three messages
+        Messages.objects.filter(seq__lte=3).update(
+            created_at=timezone.now() - timedelta(days=365)
+        )
+        self.conversation.lastMessage = Messages.objects.get(seq=5)
+        self.conversation.save()
+        call_command("archive_messages")
+
+        response = self.client.get(
+            f"{self.url}{self.conversation.id}/messages/?seq_from=2&seq_to=4",
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([message["seq"] for message in response.data], [2, 3, 4])
+        self.assertEqual(response.data[0]["content"], "Test message 2")
+
+    def test_list_messages_with_invalid_seq_range(self):
+        for query in [
+            "seq_from=abc",
+            "seq_from=0",
+            "seq_from=5&seq_to=4",
+            "seq_from=1&seq_to=1000",
+        ]:
+            with self.subTest():
+                response = self.client.get(
+                    f"{self.url}{self.conversation.id}/messages/?{query}",
+                    headers=self.headers,
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response.data["detail"], "Invalid seq range.")
+
     def test_success_clear_messages(self):
         response = self.client.patch(
             f"{self.url}{self.conversation.id}/messages/",
@@ -380,3 +703,73 @@ class MessagesViewTests(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data["detail"], "Invalid action.")
+
+
+class OpenConversationViewTests(TestCase):
+    """
+    Test suite for the OpenConversationView.
+
+    Test cases:
+    - test_open_conversation: Tests the composite response and read state
+    - test_open_conversation_query_budget: Tests the number of queries
+    - test_open_conversation_for_unauthorized_user: Tests unauthorized access
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_test_user(username="testuser", email="testuser@example.com")
+        self.another_user = create_test_user(
+            username="anotheruser", email="anotheruser@example.com"
+        )
+        self.client = APIClient()
+        self.headers = get_auth_headers(self.client, "testuser", "Swift-1234")
+
+        self.conversation = Conversations.objects.create(
+            user1=self.user, user2=self.another_user
+        )
+        for index in range(3):
+            self.conversation.lastMessage = Messages.objects.create(
+                conversation=self.conversation,
+                sender=self.another_user,
+                content=f"Test message {index}",
+            )
+        self.conversation.save()
+        self.url = f"/api/conversations/{self.conversation.id}/open/"
+
+    def test_open_conversation(self):
+        response = self.client.get(f"{self.url}?limit=2", headers=self.headers)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["conversation"]["id"], self.conversation.id)
+        self.assertEqual(
+            response.data["conversation"]["user"]["username"], "anotheruser"
+        )
+        self.assertEqual(
+            [message["content"] for message in response.data["messages"]],
+            ["Test message 1", "Test message 2"],
+        )
+        self.assertEqual(response.data["readMessages"], 3)
+        self.assertFalse(
+            self.conversation.messages_set.filter(IsReadByReceiver=False).exists()
+        )
+
+    def test_open_conversation_query_budget(self):
+        # Authentication, conversation, friendship status, unread count,
+        # messages page, archived blocks check, read state, inbox and
+        # inbox diff
+        with self.assertNumQueries(9):
+            self.client.get(self.url, headers=self.headers)
+
+        # The messages page is served from the ring buffer
+        with self.assertNumQueries(6):
+            self.client.get(self.url, headers=self.headers)
+
+    def test_open_conversation_for_unauthorized_user(self):
+        create_test_user(
+            username="unauthorizeduser", email="unauthorizeduser@example.com"
+        )
+        headers = get_auth_headers(self.client, "unauthorizeduser", "Swift-1234")
+
+        response = self.client.get(self.url, headers=headers)
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
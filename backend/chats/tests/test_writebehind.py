@@ -0,0 +1,203 @@
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.db import OperationalError, connection
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from chats.models import Conversations, Messages
+from chats.writebehind import MessagesJournal, MessagesWriteBehind
+from chat_app.helpers import create_test_user
+from pathlib import Path
+from unittest.mock import patch
+import json
+import tempfile
+import unittest
+
+
+class MessagesWriteBehindRecoveryTests(TestCase):
+
+    def setUp(self):
+        self.user1 = create_test_user(username="user1", email="user1@example.com")
+        self.user2 = create_test_user(username="user2", email="user2@example.com")
+        self.conversation = Conversations.objects.create(
+            user1=self.user1, user2=self.user2
+        )
+        self.journal_dir = Path(tempfile.mkdtemp())
+
+    def write_crashed_journal(self, entries):
+        """Write the journal of a process that no longer holds its lock"""
+        (self.journal_dir / "crashed.lock").touch()
+        with open(self.journal_dir / "crashed.0.journal", "w") as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+            # A torn line written during the crash
+            file.write('{"id": ')
+
+    def entry(self, message_id, content, client_message_id=None):
+        return {
+            "id": message_id,
+            "conversation": self.conversation.id,
+            "sender": self.user1.id,
+            "content": content,
+            "client_message_id": client_message_id,
+            "created_at": timezone.now().isoformat(),
+        }
+
+    def test_recover_crashed_journal(self):
+        self.write_crashed_journal(
+            [self.entry(1000, "Message 1"), self.entry(1001, "Message 2")]
+        )
+
+        MessagesWriteBehind.recover(self.journal_dir)
+
+        messages = Messages.objects.order_by("id")
+        self.assertEqual(
+            [(message.id, message.seq) for message in messages],
+            [(1000, 1), (1001, 2)],
+        )
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastMessage_id, 1001)
+        self.assertEqual(list(self.journal_dir.iterdir()), [])
+
+    def test_recover_skips_written_messages(self):
+        written_message = Messages.objects.create(
+            conversation=self.conversation,
+            sender=self.user1,
+            content="Message 1",
+            client_message_id="key-1",
+        )
+        self.write_crashed_journal(
+            [
+                self.entry(written_message.id, "Message 1"),
+                self.entry(written_message.id + 1, "Message 1", "key-1"),
+                self.entry(written_message.id + 2, "Message 2"),
+            ]
+        )
+
+        MessagesWriteBehind.recover(self.journal_dir)
+
+        self.assertEqual(
+            list(Messages.objects.order_by("id").values_list("seq", "content")),
+            [(1, "Message 1"), (2, "Message 2")],
+        )
+
+    def test_recover_skips_running_processes(self):
+        journal = MessagesJournal(self.journal_dir)
+        journal.append(self.entry(1000, "Message 1"))
+
+        MessagesWriteBehind.recover(self.journal_dir)
+
+        self.assertFalse(Messages.objects.exists())
+        journal.close()
+
+
+@unittest.skipUnless(
+    connection.vendor == "postgresql", "Reserving ids requires PostgreSQL"
+)
+class MessagesWriteBehindTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = create_test_user(username="user1", email="user1@example.com")
+        self.user2 = create_test_user(username="user2", email="user2@example.com")
+        self.conversation = Conversations.objects.create(
+            user1=self.user1, user2=self.user2
+        )
+
+    def test_enqueue_and_flush(self):
+        write_behind = MessagesWriteBehind(tempfile.mkdtemp())
+
+        async def send():
+            return [
+                await write_behind.enqueue(
+                    self.user1, self.conversation, f"Message {index}"
+                )
+                for index in range(3)
+            ]
+
+        acks = async_to_sync(send)()
+
+        # Messages are acknowledged with their ids and sequence numbers, in
+        # send order, before being written
+        self.assertFalse(Messages.objects.exists())
+        self.assertEqual(sorted(ack["id"] for ack in acks), [ack["id"] for ack in acks])
+        self.assertEqual([ack["seq"] for ack in acks], [1, 2, 3])
+
+        async_to_sync(write_behind.flush)()
+
+        messages = Messages.objects.order_by("seq")
+        self.assertEqual(
+            [(message.id, message.seq) for message in messages],
+            [(ack["id"], index + 1) for index, ack in enumerate(acks)],
+        )
+        # Only the open segment is left once the messages are written
+        self.assertEqual(len(list(write_behind.journal.directory.glob("*.journal"))), 1)
+        write_behind.journal.close()
+
+
+class MessagesWriteBehindDeadLetterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user1 = create_test_user(username="user1", email="user1@example.com")
+        self.user2 = create_test_user(username="user2", email="user2@example.com")
+        self.conversation = Conversations.objects.create(
+            user1=self.user1, user2=self.user2
+        )
+        self.journal_dir = Path(tempfile.mkdtemp())
+
+    def entry(self, message_id, content, conversation_id=None, sender_id=None):
+        return {
+            "id": message_id,
+            "conversation": conversation_id or self.conversation.id,
+            "sender": sender_id or self.user1.id,
+            "content": content,
+            "client_message_id": None,
+            "created_at": timezone.now().isoformat(),
+        }
+
+    def dead_letters(self):
+        with open(self.journal_dir / "dead_letters.jsonl") as file:
+            return [json.loads(line)["id"] for line in file]
+
+    def test_recover_dead_letters_failed_messages(self):
+        # Messages of a conversation and of a sender deleted meanwhile
+        (self.journal_dir / "crashed.lock").touch()
+        with open(self.journal_dir / "crashed.0.journal", "w") as file:
+            for entry in [
+                self.entry(1000, "Message 1"),
+                self.entry(1001, "Message 2", conversation_id=999),
+                self.entry(1002, "Message 3", sender_id=999),
+                self.entry(1003, "Message 4"),
+            ]:
+                file.write(json.dumps(entry) + "\n")
+
+        MessagesWriteBehind.recover(self.journal_dir)
+
+        self.assertEqual(
+            list(Messages.objects.order_by("id").values_list("id", flat=True)),
+            [1000, 1003],
+        )
+        self.assertEqual(self.dead_letters(), [1001, 1002])
+        self.assertEqual(
+            [path.name for path in self.journal_dir.iterdir()], ["dead_letters.jsonl"]
+        )
+
+    @override_settings(MESSAGES_WRITE_BEHIND_MAX_RETRIES=2)
+    def test_flush_gives_up_after_max_retries(self):
+        write_behind = MessagesWriteBehind(self.journal_dir)
+        for message_id in (1000, 1001):
+            entry = self.entry(message_id, f"Message {message_id}")
+            write_behind.append(entry, MessagesWriteBehind.from_entry(entry))
+
+        with patch.object(
+            MessagesWriteBehind, "write", side_effect=OperationalError("Down")
+        ):
+            with self.assertRaises(OperationalError):
+                async_to_sync(write_behind.flush)()
+            self.assertEqual(len(write_behind.pending), 2)
+
+            async_to_sync(write_behind.flush)()
+
+        self.assertEqual(write_behind.pending, [])
+        self.assertEqual(write_behind.failures, 0)
+        self.assertEqual(self.dead_letters(), [1000, 1001])
+        # Only the open segment is left
+        self.assertEqual(len(list(self.journal_dir.glob("*.journal"))), 1)
+        write_behind.journal.close()
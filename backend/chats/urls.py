@@ -1,5 +1,15 @@
+from django.conf import settings
 from django.urls import path
-from .views import ConversationsView, MessagesView
+from .views import (
+    ConversationsView,
+    MessagesView,
+    OpenConversationView,
+    AsyncConversationsView,
+    AsyncMessagesView,
+)
+
+if settings.ASYNC_VIEWS:
+    ConversationsView, MessagesView = AsyncConversationsView, AsyncMessagesView
 
 urlpatterns = [
     path(
@@ -16,4 +26,9 @@ urlpatterns = [
         name="delete-conversation",
     ),
     path("conversations/<int:pk>/messages/", MessagesView.as_view(), name="messages"),
+    path(
+        "conversations/<int:pk>/open/",
+        OpenConversationView.as_view(),
+        name="open-conversation",
+    ),
 ]
@@ -1,30 +1,17 @@
 from django.shortcuts import render
-from .serializers import ConversationsSerializer, MessagesSerializer
+from .serializers import ConversationsSerializer
 from .models import Conversations, Messages
 from django.db.models import Q
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, aget_object_or_404
 from rest_framework.permissions import IsAuthenticated
 from .permissions import IsParticipantInConversation
 from notifications.consumers import ChatConsumer
-
-
-class MessagesService:
-    @staticmethod
-    def mark_messages_as_read(receiver, conversation):
-        """Read unread messages for the receiver"""
-        conversation.messages_set.exclude(sender=receiver).update(IsReadByReceiver=True)
-
-    @staticmethod
-    def hide_messages_for_user(user, conversation):
-        """Hide messages for a particular user in a conversation"""
-        messages = conversation.messages_set.all()
-        if user == conversation.user1:
-            messages.update(IsVisibleToUser1=False)
-        else:
-            messages.update(IsVisibleToUser2=False)
+from .services import ConversationsService, MessagesService, InboxService
+from chat_app.views import AsyncAPIView
+from asgiref.sync import sync_to_async
 
 
 class ConversationsView(APIView):
@@ -32,7 +19,10 @@ class ConversationsView(APIView):
     View for managing conversations between users.
 
     Methods:
-        get(request): Lists all visible conversations for authenticated user
+        get(request): Lists a page of visible conversations for authenticated
+            user from their inbox, newest activity first, with the number of
+            unread messages. The next page is requested with the `cursor`
+            returned in the `X-Next-Cursor` header
         post(request): Creates a new conversation or activates an existing one
         patch(request, pk): Hides a conversation for the authenticated user
 
@@ -56,15 +46,23 @@ class ConversationsView(APIView):
 
         user = request.user
 
-        conversations = Conversations.objects.filter(
-            Q(user1=user, IsVisibleToUser1=True) | Q(user2=user, IsVisibleToUser2=True)
-        ).order_by("lastMessageTimestamp")
+        try:
+            cursor, limit = ConversationsService.get_cursor(request)
+        except ValueError:
+            return Response(
+                {"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        conversations, next_cursor = ConversationsService.get_page(user, cursor, limit)
 
         serializer = ConversationsSerializer(
             conversations, many=True, context={"request": request}
         )
 
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        if next_cursor:
+            response["X-Next-Cursor"] = next_cursor
+        return response
 
     def post(self, request):
 
@@ -86,6 +84,9 @@ class ConversationsView(APIView):
                 conversation.IsVisibleToUser2 = True
 
             conversation.save()
+            ChatConsumer.sendInboxUpdates(
+                InboxService.get_updates([conversation.id], owner=user)
+            )
             serializer = ConversationsSerializer(
                 conversation, context={"request": request}
             )
@@ -117,6 +118,9 @@ class ConversationsView(APIView):
             MessagesService.hide_messages_for_user(user, conversation)
 
         conversation.save()
+        ChatConsumer.sendInboxUpdates(
+            InboxService.get_updates([conversation.id], owner=user)
+        )
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -126,7 +130,11 @@ class MessagesView(APIView):
     View for managing messages within conversations.
 
     Methods:
-        get(request, pk): Lists all visible messages in a conversation
+        get(request, pk): Lists a page of visible messages in a conversation,
+            newest page first, paged back with the `before` message id cursor.
+            Older pages are cached until the user clears or hides the chat.
+            With `seq_from` and `seq_to`, lists the messages within that
+            inclusive range of conversation sequence numbers
         post(request, pk): Creates a new message in a conversation
         patch(request, pk): Handles message actions (clear chat, mark as read)
 
@@ -142,40 +150,59 @@ class MessagesView(APIView):
         conversation = get_object_or_404(Conversations, pk=pk)
         self.check_object_permissions(request, conversation)
 
-        if user == conversation.user1:
-            messages = conversation.messages_set.filter(IsVisibleToUser1=True)
-        else:
-            messages = conversation.messages_set.filter(IsVisibleToUser2=True)
+        if "seq_from" in request.query_params:
+            try:
+                seq_from, seq_to = MessagesService.get_seq_range(request)
+            except ValueError:
+                return Response(
+                    {"detail": "Invalid seq range."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            return Response(
+                MessagesService.get_messages_seq_range(
+                    user, conversation, seq_from, seq_to
+                )
+            )
+
+        try:
+            before, limit = MessagesService.get_cursor(request)
+        except ValueError:
+            return Response(
+                {"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Mark messages as read by the auth user
-        MessagesService.mark_messages_as_read(user, conversation)
+        data = MessagesService.get_page(user, conversation, before, limit)
 
-        serializer = MessagesSerializer(messages, many=True)
+        if before is None:
+            # Mark messages as read by the auth user
+            if MessagesService.mark_messages_as_read(user, conversation):
+                ChatConsumer.sendInboxUpdates(
+                    InboxService.get_updates([conversation.id], owner=user)
+                )
 
-        return Response(serializer.data)
+        return Response(data)
 
     def post(self, request, pk=None):
         conversation = get_object_or_404(Conversations, pk=pk)
         self.check_object_permissions(request, conversation)
 
-        serializer = MessagesSerializer(
-            data=request.data,
-            context={"request": request, "conversation_id": conversation.id},
-        )
-
-        if serializer.is_valid():
-            serializer.save()
-            conversation.lastMessage = serializer.instance
-            conversation.save()
+        try:
+            # A retry with an idempotency key returns the original message
+            data, created = MessagesService.send_message(
+                request.user,
+                conversation,
+                request.data,
+                MessagesService.get_idempotency_key(request),
+            )
+        except ValueError as error:
+            return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
+        if created:
             # Send chat message to the other user via websocket
-            user = request.user
-            receiver_id = (
-                user.id if conversation.user1.id != user.id else conversation.user2.id
-            )
-            ChatConsumer.sendChatMessage(receiver_id, serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            receiver = MessagesService.get_receiver(request.user, conversation)
+            ChatConsumer.sendChatMessage(receiver.id, data)
+            ChatConsumer.sendInboxUpdates(InboxService.get_updates([conversation.id]))
+        return Response(data, status=status.HTTP_201_CREATED)
 
     def patch(self, request, pk=None):
         conversation = get_object_or_404(Conversations, pk=pk)
@@ -184,16 +211,283 @@ class MessagesView(APIView):
         user = request.user
 
         if action == "clear_chat":
-            if user == conversation.user1:
-                conversation.messages_set.all().update(IsVisibleToUser1=False)
+            MessagesService.hide_messages_for_user(user, conversation)
+            ChatConsumer.sendInboxUpdates(
+                InboxService.get_updates([conversation.id], owner=user)
+            )
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        elif action == "read_messages":
+            if MessagesService.mark_messages_as_read(user, conversation):
+                ChatConsumer.sendInboxUpdates(
+                    InboxService.get_updates([conversation.id], owner=user)
+                )
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response(
+            {"detail": "Invalid action."}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+class OpenConversationView(APIView):
+    """
+    View for opening a conversation in a single request.
+
+    Methods:
+        get(request, pk): Returns the conversation with the other participant,
+            the newest page of messages and marks the messages as read
+
+    Permissions:
+        - Requires authentication
+        - User must be a participant in the conversation
+    """
+
+    permission_classes = [IsAuthenticated, IsParticipantInConversation]
+
+    def get(self, request, pk=None):
+        user = request.user
+        conversation = get_object_or_404(
+            Conversations.objects.select_related("user1", "user2", "lastMessage"),
+            pk=pk,
+        )
+        self.check_object_permissions(request, conversation)
+
+        try:
+            _, limit = MessagesService.get_cursor(request)
+        except ValueError:
+            return Response(
+                {"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        serializer = ConversationsSerializer(conversation, context={"request": request})
+        messages = MessagesService.get_page(user, conversation, None, limit)
+        read_messages = MessagesService.mark_messages_as_read(user, conversation)
+        if read_messages:
+            ChatConsumer.sendInboxUpdates(
+                InboxService.get_updates([conversation.id], owner=user)
+            )
+
+        return Response(
+            {
+                "conversation": serializer.data,
+                "messages": messages,
+                "readMessages": read_messages,
+            }
+        )
+
+
+class AsyncConversationsView(AsyncAPIView):
+    """
+    Async version of ConversationsView, routed instead of it when
+    ASYNC_VIEWS is set and the API is served by the ASGI application.
+    """
+
+    permission_classes = [IsAuthenticated, IsParticipantInConversation]
+
+    async def get(self, request, pk=None):
+
+        if pk:
+            # Retrieve a conversation
+            conversation = await aget_object_or_404(Conversations, pk=pk)
+            serializer = ConversationsSerializer(
+                conversation, context={"request": request}
+            )
+
+            return Response(await self.get_data(serializer))
+
+        user = request.user
+
+        try:
+            cursor, limit = ConversationsService.get_cursor(request)
+        except ValueError:
+            return Response(
+                {"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        conversations, next_cursor = await sync_to_async(ConversationsService.get_page)(
+            user, cursor, limit
+        )
+
+        serializer = ConversationsSerializer(
+            conversations, many=True, context={"request": request}
+        )
+
+        response = Response(await self.get_data(serializer))
+        if next_cursor:
+            response["X-Next-Cursor"] = next_cursor
+        return response
+
+    async def post(self, request):
+
+        # If a conversation already exists then activate
+        # the visibility for the auth user
+        user = request.user
+        user2_username = request.data.get("user2_username")
+
+        conversation = await Conversations.objects.filter(
+            Q(user1=user, user2__username=user2_username)
+            | Q(user1__username=user2_username, user2=user),
+        ).afirst()
+
+        if conversation:
+            # Update visibility
+            if user.id == conversation.user1_id:
+                conversation.IsVisibleToUser1 = True
             else:
-                conversation.messages_set.all().update(IsVisibleToUser2=False)
+                conversation.IsVisibleToUser2 = True
+
+            await conversation.asave()
+            await ChatConsumer.asendInboxUpdates(
+                await sync_to_async(InboxService.get_updates)(
+                    [conversation.id], owner=user
+                )
+            )
+            serializer = ConversationsSerializer(
+                conversation, context={"request": request}
+            )
+            return Response(
+                await self.get_data(serializer),
+                status=status.HTTP_200_OK,
+            )
+        # Create new conversation
+        serializer = ConversationsSerializer(
+            data=request.data, context={"request": request}
+        )
+
+        if await sync_to_async(serializer.is_valid)():
+            await sync_to_async(serializer.save)()
+            return Response(
+                await self.get_data(serializer), status=status.HTTP_201_CREATED
+            )
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    async def patch(self, request, pk=None):
+        conversation = await aget_object_or_404(
+            Conversations.objects.select_related("user1", "user2"), pk=pk
+        )
+        user = request.user
+
+        self.check_object_permissions(request, conversation)
+        # Hide the conversation and hide too messages for the auth user
+        if user == conversation.user1:
+            conversation.IsVisibleToUser1 = False
+        else:
+            conversation.IsVisibleToUser2 = False
+        await sync_to_async(MessagesService.hide_messages_for_user)(user, conversation)
+
+        await conversation.asave()
+        await ChatConsumer.asendInboxUpdates(
+            await sync_to_async(InboxService.get_updates)([conversation.id], owner=user)
+        )
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AsyncMessagesView(AsyncAPIView):
+    """
+    Async version of MessagesView, routed instead of it when ASYNC_VIEWS is
+    set and the API is served by the ASGI application.
+    """
+
+    permission_classes = [IsAuthenticated, IsParticipantInConversation]
+
+    async def get(self, request, pk=None):
+        user = request.user
+        conversation = await aget_object_or_404(
+            Conversations.objects.select_related("user1", "user2"), pk=pk
+        )
+        self.check_object_permissions(request, conversation)
+
+        if "seq_from" in request.query_params:
+            try:
+                seq_from, seq_to = MessagesService.get_seq_range(request)
+            except ValueError:
+                return Response(
+                    {"detail": "Invalid seq range."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            return Response(
+                await sync_to_async(MessagesService.get_messages_seq_range)(
+                    user, conversation, seq_from, seq_to
+                )
+            )
+
+        try:
+            before, limit = MessagesService.get_cursor(request)
+        except ValueError:
+            return Response(
+                {"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        data = await sync_to_async(MessagesService.get_page)(
+            user, conversation, before, limit
+        )
+
+        if before is None:
+            # Mark messages as read by the auth user
+            await self.read_messages(user, conversation)
+
+        return Response(data)
+
+    async def post(self, request, pk=None):
+        conversation = await aget_object_or_404(
+            Conversations.objects.select_related("user1", "user2"), pk=pk
+        )
+        self.check_object_permissions(request, conversation)
+
+        try:
+            # A retry with an idempotency key returns the original message
+            data, created = await sync_to_async(MessagesService.send_message)(
+                request.user,
+                conversation,
+                request.data,
+                MessagesService.get_idempotency_key(request),
+            )
+        except ValueError as error:
+            return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if created:
+            # Send chat message to the other user via websocket
+            receiver = MessagesService.get_receiver(request.user, conversation)
+            await ChatConsumer.asendChatMessage(receiver.id, data)
+            await ChatConsumer.asendInboxUpdates(
+                await sync_to_async(InboxService.get_updates)([conversation.id])
+            )
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    async def patch(self, request, pk=None):
+        conversation = await aget_object_or_404(
+            Conversations.objects.select_related("user1", "user2"), pk=pk
+        )
+        self.check_object_permissions(request, conversation)
+        action = request.data.get("action")
+        user = request.user
+
+        if action == "clear_chat":
+            await sync_to_async(MessagesService.hide_messages_for_user)(
+                user, conversation
+            )
+            await ChatConsumer.asendInboxUpdates(
+                await sync_to_async(InboxService.get_updates)(
+                    [conversation.id], owner=user
+                )
+            )
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         elif action == "read_messages":
-            MessagesService.mark_messages_as_read(user, conversation)
+            await self.read_messages(user, conversation)
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         return Response(
             {"detail": "Invalid action."}, status=status.HTTP_400_BAD_REQUEST
         )
+
+    async def read_messages(self, user, conversation):
+        if await sync_to_async(MessagesService.mark_messages_as_read)(
+            user, conversation
+        ):
+            await ChatConsumer.asendInboxUpdates(
+                await sync_to_async(InboxService.get_updates)(
+                    [conversation.id], owner=user
+                )
+            )
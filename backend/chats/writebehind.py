@@ -0,0 +1,425 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q, F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from chat_app.db import database_to_async
+from channels.layers import get_channel_layer
+from asgiref.sync import sync_to_async
+from .models import Conversations, Messages, InboxEntries
+from .serializers import MessagesSerializer
+from .services import InboxService
+from notifications.topics import INBOX, user_group
+from .cache import MessagesIdempotencyCache, PendingMessagesCache
+from pathlib import Path
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class MessagesJournal:
+    """
+    Append-only journal of messages acknowledged but not yet written to the
+    database.
+
+    Each process writes numbered segment files and holds an exclusive lock on
+    its own lock file. Segments are deleted once their messages are written,
+    so segments left behind by a process that no longer holds its lock
+    belong to a crashed process and are replayed.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self.lock_file = open(self.directory / f"{self.owner}.lock", "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.segment = 0
+        self.file = self.open_segment()
+
+    def segment_path(self, segment):
+        return self.directory / f"{self.owner}.{segment}.journal"
+
+    def open_segment(self):
+        return open(self.segment_path(self.segment), "a")
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        if settings.MESSAGES_WRITE_BEHIND_FSYNC:
+            os.fsync(self.file.fileno())
+
+    def rotate(self):
+        """Start a new segment and return the path of the closed one"""
+        self.file.close()
+        path = self.segment_path(self.segment)
+        self.segment += 1
+        self.file = self.open_segment()
+        return path
+
+    def close(self):
+        self.file.close()
+        self.segment_path(self.segment).unlink(missing_ok=True)
+        (self.directory / f"{self.owner}.lock").unlink(missing_ok=True)
+        self.lock_file.close()
+
+    @staticmethod
+    def recover(directory):
+        """
+        Yield the entries and segment paths left by crashed processes,
+        one lock file at a time
+        """
+        directory = Path(directory)
+        if not directory.exists():
+            return
+
+        for lock_path in directory.glob("*.lock"):
+            with open(lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # The owner is still running
+                    continue
+
+                owner = lock_path.name[: -len(".lock")]
+                segments = sorted(
+                    directory.glob(f"{owner}.*.journal"),
+                    key=lambda path: int(path.name.split(".")[-2]),
+                )
+                entries = []
+                for segment in segments:
+                    with open(segment) as file:
+                        for line in file:
+                            # A torn last line was never acknowledged
+                            try:
+                                entries.append(json.loads(line))
+                            except json.JSONDecodeError:
+                                break
+
+                yield entries, segments + [lock_path]
+
+    @staticmethod
+    def dead_letter(directory, entries):
+        """Keep the entries of messages that can't be written for inspection"""
+        with open(Path(directory) / "dead_letters.jsonl", "a") as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+
+
+class MessagesWriteBehind:
+    """
+    Write-behind buffer for messages sent over the WebSocket.
+
+    A message takes its id from the messages id sequence and its sequence
+    number from its conversation when it is sent, in one statement, so both
+    follow the send order of the messages written directly. Blocks of ids
+    reserved ahead by each process would break that order, so every message
+    still costs one round trip before it is acknowledged. It is appended to
+    the journal, and then acknowledged and fanned out right away. Pending
+    messages are written with one bulk insert every
+    MESSAGES_WRITE_BEHIND_INTERVAL_MS milliseconds or once
+    MESSAGES_WRITE_BEHIND_BATCH_SIZE messages are pending.
+
+    A batch rejected by the database, like one with a message of a
+    conversation or a sender deleted meanwhile, is written message by
+    message, and the messages that still fail are dead-lettered. Other
+    failures are retried with backoff up to MESSAGES_WRITE_BEHIND_MAX_RETRIES
+    times before doing the same.
+    """
+
+    def __init__(self, journal_dir=None):
+        self.journal = MessagesJournal(
+            journal_dir or settings.MESSAGES_WRITE_BEHIND_JOURNAL_DIR
+        )
+        self.lock = threading.Lock()
+        self.pending = []
+        self.segments = []
+        self.failures = 0
+        self.flush_requested = asyncio.Event()
+        self.task = None
+
+    @staticmethod
+    def reserve(conversation_id):
+        """Take the id and the sequence number of a message being sent"""
+        if connection.vendor != "postgresql":
+            raise ImproperlyConfigured("Write-behind messages require PostgreSQL.")
+
+        # Counted before the id is taken, see MessagesService.get_page
+        PendingMessagesCache.add(conversation_id)
+
+        # One round trip, the row lock is only held for the statement
+        table = connection.ops.quote_name(Conversations._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET "lastSeq" = "lastSeq" + 1 WHERE "id" = %s '
+                "RETURNING nextval(pg_get_serial_sequence(%s, 'id')), \"lastSeq\"",
+                [conversation_id, Messages._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise Conversations.DoesNotExist()
+        return row[0], row[1]
+
+    @staticmethod
+    def to_entry(message):
+        return {
+            "id": message.id,
+            "conversation": message.conversation_id,
+            "sender": message.sender_id,
+            "content": message.content,
+            "client_message_id": message.client_message_id,
+            "seq": message.seq,
+            "created_at": message.created_at.isoformat(),
+        }
+
+    @staticmethod
+    def from_entry(entry):
+        return Messages(
+            id=entry["id"],
+            conversation_id=entry["conversation"],
+            sender_id=entry["sender"],
+            content=entry["content"],
+            client_message_id=entry["client_message_id"],
+            # Entries journaled before sequence numbers were taken on send
+            seq=entry.get("seq"),
+            created_at=parse_datetime(entry["created_at"]),
+        )
+
+    async def enqueue(self, user, conversation, content, client_message_id=None):
+        """Journal a validated message and return its serialized data"""
+        message_id, seq = await database_to_async(self.reserve)(conversation.id)
+        message = Messages(
+            id=message_id,
+            conversation=conversation,
+            sender=user,
+            content=content,
+            client_message_id=client_message_id,
+            seq=seq,
+            created_at=timezone.now(),
+        )
+        pending = await asyncio.get_running_loop().run_in_executor(
+            None, self.append, self.to_entry(message), message
+        )
+        if pending >= settings.MESSAGES_WRITE_BEHIND_BATCH_SIZE:
+            self.flush_requested.set()
+
+        data = MessagesSerializer(message).data
+        if client_message_id:
+            await sync_to_async(MessagesIdempotencyCache.set)(
+                user, client_message_id, data
+            )
+
+        return data
+
+    def append(self, entry, message):
+        # The journal segment and the pending list are switched together on flush
+        with self.lock:
+            self.journal.append(entry)
+            self.pending.append(message)
+            return len(self.pending)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        await database_to_async(self.recover)()
+
+        interval = settings.MESSAGES_WRITE_BEHIND_INTERVAL_MS / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                # The messages stay journaled and pending for the next flush
+                logger.exception("Failed to write pending messages")
+                await asyncio.sleep(min(interval * 2**self.failures, 5))
+
+    async def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            messages, self.pending = self.pending, []
+            self.segments.append(self.journal.rotate())
+            segments = list(self.segments)
+
+        batch = messages
+        try:
+            await database_to_async(self.write)(messages)
+        except (IntegrityError, Conversations.DoesNotExist):
+            logger.exception("Writing pending messages one by one")
+            messages = await database_to_async(self.write_each)(
+                messages, self.journal.directory
+            )
+        except Exception:
+            self.failures += 1
+            if self.failures < settings.MESSAGES_WRITE_BEHIND_MAX_RETRIES:
+                # Retry with the next batch, the closed segments are kept until then
+                with self.lock:
+                    self.pending = messages + self.pending
+                raise
+            logger.exception(
+                f"Writing pending messages one by one after {self.failures} failures"
+            )
+            messages = await database_to_async(self.write_each)(
+                messages, self.journal.directory
+            )
+        self.failures = 0
+        await sync_to_async(self.remove_pending)(batch)
+
+        for segment in segments:
+            segment.unlink(missing_ok=True)
+            self.segments.remove(segment)
+
+        await self.send_inbox_updates({message.conversation_id for message in messages})
+
+    async def send_inbox_updates(self, conversation_ids):
+        """Send the inbox diffs of the written conversations to their owners"""
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+
+        updates = await database_to_async(InboxService.get_updates)(conversation_ids)
+        for owner_id, update in updates:
+            await channel_layer.group_send(
+                user_group(owner_id),
+                {"type": "chat.message", "topic": INBOX, "message": update},
+            )
+
+    @staticmethod
+    def remove_pending(messages):
+        """Lower the pending counts of the written or dead-lettered messages"""
+        counts = {}
+        for message in messages:
+            counts[message.conversation_id] = counts.get(message.conversation_id, 0) + 1
+        for conversation_id, count in counts.items():
+            PendingMessagesCache.remove(conversation_id, count)
+
+    @staticmethod
+    def write(messages):
+        """Write a batch of messages, skipping the ones already written"""
+        ids = [message.id for message in messages]
+        written_ids = set(
+            Messages.objects.filter(id__in=ids).values_list("id", flat=True)
+        )
+        keys = [
+            message.client_message_id
+            for message in messages
+            if message.client_message_id
+        ]
+        written_keys = set(
+            Messages.objects.filter(client_message_id__in=keys).values_list(
+                "sender_id", "client_message_id"
+            )
+        )
+
+        batch = []
+        for message in messages:
+            key = (message.sender_id, message.client_message_id)
+            if message.id in written_ids or key in written_keys:
+                continue
+            if message.client_message_id:
+                written_keys.add(key)
+            batch.append(message)
+
+        conversations = {}
+        for message in batch:
+            conversations.setdefault(message.conversation_id, []).append(message)
+
+        with transaction.atomic():
+            for conversation_id, conversation_messages in conversations.items():
+                unsequenced = [
+                    message for message in conversation_messages if message.seq is None
+                ]
+                if not unsequenced:
+                    continue
+                last_seq = Conversations.reserve_seq(conversation_id, len(unsequenced))
+                first_seq = last_seq - len(unsequenced) + 1
+                for offset, message in enumerate(unsequenced):
+                    message.seq = first_seq + offset
+
+            Messages.objects.bulk_create(batch)
+
+            now = timezone.now()
+            for conversation_id, conversation_messages in conversations.items():
+                last_message_id = conversation_messages[-1].id
+                # Don't move back a last message sent through the REST path
+                if Conversations.objects.filter(
+                    Q(lastMessage__isnull=True) | Q(lastMessage_id__lt=last_message_id),
+                    pk=conversation_id,
+                ).update(lastMessage_id=last_message_id, lastMessageTimestamp=now):
+                    InboxEntries.objects.filter(conversation_id=conversation_id).update(
+                        last_activity=now
+                    )
+
+                senders = {}
+                for message in conversation_messages:
+                    senders[message.sender_id] = senders.get(message.sender_id, 0) + 1
+                for sender_id, count in senders.items():
+                    InboxEntries.objects.filter(
+                        conversation_id=conversation_id
+                    ).exclude(owner_id=sender_id).update(unread=F("unread") + count)
+
+        return len(batch)
+
+    @staticmethod
+    def write_each(messages, journal_dir):
+        """
+        Write the messages one by one, dead-lettering the ones that fail, and
+        return the written ones
+        """
+        written = []
+        failed = []
+        for message in messages:
+            try:
+                MessagesWriteBehind.write([message])
+                written.append(message)
+            except Exception:
+                logger.exception(f"Dead-lettering message {message.id}")
+                failed.append(MessagesWriteBehind.to_entry(message))
+
+        if failed:
+            MessagesJournal.dead_letter(journal_dir, failed)
+        return written
+
+    @staticmethod
+    def recover(journal_dir=None):
+        """Write the messages journaled by crashed processes"""
+        journal_dir = journal_dir or settings.MESSAGES_WRITE_BEHIND_JOURNAL_DIR
+
+        for entries, paths in MessagesJournal.recover(journal_dir):
+            messages = [MessagesWriteBehind.from_entry(entry) for entry in entries]
+            try:
+                count = MessagesWriteBehind.write(messages)
+            except (IntegrityError, Conversations.DoesNotExist):
+                count = len(MessagesWriteBehind.write_each(messages, journal_dir))
+            for path in paths:
+                path.unlink(missing_ok=True)
+            logger.info(f"Recovered {count} journaled messages")
+
+
+_write_behind = None
+
+
+def get_write_behind():
+    """Get the write-behind buffer of this process, starting it on first use"""
+    global _write_behind
+
+    if _write_behind is None:
+        _write_behind = MessagesWriteBehind()
+        _write_behind.start()
+    return _write_behind
@@ -0,0 +1,153 @@
+"""
+Run a pool of Daphne workers sharing one listening socket.
+
+The socket is bound once and passed to every worker with --fd, so the
+kernel spreads the incoming connections across the workers. SIGHUP
+restarts the workers one at a time, starting each replacement before
+stopping the worker it replaces, so the pool keeps accepting connections.
+SIGTERM and SIGINT stop the workers. A worker that exits on its own is
+replaced.
+
+A worker is stopped by sending it SIGUSR1 to drain its connections over
+WEBSOCKET_DRAIN_WINDOW seconds (see notifications.drain), then SIGTERM.
+While draining it stops accepting connections, so the other workers get
+them.
+It is killed if it hasn't exited after WEBSOCKET_DRAIN_TIMEOUT seconds
+more.
+
+Environment:
+    WEBSOCKET_HOST, WEBSOCKET_PORT: address to listen on
+    WEBSOCKET_WORKERS: number of workers, the CPU count by default
+    WEBSOCKET_DRAIN_WINDOW: seconds given to a worker to drain
+    WEBSOCKET_DRAIN_TIMEOUT: seconds given to a worker to stop
+    WEBSOCKET_ACCESS_LOG: access log file shared by the workers
+    WEBSOCKET_VERBOSITY: Daphne verbosity
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+HOST = os.environ.get("WEBSOCKET_HOST", "0.0.0.0")
+PORT = int(os.environ.get("WEBSOCKET_PORT", "8001"))
+WORKERS = int(os.environ.get("WEBSOCKET_WORKERS") or os.cpu_count() or 1)
+DRAIN_WINDOW = float(os.environ.get("WEBSOCKET_DRAIN_WINDOW", "20"))
+DRAIN_TIMEOUT = float(os.environ.get("WEBSOCKET_DRAIN_TIMEOUT", "10"))
+ACCESS_LOG = os.environ.get("WEBSOCKET_ACCESS_LOG")
+VERBOSITY = os.environ.get("WEBSOCKET_VERBOSITY", "1")
+APPLICATION = "chat_app.asgi:application"
+
+
+class WorkerPool:
+    def __init__(self, listener, size):
+        self.listener = listener
+        self.size = size
+        self.workers = []
+        self.stopping = False
+        self.restarting = False
+
+    def spawn(self):
+        command = [
+            sys.executable,
+            "-m",
+            "daphne",
+            "--fd",
+            str(self.listener.fileno()),
+            "-v",
+            VERBOSITY,
+        ]
+        if ACCESS_LOG:
+            command += ["--access-log", ACCESS_LOG]
+        worker = subprocess.Popen(
+            command + [APPLICATION], pass_fds=[self.listener.fileno()]
+        )
+        self.workers.append(worker)
+        log(f"Started worker {worker.pid}")
+        return worker
+
+    def stop(self, workers):
+        """Drain and stop the workers, killing the ones still running after the timeout"""
+        # A worker that never had a connection has no handler and exits
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGUSR1)
+
+        deadline = time.monotonic() + DRAIN_WINDOW
+        while time.monotonic() < deadline and any(
+            worker.poll() is None for worker in workers
+        ):
+            time.sleep(0.5)
+
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for worker in workers:
+            try:
+                worker.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                log(f"Killing worker {worker.pid}")
+                worker.kill()
+                worker.wait()
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def restart(self):
+        """Replace the workers one at a time"""
+        for worker in list(self.workers):
+            if self.stopping:
+                return
+            self.spawn()
+            self.stop([worker])
+
+    def reap(self):
+        """Replace the workers that exited on their own"""
+        for worker in list(self.workers):
+            if worker.poll() is not None:
+                log(f"Worker {worker.pid} exited with code {worker.returncode}")
+                self.workers.remove(worker)
+                self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+
+        for _ in range(self.size):
+            self.spawn()
+
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                log("Restarting workers")
+                self.restart()
+            self.reap()
+            time.sleep(0.5)
+
+        log("Stopping workers")
+        self.stop(list(self.workers))
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_restart(self, signum, frame):
+        self.restarting = True
+
+
+def log(message):
+    print(f"[daphne_workers] {message}", file=sys.stderr, flush=True)
+
+
+def main():
+    listener = socket.create_server((HOST, PORT), backlog=2048)
+    listener.set_inheritable(True)
+    log(f"Listening on {HOST}:{PORT} with {WORKERS} workers")
+    WorkerPool(listener, WORKERS).run()
+
+
+if __name__ == "__main__":
+    main()
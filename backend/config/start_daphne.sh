@@ -10,10 +10,8 @@ while ! nc -z redis 6379; do
   sleep 0.1
 done
 
-echo "Starting Daphne..."
-exec daphne chat_app.asgi:application \
-    -b 0.0.0.0 \
-    -p 8001 \
-    --access-log /var/log/daphne/access.log \
-    -v 2 \
-    2>&1 | tee -a /var/log/daphne/daphne.log
+# Send SIGHUP to the launcher to restart the workers one at a time
+echo "Starting Daphne workers..."
+export WEBSOCKET_PORT=8001
+export WEBSOCKET_ACCESS_LOG=/var/log/daphne/access.log
+exec python config/daphne_workers.py >> /var/log/daphne/daphne.log 2>&1
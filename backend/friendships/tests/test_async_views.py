@@ -0,0 +1,34 @@
+from django.test import override_settings
+from django.urls import include, path
+from friendships.views import AsyncFriendshipsView
+from friendships.tests import test_views
+
+urlpatterns = [
+    path("api/", include("users.urls")),
+    path("api/friendships/", AsyncFriendshipsView.as_view()),
+    path("api/friendships/<int:pk>/", AsyncFriendshipsView.as_view()),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncCreateFriendshipsViewTests(test_views.CreateFriendshipsViewTests):
+    """Runs the friendship creation tests against AsyncFriendshipsView."""
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncListRetrieveFriendshipsViewTests(
+    test_views.ListRetrieveFriendshipsViewTests
+):
+    """Runs the friendship list and retrieve tests against AsyncFriendshipsView."""
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncAcceptRejectFriendshipsViewTests(
+    test_views.AcceptRejectFriendshipsViewTests
+):
+    """Runs the friendship accept and reject tests against AsyncFriendshipsView."""
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncDeleteFriendshipsViewTests(test_views.DeleteFriendshipsViewTests):
+    """Runs the friendship deletion tests against AsyncFriendshipsView."""
@@ -1,5 +1,9 @@
+from django.conf import settings
 from django.urls import path
-from .views import FriendshipsView
+from .views import FriendshipsView, AsyncFriendshipsView
+
+if settings.ASYNC_VIEWS:
+    FriendshipsView = AsyncFriendshipsView
 
 urlpatterns = [
     path(
@@ -2,13 +2,15 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .serializers import FriendshipsSerializer
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, aget_object_or_404
 from .models import Friendships
 from django.db.models import Q
 from django.http import Http404
 from rest_framework.permissions import IsAuthenticated
 from .permissions import IsFriendshipParticipant
 from notifications.consumers import NotificationConsumer
+from chat_app.views import AsyncAPIView
+from asgiref.sync import sync_to_async
 import logging
 
 logger = logging.getLogger(__name__)
@@ -117,3 +119,96 @@ class FriendshipsView(APIView):
 
         friendship.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AsyncFriendshipsView(AsyncAPIView):
+    """
+    Async version of FriendshipsView, routed instead of it when ASYNC_VIEWS
+    is set and the API is served by the ASGI application.
+    """
+
+    permission_classes = [IsAuthenticated, IsFriendshipParticipant]
+
+    async def get_friendship(self, request, pk):
+        friendship = await aget_object_or_404(
+            Friendships.objects.select_related("user1", "user2"), pk=pk
+        )
+        self.check_object_permissions(request, friendship)
+        return friendship
+
+    async def get(self, request, pk=None):
+        if pk:
+            friendship = await self.get_friendship(request, pk)
+            serializer = FriendshipsSerializer(friendship, context={"request": request})
+            return Response(await self.get_data(serializer))
+        friendships = Friendships.objects.filter(
+            Q(user1=request.user) | Q(user2=request.user)
+        )
+        serializer = FriendshipsSerializer(
+            friendships, context={"request": request}, many=True
+        )
+        return Response(await self.get_data(serializer))
+
+    async def post(self, request):
+        serializer = FriendshipsSerializer(
+            data=request.data, context={"request": request}
+        )
+
+        if await sync_to_async(serializer.is_valid)():
+            user = request.user
+            friendship = await sync_to_async(serializer.save)()
+            # Get receiver ID to send a friend request notification
+            receiver_id = (
+                friendship.user1_id
+                if friendship.user1_id != user.id
+                else friendship.user2_id
+            )
+            await NotificationConsumer.asendFriendRequest(receiver_id)
+            return Response(
+                await self.get_data(serializer), status=status.HTTP_201_CREATED
+            )
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    async def patch(self, request, pk=None):
+        user = request.user
+        friendship = await self.get_friendship(request, pk)
+
+        if friendship.user1 == user:
+            return Response(
+                {"detail": "You do not have permission to perform this action."},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        if friendship.status != Friendships.PENDING:
+            return Response(
+                {"detail": "The friendship has already been accepted."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        action = request.data.get("action")
+        if action == "accept":
+            friendship.status = Friendships.ACCEPTED
+            await friendship.asave()
+            return Response({"detail": "Friendship accepted"})
+        elif action == "reject":
+            await friendship.adelete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(
+            {"detail": "Invalid action"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    async def delete(self, request, pk=None):
+        friendship = await self.get_friendship(request, pk)
+
+        action = request.data.get("action")
+
+        if action == "cancel_pending":
+            if friendship.status == Friendships.PENDING:
+                await friendship.adelete()
+                return Response(status=status.HTTP_204_NO_CONTENT)
+            return Response(
+                {"detail": "The friendship has already been accepted."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        await friendship.adelete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
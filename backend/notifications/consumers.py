@@ -1,15 +1,77 @@
 # chat/consumers.py
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from chat_app.db import database_to_async
 from friendships.models import Friendships
 from django.db.models import Q
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from rest_framework.serializers import ValidationError
+from chats.models import Conversations
+from chats.services import MessagesService, InboxService
+from chats.writebehind import get_write_behind
+from urllib.parse import parse_qs
+from .stats import ConsumerStats
+from . import drain, wire, topics
+from .topics import user_group
+from collections import deque
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class BaseConsumer(AsyncWebsocketConsumer):
-    """Base consumer for handling common functionalities for chat and notification consumers"""
+    """
+    Base consumer for handling common functionalities for chat and notification consumers.
+
+    Clients connecting with `?batch=1` receive the events of every
+    WEBSOCKET_BATCH_WINDOW_MS window as one JSON array frame, where repeated
+    status updates of the same friend collapse to the latest one.
+
+    Clients negotiating the `chat.msgpack.v1` subprotocol exchange binary
+    MessagePack frames instead of JSON text, see notifications.wire.
+
+    Outbound events wait in a queue of WEBSOCKET_OUTBOUND_QUEUE_SIZE frames
+    written by a separate task. When a burst of events fills it faster than
+    the task writes, the oldest status updates are dropped, messages never
+    are: a client that can't take any more messages is sent a resume hint
+    with the last seq it got in each conversation and disconnected with code
+    4008. Control frames like `ping` don't count against the queue size, so
+    they never drop events or disconnect the client. Daphne buffers the
+    frames written to a socket without waiting on the client, so the queue
+    bounds the frames held by the consumer, not the socket buffer.
+
+    Clients connecting with `?heartbeat=1` are sent a `ping` frame every
+    WEBSOCKET_HEARTBEAT_INTERVAL seconds, answered with a `pong`. Such a
+    connection that sends no frame for WEBSOCKET_HEARTBEAT_TIMEOUT seconds
+    is reaped: it leaves its group and is closed with code 4000. Other
+    clients, like the app versions that don't answer pings, are only
+    checked by the WebSocket pings of Daphne.
+
+    A connection joins the one group of its user, and events sent to it
+    carry their topic (see notifications.topics). Only the events of the
+    subscribed topics are sent to the client: the default topics of the
+    route unless it connects with `?topics=messages,presence` or changes
+    them with `subscribe` and `unsubscribe` frames.
+
+    When the process drains before stopping, it stops listening so new
+    connections go to the other workers, and the ones it still gets are
+    refused with code 4013. Each client is closed with code 4012 at a time
+    spread over WEBSOCKET_DRAIN_WINDOW seconds, so clients reconnect
+    gradually instead of all at once. It is first sent a `reconnect` frame
+    with the milliseconds after which it can reconnect, past the end of the
+    drain window of this process and in the same spread order.
+    """
+
+    # Topics of the connections that don't choose them, set per route
+    default_topics = topics.TOPICS
+
+    def __init__(self, *args, default_topics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if default_topics is not None:
+            self.default_topics = default_topics
 
     async def connect(self):
         self.user = self.scope.get("user", None)
@@ -18,35 +80,251 @@ class BaseConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)
             return
 
-        self.group_room_name = f"chat_{self.user.id}"
+        if drain.is_draining():
+            await self.close(code=4013)
+            return
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.batching = (
+            query.get("batch") == ["1"] and settings.WEBSOCKET_BATCH_WINDOW_MS > 0
+        )
+        self.heartbeating = (
+            query.get("heartbeat") == ["1"]
+            and settings.WEBSOCKET_HEARTBEAT_INTERVAL > 0
+        )
+        self.outbox = {}
+        self.outbox_count = 0
+        self.flush_task = None
+        self.setup_outbound()
+
+        # Join the group of the user, filtered by the subscribed topics
+        self.topics = set()
+        if "topics" in query:
+            self.subscribe(query["topics"][0].split(","))
+        else:
+            self.subscribe(self.default_topics)
+        await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+        self.joined = True
+
+        self.live = True
+        await ConsumerStats.connected()
 
-        # Join room group
-        await self.channel_layer.group_add(self.group_room_name, self.channel_name)
+        if wire.MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            self.msgpack = True
+            await self.accept(subprotocol=wire.MSGPACK_SUBPROTOCOL)
+        else:
+            self.msgpack = False
+            await self.accept()
 
-        await self.accept()
+        self.writer_task = asyncio.create_task(self.write_outbound())
+        drain.register(self)
+
+        self.last_seen = asyncio.get_running_loop().time()
+        if self.heartbeating:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    def setup_outbound(self):
+        self.outbound = deque()
+        self.outbound_ready = asyncio.Event()
+        self.writer_task = None
+        self.delivered_seqs = {}
+        self.heartbeat_task = None
+        self.drain_task = None
+        self.live = False
+        self.counters = {
+            "queued": 0,
+            "dropped": 0,
+            "slow_disconnects": 0,
+            "reaped": 0,
+        }
 
     async def disconnect(self, code):
-        # Check if group_room_name exists before trying to use it
-        if hasattr(self, "group_room_name"):
-            # Leave room group
+        if getattr(self, "flush_task", None):
+            self.flush_task.cancel()
+        if getattr(self, "writer_task", None):
+            self.writer_task.cancel()
+        if getattr(self, "heartbeat_task", None):
+            self.heartbeat_task.cancel()
+        if getattr(self, "drain_task", None):
+            self.drain_task.cancel()
+        drain.unregister(self)
+        if hasattr(self, "counters"):
+            await ConsumerStats.add(self.counters)
+        if getattr(self, "live", False):
+            self.live = False
+            await ConsumerStats.disconnected()
+
+        await self.leave()
+        return await super().disconnect(code)
+
+    async def leave(self):
+        """Leave the group of the user"""
+        if getattr(self, "joined", False):
+            self.joined = False
             await self.channel_layer.group_discard(
-                self.group_room_name, self.channel_name
+                user_group(self.user.id), self.channel_name
             )
-        return await super().disconnect(code)
 
-    async def receive(self, text_data):
-        return await super().receive(text_data)
+    def subscribe(self, names):
+        """Send the events of the topics, unknown topics are ignored"""
+        self.topics |= set(names) & set(topics.TOPICS)
+
+    def unsubscribe(self, names):
+        self.topics -= set(names)
+
+    async def websocket_receive(self, message):
+        self.last_seen = asyncio.get_running_loop().time()
+        await super().websocket_receive(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        return await super().receive(text_data, bytes_data)
+
+    async def heartbeat(self):
+        """Ping the client and reap the connection once it stops answering"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(settings.WEBSOCKET_HEARTBEAT_INTERVAL)
+
+            if loop.time() - self.last_seen > settings.WEBSOCKET_HEARTBEAT_TIMEOUT:
+                await self.reap()
+                return
+            await self.queue_event({"type": "ping"})
+
+    async def reap(self):
+        """Remove a dead connection from its groups and close it"""
+        self.counters["reaped"] += 1
+        await self.leave()
+        await self.close(code=4000)
+
+    def start_drain(self, delay):
+        self.drain_task = asyncio.create_task(self.drain(delay))
+
+    async def drain(self, delay):
+        """Tell the client when to reconnect, and close it after the delay"""
+        after = settings.WEBSOCKET_DRAIN_WINDOW + delay
+        await self.queue_event({"type": "reconnect", "after": int(after * 1000)})
+        await asyncio.sleep(delay)
+        await self.close(code=4012)
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Decode an inbound frame in the wire format of the connection"""
+        if bytes_data is not None:
+            return wire.decode(bytes_data)
+        return json.loads(text_data)
+
+    async def send_event(self, event):
+        """Send an event in the wire format of the connection"""
+        if self.msgpack:
+            await self.send(bytes_data=wire.encode(event))
+        else:
+            await self.send(text_data=json.dumps(event))
+
+    # Frames sent by the server itself rather than events for the client
+    CONTROL_FRAMES = ("ping", "reconnect", "topics")
+
+    @classmethod
+    def is_control(cls, event):
+        return isinstance(event, dict) and event.get("type") in cls.CONTROL_FRAMES
+
+    @staticmethod
+    def is_droppable(event):
+        """Only frames made of status updates can be dropped"""
+        events = event if isinstance(event, list) else [event]
+        return all(item.get("type") == "status_update" for item in events)
+
+    async def queue_event(self, event):
+        """Queue an outbound frame, making room or disconnecting when the queue is full"""
+        if self.counters["slow_disconnects"]:
+            # Closing, the client resumes from the hint it was sent
+            return
+
+        queued = sum(1 for item in self.outbound if not self.is_control(item))
+        if (
+            not self.is_control(event)
+            and queued >= settings.WEBSOCKET_OUTBOUND_QUEUE_SIZE
+        ):
+            droppable = next(
+                (item for item in self.outbound if self.is_droppable(item)), None
+            )
+            if droppable is not None:
+                self.outbound.remove(droppable)
+                self.counters["dropped"] += 1
+            elif self.is_droppable(event):
+                self.counters["dropped"] += 1
+                return
+            else:
+                await self.disconnect_slow_client()
+                return
+
+        self.outbound.append(event)
+        self.counters["queued"] += 1
+        self.outbound_ready.set()
+
+    async def write_outbound(self):
+        """Write the queued frames to the client in order"""
+        while True:
+            await self.outbound_ready.wait()
+            while self.outbound:
+                event = self.outbound.popleft()
+                await self.send_event(event)
+                self.track_delivered(event)
+            self.outbound_ready.clear()
+
+    def track_delivered(self, event):
+        for item in event if isinstance(event, list) else [event]:
+            message = item.get("data")
+            if isinstance(message, dict) and message.get("seq") is not None:
+                self.delivered_seqs[message["conversation"]] = message["seq"]
+
+    async def disconnect_slow_client(self):
+        """Disconnect a client too far behind with the point to resume from"""
+        self.counters["slow_disconnects"] += 1
+        logger.warning(
+            f"Disconnecting {self.user} with {len(self.outbound)} queued frames"
+        )
+
+        self.outbound.clear()
+        if self.writer_task:
+            self.writer_task.cancel()
+        await self.send_event({"type": "resume", "conversations": self.delivered_seqs})
+        await self.close(code=4008)
 
     async def chat_message(self, event):
+        topic = event.get("topic")
+        if topic is not None and topic not in self.topics:
+            return
         message = event["message"]
 
-        await self.send(text_data=json.dumps(message))
+        if not self.batching:
+            await self.queue_event(message)
+            return
+
+        if message.get("type") == "status_update":
+            # Move the latest status of the friend to the end of the batch
+            key = f"status_update:{message.get('username')}"
+            self.outbox.pop(key, None)
+        else:
+            key = self.outbox_count
+        self.outbox_count += 1
+        self.outbox[key] = message
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_outbox())
+
+    async def flush_outbox(self):
+        """Send the events gathered during the batch window as one frame"""
+        await asyncio.sleep(settings.WEBSOCKET_BATCH_WINDOW_MS / 1000)
+
+        messages = list(self.outbox.values())
+        self.outbox = {}
+        self.flush_task = None
+        await self.queue_event(messages)
 
 
 class ChatConsumer(BaseConsumer):
     """Consumer for handling user's online status and chat notifications"""
 
-    @database_sync_to_async
+    @database_to_async
     def get_friend_notifications(self, status):
         # Query user's friends
         friendships = Friendships.objects.filter(
@@ -58,10 +336,10 @@ class ChatConsumer(BaseConsumer):
 
         for friend in friendships:
             friend_room_name = ""
-            if friend.user1 == self.user:
-                friend_room_name = f"chat_{friend.user2.id}"
+            if friend.user1_id == self.user.id:
+                friend_room_name = user_group(friend.user2_id)
             else:
-                friend_room_name = f"chat_{friend.user1.id}"
+                friend_room_name = user_group(friend.user1_id)
             notifications.append(
                 {
                     "room_name": friend_room_name,
@@ -75,16 +353,164 @@ class ChatConsumer(BaseConsumer):
 
         return notifications
 
-    @database_sync_to_async
+    @database_to_async
     def save_user_status(self, status):
         self.user.IsOnline = True if status == "Online" else False
         self.user.save()
 
-    async def receive(self, text_data):
+    @database_to_async
+    def get_conversation(self, conversation_id):
+        return (
+            Conversations.objects.filter(Q(user1=self.user) | Q(user2=self.user))
+            .select_related("user1", "user2")
+            .filter(pk=conversation_id)
+            .first()
+        )
+
+    @database_to_async
+    def create_message(self, conversation, content, client_message_id):
+        return MessagesService.send_message(
+            self.user, conversation, {"content": content}, client_message_id
+        )
+
+    @database_to_async
+    def prepare_message(self, conversation, content, client_message_id):
+        return MessagesService.prepare_message(
+            self.user, conversation, {"content": content}, client_message_id
+        )
+
+    @database_to_async
+    def get_inbox_updates(self, conversation):
+        return InboxService.get_updates([conversation.id])
+
+    async def send_chat_message(self, data):
         """
-        Receive message from WebSocket to update user's online status and send notifications to user's friends
+        Store a chat message sent over the WebSocket, or write it behind when
+        enabled, then acknowledge it to the sender and send it to the receiver
         """
-        text_data_json = json.loads(text_data)
+        client_message_id = data.get("client_message_id")
+        errors = None
+
+        try:
+            if not isinstance(data.get("conversation"), int):
+                raise ValueError("Not found.")
+            conversation = await self.get_conversation(data["conversation"])
+            if conversation is None:
+                raise ValueError("Not found.")
+
+            MessagesService.validate_idempotency_key(client_message_id)
+            if settings.MESSAGES_WRITE_BEHIND:
+                message, content = await self.prepare_message(
+                    conversation, data.get("content"), client_message_id
+                )
+                created = message is None
+                if created:
+                    message = await get_write_behind().enqueue(
+                        self.user, conversation, content, client_message_id
+                    )
+            else:
+                message, created = await self.create_message(
+                    conversation, data.get("content"), client_message_id
+                )
+        except ValidationError as error:
+            errors = error.detail
+        except ValueError as error:
+            errors = {"detail": str(error)}
+
+        if errors is not None:
+            await self.queue_event(
+                {
+                    "type": "message_error",
+                    "client_message_id": client_message_id,
+                    "errors": errors,
+                }
+            )
+            return
+
+        await self.queue_event(
+            {
+                "type": "message_ack",
+                "client_message_id": client_message_id,
+                "data": message,
+            }
+        )
+
+        if created:
+            receiver = MessagesService.get_receiver(self.user, conversation)
+            await self.channel_layer.group_send(
+                user_group(receiver.id),
+                {
+                    "type": "chat.message",
+                    "topic": topics.MESSAGES,
+                    "message": {"data": message},
+                },
+            )
+
+            # Messages written behind update the inboxes once they are written
+            if not settings.MESSAGES_WRITE_BEHIND:
+                for owner_id, update in await self.get_inbox_updates(conversation):
+                    await self.channel_layer.group_send(
+                        user_group(owner_id),
+                        {
+                            "type": "chat.message",
+                            "topic": topics.INBOX,
+                            "message": update,
+                        },
+                    )
+
+    async def send_typing(self, data):
+        """Tell the other participant that the user is typing in the conversation"""
+        if not isinstance(data.get("conversation"), int):
+            return
+        conversation = await self.get_conversation(data["conversation"])
+        if conversation is None or (
+            conversation.IsBlockedByUser1 or conversation.IsBlockedByUser2
+        ):
+            return
+
+        receiver = MessagesService.get_receiver(self.user, conversation)
+        await self.channel_layer.group_send(
+            user_group(receiver.id),
+            {
+                "type": "chat.message",
+                "topic": topics.TYPING,
+                "message": {
+                    "type": "typing",
+                    "conversation": conversation.id,
+                    "username": self.user.username,
+                },
+            },
+        )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Receive message from WebSocket to send a chat message or typing event,
+        change the subscribed topics, or to update user's online status and
+        send notifications to user's friends
+        """
+        text_data_json = self.decode(text_data, bytes_data)
+        message_type = text_data_json.get("type")
+
+        if message_type == "pong":
+            return
+
+        if message_type == "send_message":
+            await self.send_chat_message(text_data_json)
+            return
+
+        if message_type == "typing":
+            await self.send_typing(text_data_json)
+            return
+
+        if message_type in ("subscribe", "unsubscribe"):
+            names = text_data_json.get("topics")
+            if isinstance(names, list):
+                if message_type == "subscribe":
+                    self.subscribe(names)
+                else:
+                    self.unsubscribe(names)
+            await self.queue_event({"type": "topics", "topics": sorted(self.topics)})
+            return
 
         # Retrieve user's online status
         status = text_data_json["status"]
@@ -101,12 +527,13 @@ class ChatConsumer(BaseConsumer):
                 notification["room_name"],
                 {
                     "type": "chat.message",
+                    "topic": topics.PRESENCE,
                     "message": notification["message"],
                 },
             )
 
     @staticmethod
-    def sendChatMessage(receiver_id, message_data):
+    async def asendChatMessage(receiver_id, message_data):
         """Send chat message to the receiver"""
         channel_layer = get_channel_layer()
 
@@ -114,22 +541,46 @@ class ChatConsumer(BaseConsumer):
             print("Channel layer is not available")
             return
 
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{receiver_id}",
+        await channel_layer.group_send(
+            user_group(receiver_id),
             {
                 "type": "chat_message",
+                "topic": topics.MESSAGES,
                 "message": {
                     "data": message_data,
                 },
             },
         )
 
+    @staticmethod
+    def sendChatMessage(receiver_id, message_data):
+        async_to_sync(ChatConsumer.asendChatMessage)(receiver_id, message_data)
+
+    @staticmethod
+    async def asendInboxUpdates(updates):
+        """Send inbox diffs to the owners of the inbox entries"""
+        channel_layer = get_channel_layer()
+
+        if not channel_layer:
+            print("Channel layer is not available")
+            return
+
+        for owner_id, update in updates:
+            await channel_layer.group_send(
+                user_group(owner_id),
+                {"type": "chat_message", "topic": topics.INBOX, "message": update},
+            )
+
+    @staticmethod
+    def sendInboxUpdates(updates):
+        async_to_sync(ChatConsumer.asendInboxUpdates)(updates)
+
 
 class NotificationConsumer(BaseConsumer):
     """Consumer for handling friend requests notifications"""
 
     @staticmethod
-    def sendFriendRequest(receiver_id):
+    async def asendFriendRequest(receiver_id):
         """Send friend request notification to the receiver"""
         channel_layer = get_channel_layer()
 
@@ -137,7 +588,15 @@ class NotificationConsumer(BaseConsumer):
             print("Channel layer is not available")
             return
 
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{receiver_id}",
-            {"type": "chat_message", "message": {"type": "friend_request"}},
+        await channel_layer.group_send(
+            user_group(receiver_id),
+            {
+                "type": "chat_message",
+                "topic": topics.FRIEND_REQUESTS,
+                "message": {"type": "friend_request"},
+            },
         )
+
+    @staticmethod
+    def sendFriendRequest(receiver_id):
+        async_to_sync(NotificationConsumer.asendFriendRequest)(receiver_id)
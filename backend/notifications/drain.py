@@ -0,0 +1,82 @@
+from django.conf import settings
+import asyncio
+import logging
+import random
+import signal
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Sent by config/daphne_workers.py to a worker before stopping it
+DRAIN_SIGNAL = signal.SIGUSR1
+
+_consumers = set()
+_draining = False
+_installed = False
+
+
+def is_draining():
+    return _draining
+
+
+def register(consumer):
+    """Track an accepted connection, to drain it when the process stops"""
+    install()
+    _consumers.add(consumer)
+
+
+def unregister(consumer):
+    _consumers.discard(consumer)
+
+
+def install():
+    """Start draining on DRAIN_SIGNAL, in the event loop of the consumers"""
+    global _installed
+
+    if _installed:
+        return
+    _installed = True
+
+    loop = asyncio.get_running_loop()
+    try:
+        signal.signal(
+            DRAIN_SIGNAL, lambda signum, frame: loop.call_soon_threadsafe(start)
+        )
+    except ValueError:
+        # Signal handlers can only be set from the main thread
+        logger.warning("WebSocket drain signal handler not installed")
+
+
+def start():
+    """
+    Stop accepting connections and close the open ones at random times
+    spread over WEBSOCKET_DRAIN_WINDOW seconds
+    """
+    global _draining
+
+    if _draining:
+        return
+    _draining = True
+
+    stop_listening()
+
+    logger.info(f"Draining {len(_consumers)} WebSocket connections")
+    for consumer in list(_consumers):
+        consumer.start_drain(random.uniform(0, settings.WEBSOCKET_DRAIN_WINDOW))
+
+
+def stop_listening():
+    """
+    Stop accepting connections, the other workers keep accepting them from
+    the shared listening socket
+    """
+    reactor = sys.modules.get("twisted.internet.reactor")
+    if reactor is None:
+        # Not served by Daphne
+        return
+
+    from twisted.internet.tcp import Port
+
+    for reader in reactor.getReaders():
+        if isinstance(reader, Port):
+            reader.stopListening()
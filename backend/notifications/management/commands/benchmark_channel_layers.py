@@ -0,0 +1,168 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils.module_loading import import_string
+from asgiref.sync import async_to_sync
+from notifications.topics import MESSAGES, PRESENCE, user_group
+import asyncio
+import random
+import statistics
+import time
+
+PREFIX = "benchmark_channel_layers"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the chat message or presence fan-out of the channel layer "
+        "modes against the given Redis instances or the database, with the "
+        "latency of deliveries within a process and across processes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hosts",
+            nargs="+",
+            default=settings.REDIS_HOSTS,
+            help="Redis URLs to shard the channel layer across",
+        )
+        parser.add_argument(
+            "--modes",
+            nargs="+",
+            choices=settings.CHANNEL_LAYER_BACKENDS,
+            default=list(settings.CHANNEL_LAYER_BACKENDS),
+            help="Channel layer modes to compare",
+        )
+        parser.add_argument(
+            "--path",
+            choices=["messages", "presence"],
+            default="messages",
+            help="Chat messages to a conversation or status updates to friends",
+        )
+        parser.add_argument("--users", type=int, default=100, help="Number of users")
+        parser.add_argument(
+            "--friends", type=int, default=20, help="Friends notified of a status"
+        )
+        parser.add_argument(
+            "--devices", type=int, default=2, help="Connections per user"
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=4,
+            help="Layer instances the connections are spread across, 1 to "
+            "only measure deliveries within a process",
+        )
+        parser.add_argument(
+            "--messages", type=int, default=2000, help="Number of messages per mode"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="Messages sent at once, keep it below the channel capacity",
+        )
+
+    def handle(self, *args, **options):
+        for mode in options["modes"]:
+            backend = import_string(settings.CHANNEL_LAYER_BACKENDS[mode])
+            config = {"prefix": PREFIX}
+            if mode != "postgres":
+                config["hosts"] = options["hosts"]
+            latencies, expected, elapsed = async_to_sync(self.measure)(
+                backend, config, options
+            )
+            quantiles = statistics.quantiles(
+                [latency for _, latency in latencies], n=100
+            )
+            self.stdout.write(
+                f"{mode}: {len(latencies) / elapsed:.0f} deliveries/s, "
+                f"p50 {quantiles[49] * 1000:.3f}ms, "
+                f"p99 {quantiles[98] * 1000:.3f}ms, "
+                f"lost {expected - len(latencies)}"
+            )
+
+            # The local mode delivers to the channels of the sending process
+            # in memory, without the Redis round trips
+            for name, local in (("same process", True), ("other processes", False)):
+                subset = [latency for same, latency in latencies if same == local]
+                if len(subset) < 2:
+                    continue
+                quantiles = statistics.quantiles(subset, n=100)
+                self.stdout.write(
+                    f"  {name}: p50 {quantiles[49] * 1000:.3f}ms, "
+                    f"p99 {quantiles[98] * 1000:.3f}ms"
+                )
+
+    async def measure(self, backend, config, options):
+        # A layer instance stands for a Daphne process
+        layers = [backend(**config) for _ in range(options["processes"])]
+        latencies = []
+        done = asyncio.Event()
+        recipients = 2 if options["path"] == "messages" else options["friends"]
+        expected = options["messages"] * recipients * options["devices"]
+
+        async def receive(index, channel):
+            while True:
+                message = await layers[index].receive(channel)
+                latencies.append(
+                    (
+                        message["layer"] == index,
+                        time.perf_counter() - message["sent"],
+                    )
+                )
+                if len(latencies) >= expected:
+                    done.set()
+
+        members = []
+        tasks = []
+        for user in range(options["users"]):
+            for device in range(options["devices"]):
+                index = (user * options["devices"] + device) % len(layers)
+                layer = layers[index]
+                channel = await layer.new_channel()
+                group = user_group(user)
+                await layer.group_add(group, channel)
+                members.append((layer, group, channel))
+                tasks.append(asyncio.create_task(receive(index, channel)))
+
+        async def send():
+            # A chat message goes to every connection of its sender and
+            # recipient, a status update to every connection of the friends
+            index = random.randrange(len(layers))
+            layer = layers[index]
+            if options["path"] == "messages":
+                topic = MESSAGES
+                users = random.sample(range(options["users"]), 2)
+            else:
+                topic = PRESENCE
+                users = random.sample(range(options["users"]), options["friends"])
+            message = {
+                "type": "chat.message",
+                "topic": topic,
+                "layer": index,
+                "sent": time.perf_counter(),
+            }
+            for user in users:
+                await layer.group_send(user_group(user), message)
+
+        start = time.perf_counter()
+        try:
+            sent = 0
+            while sent < options["messages"]:
+                burst = min(options["concurrency"], options["messages"] - sent)
+                await asyncio.gather(*(send() for _ in range(burst)))
+                sent += burst
+            try:
+                await asyncio.wait_for(done.wait(), 10)
+            except asyncio.TimeoutError:
+                pass
+            elapsed = time.perf_counter() - start
+        finally:
+            for task in tasks:
+                task.cancel()
+            for layer, group, channel in members:
+                await layer.group_discard(group, channel)
+            for layer in layers:
+                await layer.flush()
+
+        return latencies, expected, elapsed
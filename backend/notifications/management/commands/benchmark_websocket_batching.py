@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from asgiref.sync import async_to_sync
+from notifications.consumers import ChatConsumer
+from notifications.topics import user_group
+import asyncio
+import json
+import time
+import uuid
+
+Users = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Compares WebSocket frames and CPU per delivered event with and without batching"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--events", type=int, default=5000, help="Number of events to send"
+        )
+        parser.add_argument(
+            "--friends",
+            type=int,
+            default=20,
+            help="Number of friends sending status updates",
+        )
+        parser.add_argument(
+            "--burst",
+            type=int,
+            default=50,
+            help="Events sent per millisecond, below the channel capacity",
+        )
+        parser.add_argument(
+            "--window", type=int, default=20, help="Batch window in milliseconds"
+        )
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        user = Users.objects.create_user(
+            username=f"benchmark_{suffix}", email=f"benchmark_{suffix}@example.com"
+        )
+
+        try:
+            with override_settings(WEBSOCKET_BATCH_WINDOW_MS=options["window"]):
+                for name, path in (
+                    ("Unbatched", "/ws/chat/"),
+                    ("Batched", "/ws/chat/?batch=1"),
+                ):
+                    frames, delivered, elapsed, cpu = async_to_sync(self.run)(
+                        user,
+                        path,
+                        options["events"],
+                        options["friends"],
+                        options["burst"],
+                    )
+                    self.stdout.write(
+                        f"{name}: {options['events'] + 1} events sent, "
+                        f"{frames} frames, {delivered} events delivered, "
+                        f"{frames / elapsed:.0f} frames/sec, "
+                        f"{cpu / delivered * 1e6:.1f}us CPU per delivered event"
+                    )
+        finally:
+            user.delete()
+
+    async def run(self, user, path, count, friends, burst):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        await communicator.connect()
+
+        channel_layer = get_channel_layer()
+        group = user_group(user.id)
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        # Status storms from friends mixed with chat messages
+        for index in range(count):
+            if index % 4:
+                message = {
+                    "type": "status_update",
+                    "username": f"friend{index % friends}",
+                    "status": "Online" if index % 2 else "Offline",
+                }
+            else:
+                message = {"data": {"content": f"Message {index}"}}
+            await channel_layer.group_send(
+                group, {"type": "chat.message", "message": message}
+            )
+            if index % burst == burst - 1:
+                await asyncio.sleep(0.001)
+        await channel_layer.group_send(
+            group, {"type": "chat.message", "message": {"type": "benchmark_done"}}
+        )
+
+        frames = 0
+        delivered = 0
+        done = False
+        while not done:
+            frame = json.loads(await communicator.receive_from(timeout=10))
+            events = frame if isinstance(frame, list) else [frame]
+            frames += 1
+            delivered += len(events)
+            done = events[-1].get("type") == "benchmark_done"
+
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        await communicator.disconnect()
+
+        return frames, delivered, elapsed, cpu
@@ -0,0 +1,205 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.tokens import AccessToken
+from asgiref.sync import async_to_sync
+import asyncio
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+Users = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures concurrent sockets and messages per second of the Daphne "
+        "worker pool as workers are added"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4],
+            help="Pool sizes to measure",
+        )
+        parser.add_argument(
+            "--connections",
+            type=int,
+            default=2000,
+            help="Sockets opened against each pool",
+        )
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=20,
+            help="Round trips sent on each socket",
+        )
+        parser.add_argument(
+            "--users", type=int, default=100, help="Users the sockets belong to"
+        )
+        parser.add_argument("--port", type=int, default=18001)
+
+    def handle(self, *args, **options):
+        # Each socket is a file descriptor of this process
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        suffix = uuid.uuid4().hex[:8]
+        users = [
+            Users.objects.create_user(
+                username=f"benchmark_{suffix}_{index}",
+                email=f"benchmark_{suffix}_{index}@example.com",
+            )
+            for index in range(options["users"])
+        ]
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+
+        try:
+            for workers in options["workers"]:
+                pool = self.start_pool(workers, options["port"])
+                try:
+                    connected, delivered, elapsed = async_to_sync(self.measure)(
+                        tokens, options
+                    )
+                finally:
+                    pool.terminate()
+                    pool.wait()
+
+                self.stdout.write(
+                    f"{workers} workers: {connected}/{options['connections']} "
+                    f"sockets, {delivered / elapsed:.0f} messages/s"
+                )
+        finally:
+            Users.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def start_pool(self, workers, port):
+        env = dict(
+            os.environ,
+            WEBSOCKET_HOST="127.0.0.1",
+            WEBSOCKET_PORT=str(port),
+            WEBSOCKET_WORKERS=str(workers),
+            WEBSOCKET_VERBOSITY="0",
+            WEBSOCKET_DRAIN_WINDOW="0",
+        )
+        pool = subprocess.Popen(
+            [sys.executable, str(settings.BASE_DIR / "config" / "daphne_workers.py")],
+            cwd=settings.BASE_DIR,
+            env=env,
+        )
+        # Wait for the workers to load the application
+        async_to_sync(self.wait_for_workers)(port)
+        return pool
+
+    async def wait_for_workers(self, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                await asyncio.wait_for(reader.readline(), 5)
+                writer.close()
+                break
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.5)
+        # A worker answered, give the others time to load the application
+        await asyncio.sleep(2)
+
+    async def measure(self, tokens, options):
+        async def open_socket(index):
+            try:
+                return await connect(
+                    options["port"], "/ws/?topics=messages", tokens[index % len(tokens)]
+                )
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                return None
+
+        sockets = []
+        # Open the sockets in steps, like clients reconnecting after a deploy
+        for start in range(0, options["connections"], 100):
+            stop = min(start + 100, options["connections"])
+            sockets += await asyncio.gather(
+                *(open_socket(index) for index in range(start, stop))
+            )
+        sockets = [socket for socket in sockets if socket is not None]
+
+        async def round_trips(reader, writer):
+            delivered = 0
+            for _ in range(options["messages"]):
+                writer.write(
+                    frame(json.dumps({"type": "subscribe", "topics": ["typing"]}))
+                )
+                while True:
+                    event = json.loads(await read_frame(reader))
+                    if event.get("type") == "topics":
+                        break
+                delivered += 1
+            return delivered
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(round_trips(reader, writer) for reader, writer in sockets),
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - start
+
+        for _, writer in sockets:
+            writer.close()
+
+        delivered = sum(result for result in results if isinstance(result, int))
+        return len(sockets), delivered, elapsed
+
+
+async def connect(port, path, token):
+    """Open a WebSocket and return its stream reader and writer"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(
+        (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            f"Authorization: Bearer {token}\r\n\r\n"
+        ).encode()
+    )
+    response = await reader.readuntil(b"\r\n\r\n")
+    if not response.startswith(b"HTTP/1.1 101"):
+        writer.close()
+        raise ConnectionError(response.split(b"\r\n")[0].decode())
+    return reader, writer
+
+
+def frame(text):
+    """Masked text frame sent by a client"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    if len(payload) < 126:
+        header = bytes([0x81, 0x80 | len(payload)])
+    else:
+        header = bytes([0x81, 0x80 | 126]) + len(payload).to_bytes(2, "big")
+    return (
+        header
+        + mask
+        + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    )
+
+
+async def read_frame(reader):
+    """Read the payload of the next frame sent by the server"""
+    header = await reader.readexactly(2)
+    length = header[1] & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), "big")
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), "big")
+    return await reader.readexactly(length)
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from notifications import wire
+import json
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = "Compares bytes on the wire and serialization CPU of JSON and MessagePack"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--events", type=int, default=20000, help="Number of events to encode"
+        )
+
+    def handle(self, *args, **options):
+        events = self.get_events(options["events"])
+
+        for name, encode in (
+            ("JSON", lambda event: json.dumps(event).encode()),
+            ("MessagePack", wire.encode),
+        ):
+            start = time.process_time()
+            size = sum(len(encode(event)) for event in events)
+            cpu = time.process_time() - start
+
+            self.stdout.write(
+                f"{name}: {size} bytes ({size / len(events):.1f} per event), "
+                f"{cpu / len(events) * 1e6:.2f}us CPU per event"
+            )
+
+    def get_events(self, count):
+        """Representative traffic of chat messages, status and inbox updates"""
+        random.seed(0)
+        words = ["hey", "see", "you", "at", "the", "meeting", "tomorrow", "ok", "👍"]
+        events = []
+        for index in range(count):
+            timestamp = timezone.now().isoformat().replace("+00:00", "Z")
+            kind = index % 10
+            if kind < 6:
+                events.append(
+                    {
+                        "data": {
+                            "id": 100000 + index,
+                            "conversation": random.randint(1, 5000),
+                            "sender": f"user{random.randint(1, 5000)}",
+                            "content": " ".join(
+                                random.choices(words, k=random.randint(1, 12))
+                            ),
+                            "seq": index,
+                            "created_at": timestamp,
+                        }
+                    }
+                )
+            elif kind < 9:
+                events.append(
+                    {
+                        "type": "status_update",
+                        "username": f"user{random.randint(1, 5000)}",
+                        "status": random.choice(["Online", "Offline"]),
+                    }
+                )
+            else:
+                events.append(
+                    {
+                        "type": "inbox_update",
+                        "conversation": random.randint(1, 5000),
+                        "lastMessage": " ".join(random.choices(words, k=4)),
+                        "timestamp": timestamp,
+                        "unread": random.randint(0, 20),
+                        "hidden": False,
+                        "IsBlockedByMe": False,
+                        "IsBlockedByOtherUser": False,
+                    }
+                )
+        return events
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from notifications.stats import ConsumerStats, DatabaseExecutorStats
+
+
+class Command(BaseCommand):
+    help = "Shows the connections and events of the WebSocket consumers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset", action="store_true", help="Reset the counters after showing them"
+        )
+
+    def handle(self, *args, **options):
+        stats = ConsumerStats.stats()
+
+        self.stdout.write(
+            f"Live connections: {stats['live']}, reaped: {stats['reaped']}, "
+            f"slow disconnects: {stats['slow_disconnects']}"
+        )
+        self.stdout.write(f"Queued: {stats['queued']}, dropped: {stats['dropped']}")
+
+        database = DatabaseExecutorStats.stats()
+        self.stdout.write(
+            f"Database calls: {database['calls']}, "
+            f"average wait for a thread: {database['average_wait_ms']:.2f}ms, "
+            f"waits over {DatabaseExecutorStats.SLOW_WAIT * 1000:.0f}ms: "
+            f"{database['slow_waits']}"
+        )
+
+        if options["reset"]:
+            ConsumerStats.reset_stats()
+            DatabaseExecutorStats.reset_stats()
@@ -1,3 +1,8 @@
 from django.db import models
 
-# Create your models here.
+
+class ChannelLayerPayloads(models.Model):
+    """Channel layer messages too large for a Postgres notification"""
+
+    payload = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
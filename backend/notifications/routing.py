@@ -1,9 +1,21 @@
 # chat/routing.py
 from django.urls import re_path
 
-from . import consumers
+from . import consumers, topics
 
 websocket_urlpatterns = [
-    re_path(r"ws/chat/$", consumers.ChatConsumer.as_asgi()),
-    re_path(r"ws/notification/$", consumers.ChatConsumer.as_asgi()),
+    re_path(r"ws/$", consumers.ChatConsumer.as_asgi()),
+    # The older app opens both sockets, each gets only its own events
+    re_path(
+        r"ws/chat/$",
+        consumers.ChatConsumer.as_asgi(
+            default_topics=[
+                topic for topic in topics.TOPICS if topic != topics.FRIEND_REQUESTS
+            ]
+        ),
+    ),
+    re_path(
+        r"ws/notification/$",
+        consumers.ChatConsumer.as_asgi(default_topics=[topics.FRIEND_REQUESTS]),
+    ),
 ]
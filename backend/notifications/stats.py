@@ -0,0 +1,97 @@
+from django.core.cache import cache
+import threading
+import time
+
+
+class ConsumerStats:
+    """
+    Counters of the WebSocket consumers, added to the cache by each consumer
+    when it disconnects, and the gauge of live connections.
+    """
+
+    COUNTERS = ["queued", "dropped", "slow_disconnects", "reaped"]
+
+    @staticmethod
+    def key(counter):
+        return f"notifications:consumers:{counter}"
+
+    @staticmethod
+    async def add(counters):
+        for counter, value in counters.items():
+            if value:
+                await cache.aadd(ConsumerStats.key(counter), 0, None)
+                await cache.aincr(ConsumerStats.key(counter), value)
+
+    @staticmethod
+    async def connected():
+        await cache.aadd(ConsumerStats.key("live"), 0, None)
+        await cache.aincr(ConsumerStats.key("live"))
+
+    @staticmethod
+    async def disconnected():
+        await cache.aadd(ConsumerStats.key("live"), 1, None)
+        await cache.adecr(ConsumerStats.key("live"))
+
+    @staticmethod
+    def stats():
+        return {
+            counter: cache.get(ConsumerStats.key(counter), 0)
+            for counter in ConsumerStats.COUNTERS + ["live"]
+        }
+
+    @staticmethod
+    def reset_stats():
+        """Reset the counters, the live connections gauge is kept"""
+        cache.delete_many(
+            [ConsumerStats.key(counter) for counter in ConsumerStats.COUNTERS]
+        )
+
+
+class DatabaseExecutorStats:
+    """
+    Calls run on the database executor and the time they waited for a
+    thread, added to the cache at most once per second by each process.
+    """
+
+    COUNTERS = ["calls", "wait_us", "slow_waits"]
+
+    # Waits counted as slow, in seconds
+    SLOW_WAIT = 0.05
+
+    lock = threading.Lock()
+    pending = dict.fromkeys(COUNTERS, 0)
+    last_flush = 0
+
+    @staticmethod
+    def key(counter):
+        return f"notifications:database_executor:{counter}"
+
+    @classmethod
+    def record(cls, wait):
+        with cls.lock:
+            cls.pending["calls"] += 1
+            cls.pending["wait_us"] += int(wait * 1_000_000)
+            cls.pending["slow_waits"] += wait > cls.SLOW_WAIT
+
+            now = time.monotonic()
+            if now - cls.last_flush < 1:
+                return
+            counters, cls.pending = cls.pending, dict.fromkeys(cls.COUNTERS, 0)
+            cls.last_flush = now
+
+        for counter, value in counters.items():
+            if value:
+                cache.add(cls.key(counter), 0, None)
+                cache.incr(cls.key(counter), value)
+
+    @classmethod
+    def stats(cls):
+        stats = {counter: cache.get(cls.key(counter), 0) for counter in cls.COUNTERS}
+        stats["average_wait_ms"] = (
+            stats["wait_us"] / stats["calls"] / 1000 if stats["calls"] else 0
+        )
+        return stats
+
+    @classmethod
+    def reset_stats(cls):
+        cache.delete_many([cls.key(counter) for counter in cls.COUNTERS])
@@ -1,14 +1,33 @@
-from django.test import TestCase, TransactionTestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from channels.testing import WebsocketCommunicator
-from unittest.mock import MagicMock, patch
-from asgiref.sync import sync_to_async
+from unittest.mock import MagicMock, AsyncMock, patch
+from asgiref.sync import sync_to_async, async_to_sync
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from django.contrib.auth import get_user_model
 from notifications.consumers import ChatConsumer, NotificationConsumer
 from friendships.models import Friendships
 from rest_framework.test import APIClient
 from chats.models import Conversations
 from rest_framework import status
+from notifications.stats import ConsumerStats, DatabaseExecutorStats
+from chat_app.db import database_to_async
+from notifications.topics import user_group
+from notifications.routing import websocket_urlpatterns
+from channels.routing import URLRouter
+from notifications import drain
+from django.core.cache import cache
+import asyncio
+import msgpack
+import socket
+import sys
+import threading
+import unittest
+from django.conf import settings
+from chat_app.layers import LocalRedisChannelLayer, PostgresChannelLayer
+from django.db import connection
+from notifications.models import ChannelLayerPayloads
+from twisted.internet.tcp import Port
 
 # Create your tests here.
 
@@ -131,6 +150,276 @@ class TestChatConsumer(BaseConsumerTests):
         await communicator1.disconnect()
         await communicator2.disconnect()
 
+    @override_settings(WEBSOCKET_BATCH_WINDOW_MS=200)
+    async def test_batched_events(self):
+        """Test events gathered in one frame with collapsed status updates"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+
+        communicator = await self.get_communicator(
+            ChatConsumer, "/ws/chat/?batch=1", user1
+        )
+
+        try:
+            await communicator.connect()
+
+            events = [
+                {"type": "status_update", "username": "friend1", "status": "Online"},
+                {"data": {"content": "Message 1"}},
+                {"type": "status_update", "username": "friend2", "status": "Online"},
+                {"type": "status_update", "username": "friend1", "status": "Offline"},
+            ]
+            channel_layer = get_channel_layer()
+            for event in events:
+                await channel_layer.group_send(
+                    user_group(user1.id),
+                    {"type": "chat.message", "topic": "presence", "message": event},
+                )
+
+            frame = await communicator.receive_json_from(timeout=2)
+
+            self.assertEqual(frame, events[1:])
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        finally:
+            await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        """Test the MessagePack wire format negotiated through the subprotocol"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        user2 = await self.create_user(username="user2", email="user2@example.com")
+        conversation = await self.create_conversation(user1, user2)
+
+        communicator1 = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), "/ws/chat/", subprotocols=["chat.msgpack.v1"]
+        )
+        communicator1.scope["user"] = user1
+        communicator2 = await self.get_communicator(ChatConsumer, "/ws/chat/", user2)
+
+        try:
+            connected, subprotocol = await communicator1.connect()
+            await communicator2.connect()
+
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, "chat.msgpack.v1")
+
+            # Messages are sent and acknowledged in MessagePack frames
+            await communicator1.send_to(
+                bytes_data=msgpack.packb(
+                    {
+                        "type": "send_message",
+                        "conversation": conversation.id,
+                        "content": "Message sent in MessagePack",
+                    }
+                )
+            )
+            ack = msgpack.unpackb(await communicator1.receive_from(timeout=2))
+
+            self.assertEqual(ack["type"], "message_ack")
+            self.assertEqual(ack["d"]["b"], "Message sent in MessagePack")
+            self.assertEqual(ack["d"]["s"], "user1")
+            self.assertEqual(ack["d"]["c"], conversation.id)
+            self.assertIsInstance(ack["d"]["t"], int)
+
+            # JSON clients still receive the message in JSON
+            data_received = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(data_received["data"]["id"], ack["d"]["i"])
+        finally:
+            await communicator1.disconnect()
+            await communicator2.disconnect()
+
+    @override_settings(
+        WEBSOCKET_HEARTBEAT_INTERVAL=0.05, WEBSOCKET_HEARTBEAT_TIMEOUT=0.2
+    )
+    async def test_heartbeat_reaps_dead_connections(self):
+        """Test pings answered by pongs and reaping of silent connections"""
+        await sync_to_async(cache.clear)()
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        communicator = await self.get_communicator(
+            ChatConsumer, "/ws/chat/?heartbeat=1", user1
+        )
+        # Clients that don't ask for the heartbeat are never pinged nor reaped
+        silent = await self.get_communicator(ChatConsumer, "/ws/chat/", user1)
+
+        try:
+            await communicator.connect()
+            await silent.connect()
+            self.assertEqual((await sync_to_async(ConsumerStats.stats)())["live"], 2)
+
+            # Answering pings keeps the connection alive
+            for _ in range(5):
+                ping = await communicator.receive_json_from(timeout=1)
+                self.assertEqual(ping, {"type": "ping"})
+                await communicator.send_json_to({"type": "pong"})
+
+            # A silent client is reaped and leaves its group
+            while True:
+                output = await communicator.receive_output(timeout=1)
+                if output["type"] == "websocket.close":
+                    break
+            self.assertEqual(output["code"], 4000)
+
+            await get_channel_layer().group_send(
+                user_group(user1.id),
+                {
+                    "type": "chat.message",
+                    "topic": "friend_requests",
+                    "message": {"type": "friend_request"},
+                },
+            )
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+            output = await silent.receive_output(timeout=1)
+            self.assertEqual(output["type"], "websocket.send")
+            self.assertEqual(output["text"], '{"type": "friend_request"}')
+            self.assertTrue(await silent.receive_nothing(timeout=0.2))
+        finally:
+            await communicator.disconnect()
+            await silent.disconnect()
+
+        stats = await sync_to_async(ConsumerStats.stats)()
+        self.assertEqual(stats["live"], 0)
+        self.assertEqual(stats["reaped"], 1)
+
+    @override_settings(WEBSOCKET_DRAIN_WINDOW=0.2)
+    async def test_drain(self):
+        """Test reconnect hints, gradual closes and refused connections on drain"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        communicators = [
+            await self.get_communicator(ChatConsumer, "/ws/chat/", user1)
+            for _ in range(3)
+        ]
+
+        try:
+            for communicator in communicators:
+                await communicator.connect()
+
+            with patch.object(drain, "_draining", False):
+                drain.start()
+
+                # Every client is told when it will be closed
+                for communicator in communicators:
+                    hint = await communicator.receive_json_from(timeout=1)
+                    self.assertEqual(hint["type"], "reconnect")
+                    self.assertTrue(200 <= hint["after"] <= 400)
+
+                    output = await communicator.receive_output(timeout=1)
+                    self.assertEqual(output["type"], "websocket.close")
+                    self.assertEqual(output["code"], 4012)
+
+                # New connections are refused while draining
+                refused = await self.get_communicator(ChatConsumer, "/ws/chat/", user1)
+                connected, code = await refused.connect()
+                self.assertFalse(connected)
+                self.assertEqual(code, 4013)
+        finally:
+            for communicator in communicators:
+                await communicator.disconnect()
+
+    def test_drain_stops_listening(self):
+        """Test the listening ports of Daphne closed when draining starts"""
+        port = MagicMock(spec=Port)
+        reactor = MagicMock()
+        reactor.getReaders.return_value = [port, MagicMock()]
+
+        with patch.dict(sys.modules, {"twisted.internet.reactor": reactor}):
+            with patch.object(drain, "_draining", False):
+                drain.start()
+
+        port.stopListening.assert_called_once_with()
+
+    async def test_topic_subscriptions(self):
+        """Test events fanned out only to the subscribed topics"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        user2 = await self.create_user(username="user2", email="user2@example.com")
+        conversation = await self.create_conversation(user1, user2)
+
+        communicator1 = await self.get_communicator(ChatConsumer, "/ws/", user1)
+        communicator2 = await self.get_communicator(
+            ChatConsumer, "/ws/?topics=typing,unknown", user2
+        )
+
+        try:
+            await communicator1.connect()
+            await communicator2.connect()
+
+            # Typing events reach the subscribed topic
+            await communicator1.send_json_to(
+                {"type": "typing", "conversation": conversation.id}
+            )
+            typing = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(
+                typing,
+                {
+                    "type": "typing",
+                    "conversation": conversation.id,
+                    "username": "user1",
+                },
+            )
+
+            # Chat messages are not sent to connections not subscribed to them
+            await communicator1.send_json_to(
+                {
+                    "type": "send_message",
+                    "conversation": conversation.id,
+                    "content": "Message 1",
+                }
+            )
+            ack = await communicator1.receive_json_from(timeout=2)
+            self.assertEqual(ack["type"], "message_ack")
+            self.assertTrue(await communicator2.receive_nothing(timeout=0.2))
+
+            # Subscribing to the messages topic
+            await communicator2.send_json_to(
+                {"type": "subscribe", "topics": ["messages"]}
+            )
+            subscribed = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(
+                subscribed, {"type": "topics", "topics": ["messages", "typing"]}
+            )
+
+            await communicator1.send_json_to(
+                {
+                    "type": "send_message",
+                    "conversation": conversation.id,
+                    "content": "Message 2",
+                }
+            )
+            data_received = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(data_received["data"]["content"], "Message 2")
+        finally:
+            await communicator1.disconnect()
+            await communicator2.disconnect()
+
+    async def test_legacy_routes_topics(self):
+        """Test the two sockets of the older app each getting only their events"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+
+        router = URLRouter(websocket_urlpatterns)
+        chat = WebsocketCommunicator(router, "/ws/chat/")
+        notification = WebsocketCommunicator(router, "/ws/notification/")
+        chat.scope["user"] = user1
+        notification.scope["user"] = user1
+
+        try:
+            await chat.connect()
+            await notification.connect()
+
+            await NotificationConsumer.asendFriendRequest(user1.id)
+            await ChatConsumer.asendChatMessage(user1.id, {"content": "Message 1"})
+
+            self.assertEqual(
+                await chat.receive_json_from(timeout=2),
+                {"data": {"content": "Message 1"}},
+            )
+            self.assertEqual(
+                await notification.receive_json_from(timeout=2),
+                {"type": "friend_request"},
+            )
+            self.assertTrue(await chat.receive_nothing(timeout=0.2))
+            self.assertTrue(await notification.receive_nothing(timeout=0.2))
+        finally:
+            await chat.disconnect()
+            await notification.disconnect()
+
     @database_sync_to_async
     def create_conversation(self, user1, user2):
         return Conversations.objects.create(user1=user1, user2=user2)
@@ -179,6 +468,394 @@ class TestChatConsumer(BaseConsumerTests):
             await communicator1.disconnect()
             await communicator2.disconnect()
 
+    async def test_send_chat_message_over_websocket(self):
+        """Test sending a chat message from the Websocket"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        user2 = await self.create_user(username="user2", email="user2@example.com")
+        conversation = await self.create_conversation(user1, user2)
+
+        communicator1 = await self.get_communicator(ChatConsumer, "/ws/chat/", user1)
+        communicator2 = await self.get_communicator(ChatConsumer, "/ws/chat/", user2)
+
+        try:
+            await communicator1.connect()
+            await communicator2.connect()
+
+            message = {
+                "type": "send_message",
+                "conversation": conversation.id,
+                "content": "Message sent over Websocket",
+                "client_message_id": "key-1",
+            }
+            await communicator1.send_json_to(message)
+
+            # The sender receives an acknowledgement with the stored message
+            ack = await communicator1.receive_json_from(timeout=2)
+            self.assertEqual(ack["type"], "message_ack")
+            self.assertEqual(ack["client_message_id"], "key-1")
+            self.assertEqual(ack["data"]["seq"], 1)
+
+            # The receiver gets the chat message, then both inboxes are updated
+            data_received = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(data_received["data"], ack["data"])
+            update = await communicator2.receive_json_from(timeout=2)
+            self.assertEqual(update["type"], "inbox_update")
+            self.assertEqual(update["unread"], 1)
+            update = await communicator1.receive_json_from(timeout=2)
+            self.assertEqual(update["type"], "inbox_update")
+            self.assertEqual(update["unread"], 0)
+
+            # A retry is acknowledged again without sending it twice
+            await communicator1.send_json_to(message)
+            retry_ack = await communicator1.receive_json_from(timeout=2)
+            self.assertEqual(retry_ack["data"], ack["data"])
+            self.assertTrue(await communicator2.receive_nothing(timeout=0.5))
+
+            # Conversations of other users are not found
+            await communicator1.send_json_to({**message, "conversation": 1000})
+            error = await communicator1.receive_json_from(timeout=2)
+            self.assertEqual(error["type"], "message_error")
+            self.assertEqual(error["errors"], {"detail": "Not found."})
+        finally:
+            await communicator1.disconnect()
+            await communicator2.disconnect()
+
+    async def test_inbox_updates(self):
+        """Test inbox diffs sent when a message is sent and read"""
+        user1 = await self.create_user(username="user1", email="user1@example.com")
+        user2 = await self.create_user(username="user2", email="user2@example.com")
+        conversation = await self.create_conversation(user1, user2)
+
+        communicator2 = await self.get_communicator(ChatConsumer, "/ws/chat/", user2)
+
+        try:
+            await communicator2.connect()
+
+            access_token = await self.authenticate_user(user1.username, "Swift-1234")
+            await self.send_message(
+                f"/api/conversations/{conversation.id}/messages/",
+                {"content": "Message received from user1"},
+                access_token,
+            )
+
+            # The chat message is followed by the inbox diff
+            await communicator2.receive_json_from(timeout=2)
+            update = await communicator2.receive_json_from(timeout=2)
+
+            self.assertEqual(update["type"], "inbox_update")
+            self.assertEqual(update["conversation"], conversation.id)
+            self.assertEqual(update["lastMessage"], "Message received from user1")
+            self.assertEqual(update["unread"], 1)
+            self.assertFalse(update["hidden"])
+            self.assertIsNotNone(update["timestamp"])
+
+            # Reading the messages from another device clears the unread count
+            access_token = await self.authenticate_user(user2.username, "Swift-1234")
+            await self.read_messages(conversation, access_token)
+            update = await communicator2.receive_json_from(timeout=2)
+
+            self.assertEqual(update["type"], "inbox_update")
+            self.assertEqual(update["unread"], 0)
+        finally:
+            await communicator2.disconnect()
+
+    @database_sync_to_async
+    def read_messages(self, conversation, access_token):
+        client = APIClient()
+        headers = {"Authorization": f"Bearer {access_token}"}
+        return client.patch(
+            f"/api/conversations/{conversation.id}/messages/",
+            data={"action": "read_messages"},
+            headers=headers,
+        )
+
+
+class TestOutboundQueue(TestCase):
+    """
+    Test suite for the outbound queue of the consumers.
+
+    Test cases:
+    - test_drop_oldest_status_updates: Tests status updates dropped first
+    - test_disconnect_slow_client: Tests the resume hint for clients too far behind
+    - test_control_frames_not_counted: Tests control frames queued without dropping events
+    """
+
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.user = MagicMock()
+        self.consumer.setup_outbound()
+        self.consumer.send_event = AsyncMock()
+        self.consumer.close = AsyncMock()
+
+    def status(self, username):
+        return {"type": "status_update", "username": username, "status": "Online"}
+
+    def message(self, seq):
+        return {"data": {"conversation": 1, "seq": seq, "content": f"Message {seq}"}}
+
+    @override_settings(WEBSOCKET_OUTBOUND_QUEUE_SIZE=2)
+    def test_drop_oldest_status_updates(self):
+        events = [self.status("user1"), self.status("user2"), self.message(1)]
+        for event in events + [self.message(2), self.status("user3")]:
+            async_to_sync(self.consumer.queue_event)(event)
+
+        self.assertEqual(
+            list(self.consumer.outbound), [self.message(1), self.message(2)]
+        )
+        self.assertEqual(self.consumer.counters["queued"], 4)
+        self.assertEqual(self.consumer.counters["dropped"], 3)
+        self.consumer.close.assert_not_awaited()
+
+    @override_settings(WEBSOCKET_OUTBOUND_QUEUE_SIZE=2)
+    def test_disconnect_slow_client(self):
+        self.consumer.track_delivered(self.message(5))
+
+        for seq in range(6, 9):
+            async_to_sync(self.consumer.queue_event)(self.message(seq))
+
+        self.consumer.send_event.assert_awaited_once_with(
+            {"type": "resume", "conversations": {1: 5}}
+        )
+        self.consumer.close.assert_awaited_once_with(code=4008)
+        self.assertEqual(self.consumer.counters["slow_disconnects"], 1)
+
+        # Nothing is queued once the client is disconnected
+        async_to_sync(self.consumer.queue_event)(self.message(9))
+        self.assertEqual(len(self.consumer.outbound), 0)
+
+    @override_settings(WEBSOCKET_OUTBOUND_QUEUE_SIZE=2)
+    def test_control_frames_not_counted(self):
+        events = [self.message(1), self.message(2), {"type": "ping"}]
+        for event in events + [
+            {"type": "reconnect", "after": 100},
+            self.status("user1"),
+        ]:
+            async_to_sync(self.consumer.queue_event)(event)
+
+        self.assertEqual(
+            list(self.consumer.outbound),
+            events + [{"type": "reconnect", "after": 100}],
+        )
+        self.assertEqual(self.consumer.counters["dropped"], 1)
+        self.consumer.close.assert_not_awaited()
+
+
+class TestFriendNotifications(TestCase):
+    """
+    Test suite for the status updates sent to the friends of a user.
+
+    Test cases:
+    - test_one_query_for_all_friends: Tests the friends' groups found in one query
+    """
+
+    def test_one_query_for_all_friends(self):
+        user = Users.objects.create_user(username="user", email="user@example.com")
+        friends = []
+        for index in range(3):
+            friend = Users.objects.create_user(
+                username=f"friend{index}", email=f"friend{index}@example.com"
+            )
+            # The user is on either side of the friendship
+            pair = (user, friend) if index % 2 else (friend, user)
+            Friendships.objects.create(
+                user1=pair[0], user2=pair[1], status=Friendships.ACCEPTED
+            )
+            friends.append(friend)
+
+        consumer = ChatConsumer()
+        consumer.user = user
+        # Run the wrapped function in this thread, on the connection counted
+        with self.assertNumQueries(1):
+            notifications = ChatConsumer.get_friend_notifications.__wrapped__(
+                consumer, "Online"
+            )
+
+        self.assertEqual(
+            sorted(notification["room_name"] for notification in notifications),
+            sorted(user_group(friend.id) for friend in friends),
+        )
+
+
+class TestDatabaseExecutor(TransactionTestCase):
+    """
+    Test suite for the database executor of the consumers.
+
+    Test cases:
+    - test_records_wait_for_a_thread: Tests calls run on the executor and timed
+    """
+
+    def test_records_wait_for_a_thread(self):
+        cache.clear()
+
+        @database_to_async
+        def count_users():
+            return threading.current_thread().name, Users.objects.count()
+
+        # Flush on the first call, without the calls of other tests
+        pending = dict.fromkeys(DatabaseExecutorStats.COUNTERS, 0)
+        with patch.object(DatabaseExecutorStats, "pending", pending), patch.object(
+            DatabaseExecutorStats, "last_flush", 0
+        ):
+            thread_name, count = async_to_sync(count_users)()
+
+        self.assertTrue(thread_name.startswith("database"))
+        self.assertEqual(count, 0)
+        stats = DatabaseExecutorStats.stats()
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["average_wait_ms"], stats["wait_us"] / 1000)
+
+
+def redis_available():
+    try:
+        socket.create_connection((settings.REDIS_HOST, settings.REDIS_PORT), 1).close()
+        return True
+    except OSError:
+        return False
+
+
+class TestLocalChannelLayer(TestCase):
+    """
+    Test suite for the local delivery fast path of the channel layer.
+
+    Test cases:
+    - test_send_to_local_channel: Tests local channels served from memory
+    - test_group_send_to_local_and_remote_channels: Tests groups across processes
+    - test_send_to_waiting_receiver: Tests local sends to a receiver waiting on Redis
+    """
+
+    def get_layer(self):
+        return LocalRedisChannelLayer(
+            hosts=[(settings.REDIS_HOST, settings.REDIS_PORT)]
+        )
+
+    def test_send_to_local_channel(self):
+        layer = self.get_layer()
+
+        async def send_and_receive():
+            channel = await layer.new_channel()
+            await layer.send(channel, {"type": "chat.message", "message": "Hello"})
+            return await layer.receive(channel)
+
+        message = async_to_sync(send_and_receive)()
+
+        self.assertEqual(message, {"type": "chat.message", "message": "Hello"})
+
+    @unittest.skipUnless(redis_available(), "Requires a Redis server")
+    def test_group_send_to_local_and_remote_channels(self):
+        layer = self.get_layer()
+        # Another process has its own layer and client prefix
+        remote_layer = self.get_layer()
+
+        async def group_send():
+            local_channel = await layer.new_channel()
+            remote_channel = await remote_layer.new_channel()
+            await layer.group_add("test_group", local_channel)
+            await remote_layer.group_add("test_group", remote_channel)
+
+            await layer.group_send("test_group", {"type": "chat.message"})
+
+            received = [
+                await layer.receive(local_channel),
+                await remote_layer.receive(remote_channel),
+            ]
+            await layer.flush()
+            return received
+
+        received = async_to_sync(group_send)()
+
+        self.assertEqual(received, [{"type": "chat.message"}] * 2)
+        self.assertEqual(layer.local_groups, {})
+
+    @unittest.skipUnless(redis_available(), "Requires a Redis server")
+    def test_send_to_waiting_receiver(self):
+        layer = self.get_layer()
+
+        async def send_while_receiving():
+            channel = await layer.new_channel()
+            other_channel = await layer.new_channel()
+            await layer.group_add("test_group", channel)
+
+            # The first receiver waits on Redis, the other one on its buffer
+            receiver = asyncio.ensure_future(layer.receive(channel))
+            other_receiver = asyncio.ensure_future(layer.receive(other_channel))
+            await asyncio.sleep(0.1)
+
+            await layer.send(channel, {"type": "chat.message", "message": "1"})
+            await layer.send(other_channel, {"type": "chat.message", "message": "2"})
+            received = [
+                await asyncio.wait_for(receiver, 2),
+                await asyncio.wait_for(other_receiver, 2),
+            ]
+
+            receiver = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0.1)
+            await layer.group_send("test_group", {"type": "chat.message"})
+            received.append(await asyncio.wait_for(receiver, 2))
+            await layer.flush()
+            return received
+
+        received = async_to_sync(send_while_receiving)()
+
+        self.assertEqual(
+            received,
+            [
+                {"type": "chat.message", "message": "1"},
+                {"type": "chat.message", "message": "2"},
+                {"type": "chat.message"},
+            ],
+        )
+
+
+@unittest.skipUnless(
+    connection.vendor == "postgresql", "LISTEN/NOTIFY requires PostgreSQL"
+)
+class TestPostgresChannelLayer(TransactionTestCase):
+    """
+    Test suite for the Postgres LISTEN/NOTIFY channel layer.
+
+    Test cases:
+    - test_group_send_to_local_and_remote_channels: Tests groups across processes
+    - test_send_large_message: Tests payloads spilled to the database
+    """
+
+    async def send_across_processes(self, message):
+        layer = PostgresChannelLayer()
+        # Another process has its own layer and listener connection
+        remote_layer = PostgresChannelLayer()
+        try:
+            local_channel = await layer.new_channel()
+            remote_channel = await remote_layer.new_channel()
+            await layer.group_add("test_group", local_channel)
+            await remote_layer.group_add("test_group", remote_channel)
+
+            await layer.group_send("test_group", message)
+
+            received = [
+                await layer.receive(local_channel),
+                await asyncio.wait_for(remote_layer.receive(remote_channel), 5),
+            ]
+            spilled = await database_sync_to_async(ChannelLayerPayloads.objects.count)()
+            return received, spilled
+        finally:
+            await layer.flush()
+            await remote_layer.flush()
+
+    def test_group_send_to_local_and_remote_channels(self):
+        received, spilled = async_to_sync(self.send_across_processes)(
+            {"type": "chat.message"}
+        )
+
+        self.assertEqual(received, [{"type": "chat.message"}] * 2)
+        self.assertEqual(spilled, 0)
+
+    def test_send_large_message(self):
+        message = {"type": "chat.message", "message": "a" * 10000}
+
+        received, spilled = async_to_sync(self.send_across_processes)(message)
+
+        self.assertEqual(received, [message] * 2)
+        self.assertEqual(spilled, 1)
+
 
 class TestNotificationConsumer(BaseConsumerTests):
 
@@ -0,0 +1,12 @@
+MESSAGES = "messages"
+INBOX = "inbox"
+PRESENCE = "presence"
+FRIEND_REQUESTS = "friend_requests"
+TYPING = "typing"
+
+TOPICS = [MESSAGES, INBOX, PRESENCE, FRIEND_REQUESTS, TYPING]
+
+
+def user_group(user_id):
+    """Group of the connections of the user, events carry their topic"""
+    return f"chat_{user_id}"
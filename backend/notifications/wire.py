@@ -0,0 +1,58 @@
+from django.utils.dateparse import parse_datetime
+import msgpack
+
+# Subprotocol negotiated by clients that want MessagePack frames
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+# Short keys of chat messages on the MessagePack wire format
+MESSAGE_KEYS = {
+    "id": "i",
+    "conversation": "c",
+    "sender": "s",
+    "content": "b",
+    "seq": "q",
+    "created_at": "t",
+}
+
+
+def to_milliseconds(value):
+    """Convert an ISO 8601 timestamp to integer milliseconds since the epoch"""
+    timestamp = parse_datetime(value) if isinstance(value, str) else None
+    if timestamp is None:
+        return value
+    return int(timestamp.timestamp() * 1000)
+
+
+def compact_message(message):
+    return {
+        MESSAGE_KEYS.get(field, field): (
+            to_milliseconds(value) if field == "created_at" else value
+        )
+        for field, value in message.items()
+    }
+
+
+def compact(event):
+    """
+    Shorten an outbound event for the MessagePack wire format.
+
+    Chat messages are sent under `d` with the keys of MESSAGE_KEYS, and
+    timestamps of every event become integer milliseconds.
+    """
+    if isinstance(event, list):
+        return [compact(item) for item in event]
+
+    event = dict(event)
+    if isinstance(event.get("data"), dict):
+        event["d"] = compact_message(event.pop("data"))
+    if "timestamp" in event:
+        event["timestamp"] = to_milliseconds(event["timestamp"])
+    return event
+
+
+def encode(event):
+    return msgpack.packb(compact(event))
+
+
+def decode(data):
+    return msgpack.unpackb(data)
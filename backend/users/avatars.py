@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from chat_app.oauth import ProviderUnavailable, avatars
+from .models import Users
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from io import BytesIO
+import hashlib
+import logging
+import requests
+import threading
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+class InvalidAvatar(Exception):
+    """The remote avatar can't be used, fetching it again won't help"""
+
+
+class AvatarIngestion:
+    """
+    Copies the avatars of OAuth users from their provider to our storage.
+
+    OAuth users are created with the URL of their provider's avatar as
+    their picture. After the user is committed, the avatar is downloaded in
+    the background, resized to fit AVATAR_SIZE pixels and stored as a JPEG
+    named after the hash of its content, so identical avatars share one
+    file. The stored file replaces the URL unless the user changed their
+    picture meanwhile. An avatar that can't be decoded is dropped. One that
+    can't be downloaded is left for the ingest_avatars command to retry.
+    """
+
+    @staticmethod
+    def is_remote(name):
+        return bool(name) and name.startswith(("http://", "https://"))
+
+    @staticmethod
+    def url_key(url):
+        return f"users:avatars:url:{hashlib.sha256(url.encode()).hexdigest()}"
+
+    @staticmethod
+    def schedule(user):
+        """Ingest the avatar of the user in the background once it is committed"""
+        if AvatarIngestion.is_remote(user.picture.name):
+            transaction.on_commit(lambda: AvatarIngestion.submit(user.id))
+
+    @staticmethod
+    def submit(user_id):
+        with _pending_lock:
+            if user_id in _pending:
+                return
+            _pending.add(user_id)
+        get_executor().submit(AvatarIngestion.run, user_id)
+
+    @staticmethod
+    def run(user_id):
+        try:
+            AvatarIngestion.ingest(user_id)
+        except Exception:
+            logger.exception(f"Ingesting the avatar of user {user_id} failed")
+        finally:
+            with _pending_lock:
+                _pending.discard(user_id)
+            connection.close()
+
+    @staticmethod
+    def ingest(user_id):
+        """
+        Replace the remote avatar of the user with a stored copy, returning
+        False if it should be retried later
+        """
+        url = Users.objects.filter(id=user_id).values_list("picture", flat=True).first()
+        if not AvatarIngestion.is_remote(url):
+            return True
+
+        # Users with the same avatar URL, like the provider's default avatar,
+        # share the download
+        name = cache.get(AvatarIngestion.url_key(url))
+        if name is None or not default_storage.exists(name):
+            try:
+                name = AvatarIngestion.store(AvatarIngestion.normalize(download(url)))
+            except (ProviderUnavailable, requests.RequestException) as e:
+                logger.warning(f"Downloading the avatar of user {user_id} failed: {e}")
+                return False
+            except InvalidAvatar as e:
+                logger.warning(f"Dropping the avatar of user {user_id}: {e}")
+                name = None
+            else:
+                cache.set(
+                    AvatarIngestion.url_key(url),
+                    name,
+                    settings.AVATAR_URL_CACHE_TIMEOUT,
+                )
+
+        Users.objects.filter(id=user_id, picture=url).update(picture=name)
+        return True
+
+    @staticmethod
+    def normalize(data):
+        """Decode the image, apply its orientation and resize it into a JPEG"""
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image = ImageOps.exif_transpose(image).convert("RGB")
+                image.thumbnail((settings.AVATAR_SIZE, settings.AVATAR_SIZE))
+                output = BytesIO()
+                image.save(output, format="JPEG", quality=85)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise InvalidAvatar(f"Invalid image: {e}")
+        return output.getvalue()
+
+    @staticmethod
+    def store(data):
+        """Save the avatar under the hash of its content, once"""
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"profile_pictures/avatar_{digest[:32]}.jpg"
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(data))
+        return name
+
+    @staticmethod
+    def is_shared(picture, user):
+        """Whether other users have the same stored picture, like a deduplicated avatar"""
+        return Users.objects.filter(picture=picture.name).exclude(id=user.id).exists()
+
+
+def download(url):
+    response = avatars.get(url, stream=True)
+    with response:
+        if not response.ok:
+            raise InvalidAvatar(f"The avatar URL answered {response.status_code}")
+
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > settings.AVATAR_MAX_SIZE:
+                raise InvalidAvatar("The avatar is too large")
+    return bytes(data)
+
+
+def get_executor():
+    """Get the thread pool ingesting avatars in this process"""
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            settings.AVATAR_INGESTION_WORKERS, thread_name_prefix="avatars"
+        )
+    return _executor
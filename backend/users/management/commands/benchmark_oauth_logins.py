@@ -0,0 +1,187 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from users.models import Users
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import requests
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures Google logins per second against a stub OAuth provider, with "
+        "the callback views on gunicorn and on Daphne"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--logins", type=int, default=500, help="Logins per server")
+        parser.add_argument(
+            "--concurrency", type=int, default=50, help="Logins in flight"
+        )
+        parser.add_argument(
+            "--delay",
+            type=float,
+            default=0.2,
+            help="Seconds the stub provider takes to answer each request",
+        )
+        parser.add_argument(
+            "--gunicorn-workers",
+            type=int,
+            default=os.cpu_count() * 2 + 1,
+            help="Sync workers, sized like config/gunicorn.conf.py",
+        )
+        parser.add_argument(
+            "--daphne-workers", type=int, default=os.cpu_count(), help="ASGI workers"
+        )
+        parser.add_argument("--port", type=int, default=18200)
+
+    def handle(self, *args, **options):
+        # Every login creates a user whose username collides with the others
+        prefix = f"bench{uuid.uuid4().hex[:8]}"
+        provider = StubProvider(options["delay"], prefix)
+        threading.Thread(target=provider.serve_forever, daemon=True).start()
+
+        env = {
+            "GOOGLE_TOKEN_URI": f"{provider.url}/token",
+            "GOOGLE_USERINFO_URI": f"{provider.url}/userinfo",
+        }
+        servers = (
+            (
+                "WSGI",
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "chat_app.wsgi:application",
+                    "-b",
+                    f"127.0.0.1:{options['port']}",
+                    "-w",
+                    str(options["gunicorn_workers"]),
+                    "--log-level",
+                    "warning",
+                ],
+                env,
+            ),
+            (
+                "ASGI",
+                [
+                    sys.executable,
+                    str(settings.BASE_DIR / "config" / "daphne_workers.py"),
+                ],
+                dict(
+                    env,
+                    WEBSOCKET_HOST="127.0.0.1",
+                    WEBSOCKET_PORT=str(options["port"]),
+                    WEBSOCKET_WORKERS=str(options["daphne_workers"]),
+                    WEBSOCKET_VERBOSITY="0",
+                    WEBSOCKET_DRAIN_WINDOW="0",
+                ),
+            ),
+        )
+
+        try:
+            for name, command, server_env in servers:
+                server = subprocess.Popen(
+                    command, cwd=settings.BASE_DIR, env=dict(os.environ, **server_env)
+                )
+                try:
+                    self.wait_for_server(options["port"])
+                    latencies, errors, elapsed = self.measure(options)
+                finally:
+                    server.terminate()
+                    server.wait()
+
+                quantiles = statistics.quantiles(latencies, n=100)
+                self.stdout.write(
+                    f"{name}: {len(latencies) / elapsed:.1f} logins/s, "
+                    f"p50 {quantiles[49] * 1000:.0f}ms, "
+                    f"p99 {quantiles[98] * 1000:.0f}ms, errors {errors}"
+                )
+        finally:
+            provider.shutdown()
+            Users.objects.filter(email__startswith=prefix).delete()
+
+    def wait_for_server(self, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f"http://127.0.0.1:{port}/api/login/", timeout=5)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.5)
+        # A worker answered, give the others time to load the application
+        time.sleep(2)
+
+    def measure(self, options):
+        url = f"http://127.0.0.1:{options['port']}/api/oauth/google/callback/"
+        local = threading.local()
+        errors = []
+
+        def login(_):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+
+            start = time.perf_counter()
+            response = local.session.post(url, {"code": "code"}, timeout=60)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            latencies = list(executor.map(login, range(options["logins"])))
+        elapsed = time.perf_counter() - start
+
+        return latencies, len(errors), elapsed
+
+
+class StubProvider(ThreadingHTTPServer):
+    """Google token and userinfo endpoints answering after a delay"""
+
+    daemon_threads = True
+
+    def __init__(self, delay, prefix):
+        super().__init__(("127.0.0.1", 0), StubProviderHandler)
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        self.delay = delay
+        self.prefix = prefix
+        self.counter = itertools.count()
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.respond({"access_token": "stub_access_token"})
+
+    def do_GET(self):
+        self.respond(
+            {
+                "id": "12345",
+                "email": f"{self.server.prefix}_{next(self.server.counter)}@example.com",
+                "given_name": self.server.prefix,
+                "family_name": "User",
+                "picture": "https://example.com/picture.png",
+            }
+        )
+
+    def respond(self, data):
+        time.sleep(self.server.delay)
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from users.models import Users
+from users.avatars import AvatarIngestion
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Stores the avatars of OAuth users still pointing to their provider"
+
+    def handle(self, *args, **options):
+        users = Users.objects.filter(
+            Q(picture__startswith="http://") | Q(picture__startswith="https://")
+        ).values_list("id", flat=True)
+
+        ingested = failed = 0
+        for user_id in users.iterator():
+            if AvatarIngestion.ingest(user_id):
+                ingested += 1
+            else:
+                failed += 1
+
+        logger.info(f"Ingested {ingested} avatars, {failed} left to retry")
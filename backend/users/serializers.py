@@ -14,6 +14,7 @@ from django.conf import settings
 from django.core.files.storage import default_storage
 from django.shortcuts import get_object_or_404
 from friendships.models import Friendships
+from .avatars import AvatarIngestion
 from django.db.models import Q
 import logging
 
@@ -312,7 +313,11 @@ class UpdatePictureSerializer(serializers.Serializer):
         user = self.context.get("request").user
         old_picture = user.picture
 
-        if old_picture and default_storage.exists(old_picture.path):
+        if (
+            old_picture
+            and default_storage.exists(old_picture.path)
+            and not AvatarIngestion.is_shared(old_picture, user)
+        ):
             default_storage.delete(old_picture.path)
 
         user.picture = self.validated_data["new_picture"]
@@ -0,0 +1,255 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from rest_framework.test import APIClient
+from rest_framework import status
+from chat_app.helpers import create_test_user, get_auth_headers
+from chat_app.oauth import avatars
+from users.avatars import AvatarIngestion
+from users.models import Users
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from PIL import Image
+from io import BytesIO
+import collections
+import shutil
+import tempfile
+import threading
+
+
+def create_image(width, height, format="PNG"):
+    output = BytesIO()
+    Image.new("RGB", (width, height), color="blue").save(output, format=format)
+    return output.getvalue()
+
+
+class StubImageServer(ThreadingHTTPServer):
+    """Serves the responses queued for each path, repeating the last one"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubImageHandler)
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        self.routes = {}
+        self.requests = collections.Counter()
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        responses = self.server.routes.get(self.path, [(404, b"")])
+        status_code, body = responses.pop(0) if len(responses) > 1 else responses[0]
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(OAUTH_RETRIES=1, OAUTH_RETRY_BACKOFF=0)
+class AvatarIngestionTests(TestCase):
+    """
+    Test suite for AvatarIngestion against a stub image server.
+
+    Test cases:
+    - `test_avatar_resized_and_stored`: Tests that the remote avatar is resized and replaces the URL.
+    - `test_identical_avatars_stored_once`: Tests that identical avatars share one file and one URL is downloaded once.
+    - `test_download_retried`: Tests that a failed download is retried, and left for a later run when retries fail.
+    - `test_invalid_avatars_dropped`: Tests that missing, broken and too large avatars are removed from the user.
+    - `test_changed_picture_kept`: Tests that a picture changed during the download is not overwritten.
+    - `test_schedule_after_commit`: Tests that ingestion is submitted once the user is committed, and once at a time per user.
+    - `test_ingest_avatars_command`: Tests that the command ingests the remaining remote avatars.
+    - `test_delete_shared_avatar`: Tests that deleting a picture shared with another user keeps the file.
+    - `test_circuit_per_host`: Tests that a host with an open circuit doesn't fail downloads from other hosts.
+
+    Methods:
+    - `setUpClass`: Starts the stub image server.
+    - `setUp`: Stores pictures in a temporary media directory and resets the avatar client and cache.
+    - `create_oauth_user`: Helper method to create a user whose picture is a stub server URL.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubImageServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        avatars.reset()
+        cache.clear()
+        self.server.routes = {"/avatar.png": [(200, create_image(1024, 768))]}
+        self.server.requests.clear()
+
+    def create_oauth_user(self, username, path="/avatar.png"):
+        user = create_test_user(username, f"{username}@example.com")
+        user.picture = f"{self.server.url}{path}"
+        user.IsOAuth = True
+        user.save()
+        return user
+
+    def test_avatar_resized_and_stored(self):
+        user = self.create_oauth_user("oauthuser")
+
+        self.assertTrue(AvatarIngestion.ingest(user.id))
+
+        user.refresh_from_db()
+        self.assertRegex(
+            user.picture.name, r"^profile_pictures/avatar_[0-9a-f]{32}\.jpg$"
+        )
+        with Image.open(default_storage.open(user.picture.name)) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.size, (256, 192))
+
+    def test_identical_avatars_stored_once(self):
+        self.server.routes["/copy.png"] = [(200, create_image(1024, 768))]
+        users = [
+            self.create_oauth_user("oauthuser1"),
+            self.create_oauth_user("oauthuser2"),
+            self.create_oauth_user("oauthuser3", "/copy.png"),
+        ]
+
+        for user in users:
+            AvatarIngestion.ingest(user.id)
+
+        names = {user.picture.name for user in Users.objects.filter(IsOAuth=True)}
+        self.assertEqual(len(names), 1)
+        self.assertEqual(len(default_storage.listdir("profile_pictures")[1]), 1)
+        self.assertEqual(self.server.requests["/avatar.png"], 1)
+
+    def test_download_retried(self):
+        image = create_image(64, 64)
+        self.server.routes["/flaky.png"] = [(503, b""), (200, image)]
+        self.server.routes["/down.png"] = [(503, b""), (503, b""), (200, image)]
+        flaky_user = self.create_oauth_user("flakyuser", "/flaky.png")
+        down_user = self.create_oauth_user("downuser", "/down.png")
+
+        self.assertTrue(AvatarIngestion.ingest(flaky_user.id))
+        self.assertEqual(self.server.requests["/flaky.png"], 2)
+
+        self.assertFalse(AvatarIngestion.ingest(down_user.id))
+        down_user.refresh_from_db()
+        self.assertEqual(down_user.picture.name, f"{self.server.url}/down.png")
+
+        self.assertTrue(AvatarIngestion.ingest(down_user.id))
+        down_user.refresh_from_db()
+        self.assertTrue(down_user.picture.name.startswith("profile_pictures/"))
+
+    def test_invalid_avatars_dropped(self):
+        self.server.routes["/broken.png"] = [(200, b"not an image")]
+        self.server.routes["/large.png"] = [(200, b"0" * (2 * 1024 * 1024 + 1))]
+
+        for index, path in enumerate(["/missing.png", "/broken.png", "/large.png"]):
+            with self.subTest(path=path):
+                user = self.create_oauth_user(f"oauthuser{index}", path)
+
+                self.assertTrue(AvatarIngestion.ingest(user.id))
+
+                user.refresh_from_db()
+                self.assertFalse(user.picture)
+
+    def test_changed_picture_kept(self):
+        user = self.create_oauth_user("oauthuser")
+
+        def download(url):
+            Users.objects.filter(id=user.id).update(picture="profile_pictures/new.jpg")
+            return create_image(64, 64)
+
+        with patch("users.avatars.download", side_effect=download):
+            AvatarIngestion.ingest(user.id)
+
+        user.refresh_from_db()
+        self.assertEqual(user.picture.name, "profile_pictures/new.jpg")
+
+    @patch("users.avatars.get_executor")
+    def test_schedule_after_commit(self, mock_get_executor):
+        user = self.create_oauth_user("oauthuser")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AvatarIngestion.schedule(user)
+            AvatarIngestion.schedule(user)
+            mock_get_executor.return_value.submit.assert_not_called()
+
+        mock_get_executor.return_value.submit.assert_called_once_with(
+            AvatarIngestion.run, user.id
+        )
+
+        # Users with an uploaded picture are not scheduled
+        uploader = create_test_user("uploader", "uploader@example.com")
+        uploader.picture = "profile_pictures/uploaded.jpg"
+        with self.captureOnCommitCallbacks() as callbacks:
+            AvatarIngestion.schedule(uploader)
+        self.assertEqual(callbacks, [])
+
+        # Once ingested, the user can be submitted again
+        with patch.object(AvatarIngestion, "ingest") as mock_ingest:
+            thread = threading.Thread(target=AvatarIngestion.run, args=[user.id])
+            thread.start()
+            thread.join()
+        mock_ingest.assert_called_once_with(user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AvatarIngestion.schedule(user)
+        self.assertEqual(mock_get_executor.return_value.submit.call_count, 2)
+
+    def test_ingest_avatars_command(self):
+        users = [self.create_oauth_user(f"oauthuser{index}") for index in range(3)]
+        create_test_user("localuser", "localuser@example.com")
+
+        call_command("ingest_avatars")
+
+        for user in users:
+            user.refresh_from_db()
+            self.assertTrue(user.picture.name.startswith("profile_pictures/avatar_"))
+        self.assertFalse(Users.objects.get(username="localuser").picture)
+
+    def test_delete_shared_avatar(self):
+        users = [self.create_oauth_user(f"oauthuser{index}") for index in range(2)]
+        for user in users:
+            AvatarIngestion.ingest(user.id)
+        name = Users.objects.get(id=users[0].id).picture.name
+
+        client = APIClient()
+        headers = get_auth_headers(client, "oauthuser0", "Swift-1234")
+        response = client.delete("/api/delete-picture/", headers=headers)
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Users.objects.get(id=users[0].id).picture)
+        self.assertTrue(default_storage.exists(name))
+
+    @override_settings(OAUTH_BREAKER_FAILURES=2, OAUTH_BREAKER_RESET=60)
+    def test_circuit_per_host(self):
+        self.server.routes["/down.png"] = [(503, b"")]
+        down_user = self.create_oauth_user("downuser", "/down.png")
+        # The same server under another host name
+        user = self.create_oauth_user("oauthuser")
+        user.picture = f"http://localhost:{self.server.server_port}/avatar.png"
+        user.save()
+
+        for _ in range(3):
+            self.assertFalse(AvatarIngestion.ingest(down_user.id))
+        # The circuit of the host opened after 2 failed downloads
+        self.assertEqual(self.server.requests["/down.png"], 4)
+
+        self.assertTrue(AvatarIngestion.ingest(user.id))
+        user.refresh_from_db()
+        self.assertTrue(user.picture.name.startswith("profile_pictures/"))
@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework.test import APIClient
 from rest_framework import status
 from users.models import Users, Blacklist
@@ -11,7 +11,14 @@ from users.serializers import UsersSerializer
 from chat_app.helpers import get_auth_headers, create_test_user
 from friendships.models import Friendships
 from chats.models import Conversations
+from chat_app.oauth import google, intra_42
+from users.views import get_available_username
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import os
+import statistics
+import threading
+import time
 
 
 class RegisterViewTests(TestCase):
@@ -243,6 +250,8 @@ class OAuthCallbackViewTests(TestCase):
     - `test_oauth_callback_with_empty_authorization_code`: Tests the OAuth callback with empty authorization code.
     - `test_oauth_42_invalid_authorization_code`: Tests the OAuth callback with invalid authorization code.
     - `test_oauth_42_with_invalid_access_token`: Tests the OAuth callback with invalid access token. Mocks the request to exchange the authorization code for an invalid access token.
+    - `test_oauth_callback_with_taken_username`: Tests that a new OAuth user whose username is taken gets a username with a random suffix.
+    - `test_get_available_username`: Tests that username collisions are resolved in one query.
 
     Methods:
     - `setUp`: Sets up the initial data for the tests.
@@ -250,6 +259,8 @@ class OAuthCallbackViewTests(TestCase):
     """
 
     def setUp(self):
+        google.reset()
+        intra_42.reset()
 
         self.client = APIClient()
         self.google_callback_url = reverse("oauth-google-callback")
@@ -277,8 +288,8 @@ class OAuthCallbackViewTests(TestCase):
             },
         ]
 
-    @patch("requests.post")
-    @patch("requests.get")
+    @patch("requests.Session.post")
+    @patch("requests.Session.get")
     def test_oauth_callback_success(self, mock_get, mock_post):
         # Pretend Exchanging authorization code for an access token
         mock_post.return_value.json.return_value = {"access_token": "mock_access_token"}
@@ -313,7 +324,7 @@ class OAuthCallbackViewTests(TestCase):
             with self.subTest():
                 self.post_and_assert(callback_url, {"code": "invalid_code"})
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def test_oauth_callback_with_invalid_access_token(self, mock_post):
         mock_post.return_value.json.return_value = {
             "access_token": "mock_invalid_access_token"
@@ -323,12 +334,236 @@ class OAuthCallbackViewTests(TestCase):
             with self.subTest():
                 self.post_and_assert(callback_url, {"code": "valid_code"})
 
+    @patch("requests.Session.post")
+    @patch("requests.Session.get")
+    def test_oauth_callback_with_taken_username(self, mock_get, mock_post):
+        mock_post.return_value.json.return_value = {"access_token": "mock_access_token"}
+        mock_get.return_value.ok = True
+        # The 42 username is also taken when followed by the 42 user id
+        create_test_user("test_81545", "google@example.com")
+        create_test_user("testuser_815456", "intra@example.com")
+
+        for index, userinfo in enumerate(self.userinfos):
+            with self.subTest():
+                userinfo["email"] = f"oauth_{index}@example.com"
+                mock_get.return_value.json.return_value = userinfo
+                base_username = ("test_81545", "testuser")[index]
+
+                response = self.client.post(
+                    self.callback_urls[index], {"code": "valid_code"}
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                user = Users.objects.get(email=userinfo["email"])
+                self.assertTrue(user.username.startswith(f"{base_username}_"))
+                self.assertEqual(len(user.username), len(base_username) + 7)
+
+    def test_get_available_username(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_available_username("testuser"), "testuser")
+
+        create_test_user("testuser", "test@example.com")
+        with self.assertNumQueries(1):
+            username = get_available_username("testuser")
+        self.assertRegex(username, r"^testuser_[a-z0-9]{6}$")
+
+        create_test_user("test_user", "test_user@example.com")
+        with self.assertNumQueries(1):
+            username = get_available_username("test", suffix="user")
+        self.assertRegex(username, r"^test_[a-z0-9]{6}$")
+
     def post_and_assert(self, callback_url, data):
         response = self.client.post(callback_url, data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn("error_message", response.json())
 
 
+class StubOAuthServer(ThreadingHTTPServer):
+    """OAuth provider answering the token exchange and userinfo requests"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubOAuthHandler)
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        self.userinfo = {}
+        self.delay = 0
+        self.token_failures = 0
+        self.userinfo_failures = 0
+        self.connections = 0
+        self.requests = 0
+
+    def handle_error(self, request, client_address):
+        # Clients give up on slow answers
+        pass
+
+
+class StubOAuthHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        failed = self.server.token_failures > 0
+        self.server.token_failures -= failed
+        self.respond(failed, {"access_token": "stub_access_token"})
+
+    def do_GET(self):
+        failed = self.server.userinfo_failures > 0
+        self.server.userinfo_failures -= failed
+        self.respond(failed, self.server.userinfo)
+
+    def respond(self, failed, data):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        body = json.dumps({} if failed else data).encode()
+        self.send_response(503 if failed else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(
+    OAUTH_READ_TIMEOUT=0.5,
+    OAUTH_RETRIES=1,
+    OAUTH_RETRY_BACKOFF=0,
+    OAUTH_BREAKER_FAILURES=3,
+    OAUTH_BREAKER_RESET=0.2,
+)
+class OAuthProviderClientTests(TestCase):
+    """
+    Test suite for the OAuth callback views against a stub OAuth provider.
+
+    Test cases:
+    - `test_logins_reuse_connection`: Tests that logins share one connection to the provider and measures their latency.
+    - `test_slow_provider`: Tests that a login fails with 503 after the read timeout when the provider is slow.
+    - `test_userinfo_retried`: Tests that a failed userinfo request is retried.
+    - `test_token_exchange_not_retried`: Tests that a failed token exchange is not sent again.
+    - `test_circuit_breaker`: Tests that logins fail without reaching the provider while the circuit is open, and succeed once it closes.
+    - `test_probe_error`: Tests that a probe failing with an unexpected error lets the next request probe again.
+
+    Methods:
+    - `setUpClass`: Starts the stub OAuth server.
+    - `setUp`: Points the Google provider settings to the stub and resets the provider client.
+    - `login`: Helper method to log in with Google and return the response.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubOAuthServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        settings_override = override_settings(
+            GOOGLE_TOKEN_URI=f"{self.server.url}/token",
+            GOOGLE_USERINFO_URI=f"{self.server.url}/userinfo",
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        google.reset()
+        self.addCleanup(google.reset)
+
+        self.client = APIClient()
+        self.server.userinfo = {
+            "id": "815456",
+            "email": "test@example.com",
+            "given_name": "Test",
+            "family_name": "User",
+            "picture": "https://example.com/test.png",
+        }
+        self.server.delay = 0
+        self.server.token_failures = 0
+        self.server.userinfo_failures = 0
+        self.server.connections = 0
+        self.server.requests = 0
+
+    def test_logins_reuse_connection(self):
+        latencies = []
+        for _ in range(20):
+            start = time.perf_counter()
+            response = self.login()
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, 40)
+        # Logins are bounded by the provider, not by connection setup
+        self.assertLess(statistics.median(latencies), 0.5)
+
+    def test_slow_provider(self):
+        self.server.delay = 1
+
+        start = time.perf_counter()
+        response = self.login()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("error_message", response.json())
+        self.assertLess(elapsed, 1)
+
+    def test_userinfo_retried(self):
+        self.server.userinfo_failures = 1
+
+        response = self.login()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_token_exchange_not_retried(self):
+        self.server.token_failures = 1
+
+        response = self.login()
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_circuit_breaker(self):
+        self.server.token_failures = 3
+        for _ in range(3):
+            self.assertEqual(
+                self.login().status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+
+        response = self.login()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(self.server.requests, 3)
+
+        time.sleep(0.25)
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+
+    def test_probe_error(self):
+        self.server.token_failures = 3
+        for _ in range(3):
+            self.login()
+        time.sleep(0.25)
+
+        with patch.object(google.get_session(), "post", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                google.post(f"{self.server.url}/token")
+
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+
+    def login(self):
+        return self.client.post(
+            reverse("oauth-google-callback"), {"code": "valid_code"}
+        )
+
+
 class UpdateProfileViewTests(TestCase):
     """
     Test suite for the UpdateProfileView.
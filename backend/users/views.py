@@ -21,18 +21,49 @@ from rest_framework.serializers import ValidationError
 from users.models import Users, Blacklist
 from friendships.models import Friendships
 from chats.models import Conversations
+from chats.services import InboxService
+from notifications.consumers import ChatConsumer
 from django.utils.crypto import get_random_string
 from django.core.files.storage import default_storage
 from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.http import Http404
-import requests
+from chat_app.oauth import google, intra_42
+from .avatars import AvatarIngestion
 import logging
-import random
 import string
 
 logger = logging.getLogger(__name__)
 
+# Usernames with a random suffix tried at once when an OAuth username is taken
+USERNAME_CANDIDATES = 10
+
+
+def get_available_username(username, suffix=None):
+    """
+    Get the username, or a variant of it with a random suffix when it is
+    taken, checking all the candidates in one query. With a suffix, a
+    candidate is only available if the candidate followed by the suffix is
+    available too.
+    """
+    while True:
+        candidates = [username] + [
+            f"{username}_{get_random_string(6, string.ascii_lowercase + string.digits)}"
+            for _ in range(USERNAME_CANDIDATES)
+        ]
+        names = list(candidates)
+        if suffix is not None:
+            names += [f"{candidate}_{suffix}" for candidate in candidates]
+
+        taken = set(
+            Users.objects.filter(username__in=names).values_list("username", flat=True)
+        )
+        for candidate in candidates:
+            if candidate not in taken and (
+                suffix is None or f"{candidate}_{suffix}" not in taken
+            ):
+                return candidate
+
 
 class RegisterView(CreateAPIView):
     serializer_class = RegisterSerializer
@@ -76,32 +107,33 @@ class LoginView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class OAuthGoogleCallbackView(APIView):
+class OAuthCallbackView(APIView):
     """
-    View to handle the OAuth Google callback.
+    Base of the OAuth callback views.
 
-    This view processes the authorization code received from the OAuth Google
-    provider, exchanges it for an access token, retrieves user information,
-    and logs the user in or creates a new user if necessary.
+    The login flow is shared by the callback views of every provider: the
+    authorization code is exchanged for an access token, the access token
+    for the user information, and the user is logged in or created.
+    Subclasses define how to talk to their provider.
 
     Methods
     -------
     post(request):
         Handles the POST request to process the authorization code and log the user in.
 
-    get_or_create_user(userinfo):
-        Retrieves or creates a user based on the user information from the OAuth Google provider.
+    get_authorization_code(request):
+        Returns the authorization code of the request.
 
-    exchange_code_with_access_token(authorization_code):
-        Exchanges the authorization code for an access token.
-
-    request_42_userinfo(access_token):
-        Retrieves user information from the OAuth Google provider using the access token.
+    login(authorization_code):
+        Logs in the user of the authorization code.
     """
 
     permission_classes = [IsUnauthenticated]
 
     def post(self, request):
+        return self.login(self.get_authorization_code(request))
+
+    def get_authorization_code(self, request):
         authorization_code = request.data.get("code")
 
         if not authorization_code:
@@ -110,7 +142,9 @@ class OAuthGoogleCallbackView(APIView):
                     "error_message": "Authorization code is missing. Please try logging in again."
                 }
             )
+        return authorization_code
 
+    def login(self, authorization_code):
         access_token = self.exchange_code_with_access_token(authorization_code)
         if access_token is None:
             raise ValidationError(
@@ -119,7 +153,7 @@ class OAuthGoogleCallbackView(APIView):
                 }
             )
 
-        userinfo = self.request_google_userinfo(access_token)
+        userinfo = self.request_userinfo(access_token)
         if userinfo is None:
             raise ValidationError(
                 {
@@ -139,19 +173,34 @@ class OAuthGoogleCallbackView(APIView):
             status=status.HTTP_200_OK,
         )
 
+
+class OAuthGoogleCallbackView(OAuthCallbackView):
+    """
+    View to handle the OAuth Google callback.
+
+    This view processes the authorization code received from the OAuth Google
+    provider, exchanges it for an access token, retrieves user information,
+    and logs the user in or creates a new user if necessary.
+
+    Methods
+    -------
+    get_or_create_user(userinfo):
+        Retrieves or creates a user based on the user information from the OAuth Google provider.
+
+    exchange_code_with_access_token(authorization_code):
+        Exchanges the authorization code for an access token.
+
+    request_userinfo(access_token):
+        Retrieves user information from the OAuth Google provider using the access token.
+    """
+
     def get_or_create_user(self, userinfo):
         email = userinfo.get("email")
         user = Users.objects.filter(email=email).first()
         username = f"{userinfo.get('given_name').lower()}_{userinfo.get('id')[:5]}"
 
         if not user:
-            base_username = username
-            while Users.objects.filter(username=username).exists():
-                random_id = "".join(
-                    random.choices(string.ascii_lowercase + string.digits, k=6)
-                )
-                username = f"{base_username}_{random_id}"
-
+            username = get_available_username(username)
             password = get_random_string(30)
             user = Users.objects.create_user(
                 username=username,
@@ -162,6 +211,7 @@ class OAuthGoogleCallbackView(APIView):
                 picture=userinfo.get("picture"),
                 IsOAuth=True,
             )
+            AvatarIngestion.schedule(user)
         return user
 
     def exchange_code_with_access_token(self, authorization_code):
@@ -173,23 +223,21 @@ class OAuthGoogleCallbackView(APIView):
             "grant_type": "authorization_code",
         }
 
-        response = requests.post(settings.GOOGLE_TOKEN_URI, data)
+        response = google.post(settings.GOOGLE_TOKEN_URI, data)
         response_data = response.json()
 
         return response_data.get("access_token", None)
 
-    def request_google_userinfo(self, access_token):
+    def request_userinfo(self, access_token):
         headers = {"Authorization": f"Bearer {access_token}"}
 
-        response = requests.get(
-            "https://www.googleapis.com/oauth2/v2/userinfo", headers=headers
-        )
+        response = google.get(settings.GOOGLE_USERINFO_URI, headers=headers)
         if not response.ok:
             return None
         return response.json()
 
 
-class OAuth42CallbackView(APIView):
+class OAuth42CallbackView(OAuthCallbackView):
     """
     View to handle the OAuth 42 callback.
 
@@ -199,59 +247,19 @@ class OAuth42CallbackView(APIView):
 
     Methods
     -------
-    post(request):
-        Handles the POST request to process the authorization code and log the user in.
-
     get_or_create_user(userinfo):
         Retrieves or creates a user based on the user information from the OAuth 42 provider.
 
     exchange_code_with_access_token(authorization_code):
         Exchanges the authorization code for an access token.
 
-    request_42_userinfo(access_token):
+    request_userinfo(access_token):
         Retrieves user information from the OAuth 42 provider using the access token.
     """
 
-    permission_classes = [IsUnauthenticated]
-
-    def post(self, request):
-        authorization_code = request.data.get("code")
-
-        logger.info(f"Authorization code: {authorization_code}")
-        if not authorization_code:
-            raise ValidationError(
-                {
-                    "error_message": "Authorization code is missing. Please try logging in again."
-                }
-            )
-
-        access_token = self.exchange_code_with_access_token(authorization_code)
-        if access_token is None:
-            raise ValidationError(
-                {
-                    "error_message": "The authorization code is invalid or expired. Please try logging in again."
-                }
-            )
-
-        userinfo = self.request_42_userinfo(access_token)
-        if userinfo is None:
-            raise ValidationError(
-                {
-                    "error_message": "Authentication failed. Please ensure you are logged in and try again."
-                }
-            )
-
-        user = self.get_or_create_user(userinfo)
-        refresh = RefreshToken.for_user(user)
-
-        return Response(
-            {
-                "message": "Login successful",
-                "access": str(refresh.access_token),
-                "refresh": str(refresh),
-            },
-            status=status.HTTP_200_OK,
-        )
+    def get_authorization_code(self, request):
+        logger.info(f"Authorization code: {request.data.get('code')}")
+        return super().get_authorization_code(request)
 
     def get_or_create_user(self, userinfo):
         email = userinfo.get("email")
@@ -260,18 +268,10 @@ class OAuth42CallbackView(APIView):
         user = Users.objects.filter(email=email).first()
 
         if not user:
-            base_username = username
+            username = get_available_username(username, suffix=user_id)
             password = get_random_string(30)
             picture = userinfo.get("image").get("versions").get("medium")
 
-            while Users.objects.filter(
-                username=username
-            ).exists() or Users.objects.filter(username=f"{username}_{user_id}"):
-                random_id = "".join(
-                    random.choices(string.ascii_lowercase + string.digits, k=6)
-                )
-                username = f"{base_username}_{random_id}"
-
             user = Users.objects.create_user(
                 username=username,
                 email=email,
@@ -281,6 +281,7 @@ class OAuth42CallbackView(APIView):
                 password=password,
                 IsOAuth=True,
             )
+            AvatarIngestion.schedule(user)
         return user
 
     def exchange_code_with_access_token(self, authorization_code):
@@ -292,15 +293,15 @@ class OAuth42CallbackView(APIView):
             "grant_type": "authorization_code",
         }
 
-        response = requests.post(settings.TOKEN_42_URI, data)
+        response = intra_42.post(settings.TOKEN_42_URI, data)
         response_data = response.json()
 
         return response_data.get("access_token", None)
 
-    def request_42_userinfo(self, access_token):
+    def request_userinfo(self, access_token):
         headers = {"Authorization": f"Bearer {access_token}"}
 
-        response = requests.get("https://api.intra.42.fr/v2/me", headers=headers)
+        response = intra_42.get(settings.USERINFO_42_URI, headers=headers)
 
         if not response.ok:
             return None
@@ -391,7 +392,8 @@ class DeletePictureView(APIView):
     def delete(self, request, *args, **kwargs):
         user = request.user
         if user.picture and default_storage.exists(user.picture.path):
-            default_storage.delete(user.picture.path)
+            if not AvatarIngestion.is_shared(user.picture, user):
+                default_storage.delete(user.picture.path)
             user.picture = None
             user.save()
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -477,6 +479,7 @@ class BlacklistView(APIView):
             else:
                 conversation.IsBlockedByUser2 = value
             conversation.save()
+            ChatConsumer.sendInboxUpdates(InboxService.get_updates([conversation.id]))
 
 
 class UsersSearchView(APIView):